@@ -1,6 +1,7 @@
 # Only these modalities are available for query
 ALLOWED_MODALITIES = ['bold', 'T1w', 'T2w']
 STRUCTURAL_MODALITIES = ['T1w', 'T2w']
+ALL_MODALITIES = 'all'             # names all of the allowed modalities at once
 
 # Name of a subdirectory to hold fetched query results
 FETCHED_DIR = 'fetched'
@@ -13,6 +14,10 @@ REPORTS_DIR = 'reports'
 
 # File extensions for report files and BIDS-compliant data files.
 BIDS_DATA_EXT = '.tsv'
+GZIP_DATA_EXT = '.tsv.gz'
+FEATHER_DATA_EXT = '.feather'
+PARQUET_DATA_EXT = '.parquet'
+QUERY_FILE_EXT = '.qp'
 PLOT_EXT = '.png'
 REPORTS_EXT = '.html'
 
@@ -26,3 +31,8 @@ INPUTS_DIR_EXIT_CODE = 21
 REPORTS_DIR_EXIT_CODE = 22
 
 NUM_RECS_EXIT_CODE = 30
+OUTPUT_FIELDS_EXIT_CODE = 31
+NUM_SHARDS_EXIT_CODE = 32
+NUM_SAMPLES_EXIT_CODE = 33
+
+BATCH_FAILURE_EXIT_CODE = 40
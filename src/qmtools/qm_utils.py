@@ -1,6 +1,6 @@
 # Shared utilities for the QMTools programs.
 #   Written by: Tom Hicks and Dianne Patterson.
-#   Last Modified: Trivial doc fix.
+#   Last Modified: Load fetched files in the compressed and columnar formats too.
 #
 import datetime
 import os
@@ -8,7 +8,7 @@ import sys
 
 import pandas as pd
 
-from qmtools import (ALLOWED_MODALITIES,
+from qmtools import (ALLOWED_MODALITIES, FEATHER_DATA_EXT, PARQUET_DATA_EXT,
                      FETCHED_DIR, FETCHED_DIR_EXIT_CODE,
                      REPORTS_DIR, REPORTS_DIR_EXIT_CODE)
 from qmtools.file_utils import good_dir_path
@@ -63,8 +63,16 @@ def gen_output_name (modality, extension=''):
 
 
 def load_tsv (tsv_path):
-  "Read the specified TSV file and return a Pandas dataframe from it."
-  return pd.read_csv(tsv_path, sep='\t')
+  """
+  Read the specified TSV file and return a Pandas dataframe from it. Gzipped TSV,
+  Parquet, and Feather files are detected and read by their file extensions
+  (the columnar formats require the pyarrow package).
+  """
+  if (tsv_path.endswith(PARQUET_DATA_EXT)):
+    return pd.read_parquet(tsv_path)
+  if (tsv_path.endswith(FEATHER_DATA_EXT)):
+    return pd.read_feather(tsv_path)
+  return pd.read_csv(tsv_path, sep='\t')     # decompresses gzipped files by extension
 
 
 def validate_modality (modality):
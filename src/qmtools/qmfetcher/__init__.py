@@ -1,3 +1,29 @@
 CONNECTION_TIMEOUT = 30                     # connection timeout in seconds
 READ_TIMEOUT = 180                          # read timeout in seconds
 SERVER_PAGE_SIZE = 50
+STREAM_CHUNK_SIZE = 64 * 1024                # size of chunks of response text parsed incrementally
+FETCH_WORKERS = 4                           # default number of pages fetched concurrently
+BATCH_JOBS = 4                              # default number of query files fetched concurrently in a batch
+ASYNC_CONCURRENCY = 32                      # default number of page requests in flight on the event loop
+PIPELINE_DEPTH = 4                          # pages held between the stages of a pipelined fetch
+
+# Limits for adapting the page size to the server
+MAX_PAGE_SIZE = 1000                        # largest page size ever requested of the server
+PAGE_TIME_BUDGET = 0.5                      # fraction of the read timeout a page may be expected to take
+PAGE_TIME_SMOOTHING = 0.3                   # weight of the newest page in the time per record estimate
+
+# Location and limits of the on-disk cache of query responses
+CACHE_DIR = 'fetched/.cache'                # cache directory, below the run directory
+CACHE_TTL = 24 * 60 * 60                    # time-to-live for cached responses, in seconds
+CACHE_MAX_BYTES = 512 * 1024 * 1024         # total size cap for the cache, in bytes
+
+# Location of the local SQLite mirror of fetched records
+MIRROR_DB = 'fetched/mirror.sqlite'
+
+# Location of the persistent index of the checksums of the records already fetched
+CHKSUM_INDEX = 'fetched/md5sums.idx'
+
+# Limits for retrying requests when the server is overloaded
+MAX_RETRIES = 5                             # maximum retries of each overloaded request
+RETRY_BACKOFF = 1.0                         # initial wait before retrying, in seconds (doubles)
+RETRY_MAX_WAIT = 60.0                       # maximum wait before retrying, in seconds
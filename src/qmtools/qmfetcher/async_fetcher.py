@@ -0,0 +1,111 @@
+#
+# Asyncio versions of the methods to query the MRIQC server and download query result records.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Flatten only the fields to be written.
+#
+import asyncio
+import json
+import math
+
+import aiohttp
+
+import qmtools.qmfetcher.fetcher as fetch
+from qmtools.qmfetcher import ASYNC_CONCURRENCY, CONNECTION_TIMEOUT, READ_TIMEOUT
+
+
+async def ado_query (session, query_str, connection_timeout=CONNECTION_TIMEOUT,
+                     read_timeout=READ_TIMEOUT):
+  """
+  Query the server with the given query string through the given aiohttp session,
+  waiting for the specified or default time, then return the parsed JSON data
+  if successful, otherwise raise an aiohttp.ClientError.
+  """
+  timeout = aiohttp.ClientTimeout(sock_connect=connection_timeout, sock_read=read_timeout)
+  async with session.get(query_str, timeout=timeout) as resp:
+    resp.raise_for_status()
+    text = await resp.text()
+  return json.loads(text)
+
+
+async def afetch_page (session, query, args=None, fields=None):
+  """
+  Query for the first (or numbered) page of results from the MRIQC server.
+  Return a tuple of the cleaned, flattened result records and the metadata
+  dictionary which describes the page (e.g., total, max_results, page).
+  Arguments:
+    session: the aiohttp ClientSession through which to make the request.
+    query: pre-built query string to use to fetch a page of results.
+    args: a dictionary of arguments to create/control the query, passed to children.
+    fields: an optional list of the (flattened) fields to keep [default: all fields].
+  """
+  json_query_result = await ado_query(session, query)
+  json_recs = fetch.extract_records(json_query_result)
+  flat_recs = fetch.get_flattener(fields).flatten_records(json_recs)
+  fetch.clean_records(flat_recs, args)
+  return (flat_recs, json_query_result.get('_meta', {}))
+
+
+async def aget_n_records (modality, args, concurrency=ASYNC_CONCURRENCY, session=None):
+  """
+  Fetch N records from the server using the given parameters. Query then
+  clean, flatten, deduplicate and return a list of fetched image quality
+  metrics records (dictionaries), in server order. After the first page,
+  up to the given number of page requests are kept in flight on the event loop.
+  Cancelling the calling task cancels all of its outstanding page requests.
+  Arguments:
+    modality: the modality to query on (must be one of {ALLOWED_MODALITIES}).
+    args: a dictionary of optional arguments to create/control the query.
+    concurrency: the maximum number of page requests in flight at one time.
+    session: an optional aiohttp ClientSession through which to make the requests.
+  """
+  concurrency = max(1, concurrency)
+  own_session = (session is None)
+  if (own_session):
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency))
+
+  try:
+    num_recs = fetch.get_num_recs_arg(args)
+    fields = fetch.get_fields_arg(modality, args)
+    recs, meta = await afetch_page(session, fetch.build_query(modality, args, page_num=1), args,
+                                   fields)
+    good_records, chksums_seen = fetch.deduplicate_records(recs, set())
+    if (len(recs) < 1):                # if no records available, then exit
+      return good_records
+
+    # plan the page range from the total and the page size actually used by the server
+    page_size = meta.get('max_results') or len(recs)
+    last_page = math.ceil(meta.get('total', len(recs)) / page_size)
+    limiter = asyncio.Semaphore(concurrency)
+
+    async def fetch_numbered_page (page_num):
+      async with limiter:
+        query = fetch.build_query(modality, args, page_num=page_num)
+        page_recs, _ = await afetch_page(session, query, args, fields)
+        return page_recs
+
+    # fetch batches of the pages still needed until satisfied or out of pages
+    next_page_num = 2
+    while ((len(good_records) < num_recs) and (next_page_num <= last_page)):
+      pages_needed = math.ceil((num_recs - len(good_records)) / page_size)
+      batch = range(next_page_num, min(last_page, next_page_num + pages_needed - 1) + 1)
+      tasks = [asyncio.ensure_future(fetch_numbered_page(page_num)) for page_num in batch]
+      try:
+        pages = await asyncio.gather(*tasks)
+      except BaseException:            # on any failure or cancellation, abandon the batch
+        for task in tasks:
+          task.cancel()
+        raise
+      for recs in pages:
+        if (len(recs) < 1):            # if no more records available, then stop
+          last_page = 0
+          break
+        recs, chksums_seen = fetch.deduplicate_records(recs, chksums_seen)
+        good_records.extend(recs)
+      next_page_num += len(batch)
+
+  finally:
+    if (own_session):
+      await session.close()
+
+  # if got more than user asked for, prune off any extra records:
+  return good_records[:num_recs] if (len(good_records) > num_recs) else good_records
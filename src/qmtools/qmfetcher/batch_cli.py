@@ -0,0 +1,264 @@
+# CLI program to run a batch of query parameters files against the MRIQC server,
+# saving the results of each query into its own file (the 'qmfetcher batch' command).
+#   Written by: Tom Hicks and Dianne Patterson.
+# Last Modified: Describe refreshing as revalidating the response cache.
+#
+import argparse
+import csv
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests as req
+
+import qmtools.qm_utils as qmu
+import qmtools.qmfetcher.fetcher as fetch
+from qmtools import (ALLOWED_MODALITIES, BATCH_FAILURE_EXIT_CODE, BIDS_DATA_EXT, FETCHED_DIR,
+                     NUM_RECS_EXIT_CODE, QUERY_FILE_EXIT_CODE, QUERY_FILE_EXT)
+from qmtools.file_utils import good_file_path
+from qmtools.qmfetcher import (BATCH_JOBS, CACHE_MAX_BYTES, CACHE_TTL, FETCH_WORKERS,
+                               SERVER_PAGE_SIZE)
+from qmtools.qmfetcher.cache import ResponseCache
+from qmtools.qmfetcher.client import FetcherClient
+from qmtools.qmfetcher.page_sizer import PageSizer
+from qmtools.qmfetcher.query_parser import parse_query_from_file
+from qmtools.qmfetcher.throttle import AdaptiveLimiter
+
+PROG_NAME = 'qmfetcher batch'
+
+MANIFEST_FIELDS = ['query_file', 'output_file', 'num_fetched', 'total', 'elapsed', 'error']
+
+
+def fetch_query_file (modality, query_file, output_filepath, args, client):
+  """
+  Parse the given query parameters file, fetch the records matching it from the MRIQC
+  server, using the given client, and save them into the given output file.
+  Return a manifest entry (dictionary) for the query file, recording the number of
+  records fetched, the elapsed time, and the error which failed the query, if any.
+  """
+  start_time = time.perf_counter()
+  entry = { 'query_file': query_file, 'output_file': output_filepath,
+            'num_fetched': 0, 'total': None, 'error': None }
+  try:
+    qargs = dict(args, query_params=parse_query_from_file(modality, query_file, PROG_NAME))
+    page_meta = {}
+    recs = fetch.get_n_records(modality, qargs, client=client, sizer=PageSizer(),
+                               page_meta=page_meta)
+    fetch.save_records(modality, recs, output_filepath)
+    entry['num_fetched'] = len(recs)
+    entry['total'] = page_meta.get('total')
+  except (OSError, ValueError, req.RequestException) as err:
+    entry['error'] = str(err).strip() or type(err).__name__
+  entry['elapsed'] = round(time.perf_counter() - start_time, 3)
+  return entry
+
+
+def find_query_files (paths):
+  """
+  Return a list of the query parameters files named by the given paths, each of which
+  may name a directory (of query parameters files), a glob pattern, or a single file.
+  Each file is listed only once, in the order found.
+  """
+  query_files = []
+  for path in paths:
+    if (os.path.isdir(path)):
+      found = sorted(glob.glob(os.path.join(path, f"*{QUERY_FILE_EXT}")))
+    else:
+      found = sorted(glob.glob(path)) or [path]
+    for query_file in found:
+      if (query_file not in query_files):
+        query_files.append(query_file)
+  return query_files
+
+
+def get_output_filepaths (modality, query_files):
+  """
+  Return a list of the paths, in the fetched directory, of the output files for the
+  given query files, each named for its query file and the modality. Query files of
+  the same name, from different directories, are numbered to keep their outputs apart.
+  """
+  filepaths = []
+  for query_file in query_files:
+    stem = os.path.splitext(os.path.basename(query_file))[0]
+    filepath = os.path.join(FETCHED_DIR, f"{stem}_{modality}{BIDS_DATA_EXT}")
+    count = 1
+    while (filepath in filepaths):
+      count += 1
+      filepath = os.path.join(FETCHED_DIR, f"{stem}_{count}_{modality}{BIDS_DATA_EXT}")
+    filepaths.append(filepath)
+  return filepaths
+
+
+def write_manifest (manifest, filepath):
+  "Write the given manifest entries, one row per query file, into a TSV file at the given path."
+  with open(filepath, 'w', newline='') as manifest_file:
+    writer = csv.DictWriter(manifest_file, fieldnames=MANIFEST_FIELDS, delimiter='\t')
+    writer.writeheader()
+    for entry in manifest:
+      writer.writerow({ key: ('' if (val is None) else val) for key, val in entry.items() })
+
+
+def main (argv=None):
+  """
+  The main method for the batch command. This method is called from the qmfetcher
+  main method, processes the command line arguments and calls into the fetcher
+  module to do its work. The program takes arguments from the command line:
+    1) required modality of the IQM records to fetch (one of 'bold', 'T1w', or 'T2w')
+    2) required paths to query parameters files, directories of them, or glob patterns
+    3) optional number of records to fetch for each query [default: {SERVER_PAGE_SIZE}]
+    4) optional flag to use the oldest records [default: False (use latest records)]
+    5) optional number of query files to fetch concurrently [default: {BATCH_JOBS}]
+    6) optional number of pages to fetch concurrently for each query [default: {FETCH_WORKERS}]
+    7) optional flags to bypass or to refresh the on-disk response cache [default: False]
+    8) optional manifest filename [default: NONE (one will be generated)]
+    9) optional flag to page through the records by their keys, rather than by page number
+       [default: False]
+  """
+  if (argv is None):
+    argv = sys.argv[2:]                # skip the 'batch' command argument
+
+  parser = argparse.ArgumentParser(
+    prog=PROG_NAME,
+    formatter_class=argparse.RawTextHelpFormatter,
+    description='Run a batch of query parameters files, saving the results of each query into its own file.'
+  )
+
+  parser.add_argument(
+    '-v', '--verbose', dest='verbose', action='store_true',
+    default=False,
+    help='Print informational messages during processing [default: False (non-verbose mode)].'
+  )
+
+  parser.add_argument(
+    'modality', choices=ALLOWED_MODALITIES,
+    help=f"Modality of the MRIQC IQM records to fetch. Must be one of: {ALLOWED_MODALITIES}"
+  )
+
+  parser.add_argument(
+    'query_paths', metavar='path', nargs='+',
+    help=f"Query parameters files, directories of them (*{QUERY_FILE_EXT}), or glob patterns naming them."
+  )
+
+  parser.add_argument(
+    '-n', '--num-recs', dest='num_recs', type=int,
+    default=SERVER_PAGE_SIZE,
+    help=f"Number of records to fetch for each query [default: {SERVER_PAGE_SIZE}]"
+  )
+
+  parser.add_argument(
+    '--use-oldest', dest='use_oldest', action='store_true',
+    default=False,
+    help='Fetch the oldest records [default: False (the most recent records)].'
+  )
+
+  parser.add_argument(
+    '--keyset', dest='keyset', action='store_true',
+    default=False,
+    help='Page through the records after the key (creation time and id) of the last record fetched, rather than by page number [default: False].'
+  )
+
+  parser.add_argument(
+    '-j', '--jobs', dest='jobs', type=int,
+    default=BATCH_JOBS,
+    help=f"Number of query files to fetch concurrently [default: {BATCH_JOBS}]"
+  )
+
+  parser.add_argument(
+    '-w', '--workers', dest='workers', type=int,
+    default=FETCH_WORKERS,
+    help=f"Number of pages of records to fetch concurrently for each query [default: {FETCH_WORKERS}]"
+  )
+
+  parser.add_argument(
+    '--no-cache', dest='no_cache', action='store_true',
+    default=False,
+    help='Always query the server, bypassing the on-disk response cache [default: False].'
+  )
+
+  parser.add_argument(
+    '--refresh', dest='refresh', action='store_true',
+    default=False,
+    help='Revalidate the on-disk response cache with the server, re-fetching only changed responses [default: False].'
+  )
+
+  parser.add_argument(
+    '-m', '--manifest', dest='manifest_filename', metavar='filename',
+    default=argparse.SUPPRESS,
+    help='Optional name of the manifest file, in the fetched directory [default: none (one will be generated)].'
+  )
+
+  # actually parse the arguments from the command line
+  args = vars(parser.parse_args(argv))
+
+  modality = qmu.validate_modality(args.get('modality'))
+  qmu.ensure_fetched_dir(PROG_NAME)
+
+  num_recs = args.get('num_recs')
+  if (num_recs < 1):
+    err_msg = "({}): ERROR: {} Exiting...".format(PROG_NAME,
+      "The total number of records must be 1 or more.")
+    print(err_msg, file=sys.stderr)
+    sys.exit(NUM_RECS_EXIT_CODE)
+
+  query_files = [qfile for qfile in find_query_files(args.get('query_paths'))
+                   if good_file_path(qfile)]
+  if (not query_files):
+    err_msg = "({}): ERROR: {} Exiting...".format(PROG_NAME,
+      "The paths given must name one or more valid, readable query parameters files.")
+    print(err_msg, file=sys.stderr)
+    sys.exit(QUERY_FILE_EXIT_CODE)
+  output_filepaths = get_output_filepaths(modality, query_files)
+
+  manifest_filename = args.get('manifest_filename')
+  if (not manifest_filename):
+    manifest_filename = qmu.gen_output_name('batch', f"_manifest{BIDS_DATA_EXT}")
+  manifest_filepath = os.path.join(FETCHED_DIR, manifest_filename)
+  if (not manifest_filepath.endswith(BIDS_DATA_EXT)):
+    manifest_filepath = manifest_filepath + BIDS_DATA_EXT
+
+  # share one pooled connection session, response cache, and adaptive limiter among
+  # the requests of all of the queries run concurrently:
+  jobs = max(1, min(args.get('jobs'), len(query_files)))
+  workers = fetch.get_workers_arg(args) * jobs
+  if (args.get('no_cache')):
+    cache = None
+  else:
+    cache = ResponseCache(ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES, refresh=args.get('refresh'))
+  limiter = AdaptiveLimiter(max_limit=workers)
+  client = FetcherClient(pool_size=workers, cache=cache, limiter=limiter)
+
+  if (args.get('verbose')):
+    print(f"({PROG_NAME}): Running {len(query_files)} queries of modality '{modality}', for {num_recs} records each.",
+      file=sys.stderr)
+
+  start_time = time.perf_counter()
+  try:
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+      futures = [ executor.submit(fetch_query_file, modality, query_file, output_filepath,
+                                  args, client)
+                  for (query_file, output_filepath) in zip(query_files, output_filepaths) ]
+      manifest = [ future.result() for future in futures ]
+  finally:
+    client.close()
+  elapsed = time.perf_counter() - start_time
+
+  write_manifest(manifest, manifest_filepath)
+
+  failures = [entry for entry in manifest if entry.get('error')]
+  num_fetched = sum(entry.get('num_fetched') for entry in manifest)
+  if (args.get('verbose')):
+    for entry in manifest:
+      if (entry.get('error')):
+        print(f"({PROG_NAME}): Query file '{entry['query_file']}' failed: {entry['error']}",
+              file=sys.stderr)
+      else:
+        print(f"({PROG_NAME}): Fetched {entry['num_fetched']} records for '{entry['query_file']}' into '{entry['output_file']}'.",
+              file=sys.stderr)
+    print(f"({PROG_NAME}): Adaptive request {limiter.summary()}.", file=sys.stderr)
+  print("({}): Fetched {} records for {} of {} query files, in {:.2f} seconds. Manifest saved to '{}'.".format(
+    PROG_NAME, num_fetched, len(manifest) - len(failures), len(manifest), elapsed, manifest_filepath))
+
+  if (failures):
+    sys.exit(BATCH_FAILURE_EXIT_CODE)
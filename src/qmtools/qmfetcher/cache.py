@@ -0,0 +1,262 @@
+#
+# Class to manage a persistent, on-disk cache of MRIQC server query responses.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Keep the total size right when entries are replaced or expire.
+#
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+from qmtools.qmfetcher import CACHE_DIR, CACHE_MAX_BYTES, CACHE_TTL
+
+CACHE_FILE_EXT = '.json'
+VALIDATORS_FILE_EXT = '.validators'
+
+# the response headers which validate a cached response, with the request headers which send them
+VALIDATOR_HEADERS = { 'ETag': 'If-None-Match', 'Last-Modified': 'If-Modified-Since' }
+
+
+def normalize_url (url):
+  """
+  Return a normalized version of the given query URL, for use as a cache key:
+  the scheme and host are lowercased and the query arguments are sorted.
+  """
+  parts = urlsplit(url.strip())
+  query = '&'.join(sorted(arg for arg in parts.query.split('&') if arg))
+  return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ''))
+
+
+class ResponseCache(object):
+  """
+  Persistent cache of query response texts, keyed on the normalized query URL.
+  Each response is stored in its own file, whose modification time records when
+  it was fetched (for expiration after the time-to-live) and whose access time
+  records when it was last used (for least-recently-used eviction when the total
+  size of the cache exceeds its cap). If the server validated a response (with an
+  ETag or Last-Modified header), the validators are stored in a file beside it and
+  the response is kept when it expires (or is refreshed), so that it can be
+  revalidated with a conditional request rather than downloaded again.
+  """
+
+  def __init__ (self, cache_dir=CACHE_DIR, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES,
+                refresh=False):
+    """
+    Create a cache in the given directory, creating the directory if necessary.
+    If the refresh flag is set, cached responses are never read but are replaced.
+    """
+    self.cache_dir = cache_dir
+    self.ttl = ttl
+    self.max_bytes = max_bytes
+    self.refresh = refresh
+    self.num_revalidated = 0
+    self._lock = threading.Lock()
+    os.makedirs(cache_dir, mode=0o775, exist_ok=True)
+    self._total_bytes = sum(size for (_, _, size) in self.entries())
+
+
+  def clear (self):
+    "Remove all the entries from the cache."
+    with self._lock:
+      for (path, _, _) in self.entries():
+        self._remove_entry(path)
+      self._total_bytes = 0
+
+
+  def conditional_headers (self, url):
+    """
+    Return a dictionary of the request headers (If-None-Match and If-Modified-Since)
+    with which to revalidate the stale (or refreshed) cached response for the given
+    query URL, or an empty dictionary if no response with validators is cached.
+    """
+    validators = self.validators(url)
+    return { VALIDATOR_HEADERS[name]: value for (name, value) in validators.items()
+             if name in VALIDATOR_HEADERS }
+
+
+  def entries (self):
+    "Return a list of (path, last use time, size) tuples for the entries of the cache."
+    entries = []
+    for entry in os.scandir(self.cache_dir):
+      if (entry.name.endswith(CACHE_FILE_EXT)):
+        try:
+          stat = entry.stat()
+          entries.append((entry.path, stat.st_atime, stat.st_size))
+        except FileNotFoundError:      # removed by another thread or process
+          pass
+    return entries
+
+
+  def evict (self):
+    "Remove the least recently used entries until the cache is within its size cap."
+    with self._lock:
+      entries = sorted(self.entries(), key=lambda entry: entry[1])
+      total_bytes = sum(size for (_, _, size) in entries)
+      for (path, _, size) in entries:
+        if (total_bytes <= self.max_bytes):
+          break
+        self._remove_entry(path)
+        total_bytes -= size
+      self._total_bytes = total_bytes
+
+
+  def get (self, url):
+    """
+    Return the cached response text for the given query URL, or None if the
+    response is not cached, has expired, or the cache is being refreshed.
+    """
+    cfyl = self.open_entry(url)
+    if (cfyl is None):
+      return None
+    with cfyl:
+      return cfyl.read()
+
+
+  def open_entry (self, url):
+    """
+    Return an open text file from which to read the cached response for the given
+    query URL, or None if the response is not cached, has expired, or the cache
+    is being refreshed. The caller must close the file.
+    """
+    if (self.refresh):
+      return None
+    path = self.path_for(url)
+    try:
+      fetched_time = os.stat(path).st_mtime
+      now = time.time()
+      if ((now - fetched_time) > self.ttl):
+        if (not os.path.exists(self._validators_path(path))):
+          with self._lock:             # cannot be revalidated, so it is of no further use
+            self._total_bytes -= self._entry_size(path)
+            self._remove_entry(path)
+        return None
+      cfyl = open(path, encoding='utf-8')
+      os.utime(path, (now, fetched_time))   # record this use, keeping the fetch time
+      return cfyl
+    except FileNotFoundError:
+      return None
+
+
+  def path_for (self, url):
+    "Return the path of the cache file which holds the response for the given query URL."
+    key = hashlib.sha256(normalize_url(url).encode('utf-8')).hexdigest()
+    return os.path.join(self.cache_dir, f"{key}{CACHE_FILE_EXT}")
+
+
+  def put (self, url, text, headers=None):
+    """
+    Store the given response text for the given query URL, with the validators
+    among the given response headers, then evict least recently used entries if
+    the cache has grown beyond its size cap.
+    """
+    for _ in self.tee(url, [text], headers):
+      pass
+
+
+  def revalidated (self, url):
+    """
+    Mark the cached response for the given query URL as fresh again, as the server
+    has confirmed that it is unchanged (i.e. answered '304 Not Modified'), and
+    return an open text file from which to read it, or None if it is no longer
+    cached. The caller must close the file.
+    """
+    path = self.path_for(url)
+    try:
+      cfyl = open(path, encoding='utf-8')
+    except FileNotFoundError:
+      return None
+    now = time.time()
+    os.utime(path, (now, now))         # the response is as good as one fetched now
+    with self._lock:
+      self.num_revalidated += 1
+    return cfyl
+
+
+  def tee (self, url, chunks, headers=None):
+    """
+    Generator which yields each of the given chunks of response text for the given
+    query URL while also writing them to the cache. The response is stored only
+    if all of the chunks are consumed, with the validators among the given response
+    headers (if any); then least recently used entries are evicted if the cache has
+    grown beyond its size cap.
+    """
+    path = self.path_for(url)
+    validators = { name: headers[name] for name in VALIDATOR_HEADERS
+                   if (headers is not None) and headers.get(name) }
+    fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'w', encoding='utf-8') as cfyl:
+        for chunk in chunks:
+          cfyl.write(chunk)
+          yield chunk
+      with self._lock:                 # atomically replace any older response, and its size
+        old_size = self._entry_size(path)
+        os.replace(tmp_path, path)
+        self._total_bytes += os.path.getsize(path) - old_size
+        over_cap = (self._total_bytes > self.max_bytes)
+      self._write_validators(path, validators)
+    finally:
+      self._remove(tmp_path)           # if the response was not completely stored
+    if (over_cap):
+      self.evict()
+
+
+  def validators (self, url):
+    """
+    Return a dictionary of the validators (ETag and Last-Modified response headers)
+    of the cached response for the given query URL, which may be stale, or an empty
+    dictionary if no response with validators is cached.
+    """
+    path = self.path_for(url)
+    if (not os.path.exists(path)):
+      return {}
+    try:
+      with open(self._validators_path(path), encoding='utf-8') as vfyl:
+        return json.load(vfyl)
+    except (FileNotFoundError, ValueError):
+      return {}
+
+
+  def _entry_size (self, path):
+    "Return the size of the given cache entry file, or zero if there is no such file."
+    try:
+      return os.path.getsize(path)
+    except FileNotFoundError:
+      return 0
+
+
+  def _remove (self, path):
+    "Remove the given cache file, ignoring files already removed."
+    try:
+      os.remove(path)
+    except FileNotFoundError:
+      pass
+
+
+  def _remove_entry (self, path):
+    "Remove the given cache entry file and the validators of its response, if any."
+    self._remove(path)
+    self._remove(self._validators_path(path))
+
+
+  def _validators_path (self, path):
+    "Return the path of the file which holds the validators of the given cache entry file."
+    return path[:-len(CACHE_FILE_EXT)] + VALIDATORS_FILE_EXT
+
+
+  def _write_validators (self, path, validators):
+    "Store the given validators of the given cache entry file, removing any older ones."
+    vpath = self._validators_path(path)
+    if (not validators):
+      self._remove(vpath)
+      return
+    fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'w', encoding='utf-8') as vfyl:
+        json.dump(validators, vfyl)
+      os.replace(tmp_path, vpath)
+    finally:
+      self._remove(tmp_path)
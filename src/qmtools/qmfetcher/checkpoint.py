@@ -0,0 +1,116 @@
+#
+# Class to record the progress of a streaming fetch, so that an interrupted fetch can be resumed.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Rewrap the class documentation.
+#
+import json
+import os
+
+CHECKPOINT_EXT = '.ckpt'
+
+
+def checkpoint_path (output_filepath):
+  "Return the path of the checkpoint file kept next to the given output file."
+  return f"{output_filepath}{CHECKPOINT_EXT}"
+
+
+class Checkpoint(object):
+  """
+  Records the query being fetched, the offset reached (the number of server records
+  through the last page completed) or, for keyset pagination, the cursor reached (the
+  key of the last record written), the checksums of the records seen, the number of
+  records written, and the size of the output file after they were written.
+  The checkpoint file is append-only: a header line records the query and then one
+  JSON line is appended for each completed page, so the cost of saving does not
+  grow with the number of records fetched.
+  """
+
+  def __init__ (self, filepath, query):
+    self.filepath = filepath
+    self.query = query
+    self.offset = 0
+    self.cursor = None
+    self.chksums = set()
+    self.num_written = 0
+    self.file_size = 0
+    self._ckfile = None
+
+
+  @classmethod
+  def load (cls, filepath):
+    """
+    Load and return the checkpoint in the given file, or return None if there is
+    no such file. A partially written last line (from a crash) is ignored and cut
+    from the file, so that the entries appended when the fetch resumes can be read.
+    """
+    if (not os.path.isfile(filepath)):
+      return None
+    with open(filepath, 'rb') as ckfile:
+      lines = ckfile.readlines()
+    if (not lines):
+      return None
+    ckpt = cls(filepath, json.loads(lines[0]).get('query'))
+    good_size = len(lines[0])          # the size of the complete lines read
+    for line in lines[1:]:
+      if (not line.endswith(b'\n')):   # partially written when interrupted
+        break
+      try:
+        entry = json.loads(line)
+      except json.JSONDecodeError:     # partially written when interrupted
+        break
+      ckpt.offset = entry['offset']
+      ckpt.cursor = tuple(entry['cursor']) if entry.get('cursor') else None
+      ckpt.chksums.update(entry['md5sums'])
+      ckpt.num_written = entry['num_written']
+      ckpt.file_size = entry['file_size']
+      good_size += len(line)
+    if (good_size < os.path.getsize(filepath)):
+      os.truncate(filepath, good_size)
+    return ckpt
+
+
+  def close (self):
+    "Close the checkpoint file, if it is open."
+    if (self._ckfile is not None):
+      self._ckfile.close()
+      self._ckfile = None
+
+
+  def record_page (self, offset, records, num_written, file_size, cursor=None):
+    """
+    Record the completion of the page ending at the given server offset (or, for
+    keyset pagination, at the given cursor), whose (deduplicated) records have been
+    written, leaving the given total number of records and size of output file.
+    The checksums of the records are assumed to be already in the checksums set.
+    """
+    if (self._ckfile is None):
+      self._open()
+    entry = { 'offset': offset,
+              'md5sums': [rec.get('provenance.md5sum') for rec in records],
+              'num_written': num_written,
+              'file_size': file_size }
+    if (cursor is not None):
+      entry['cursor'] = list(cursor)
+    self._ckfile.write(json.dumps(entry) + '\n')
+    self._ckfile.flush()
+    os.fsync(self._ckfile.fileno())
+    self.offset = offset
+    self.cursor = cursor
+    self.num_written = num_written
+    self.file_size = file_size
+
+
+  def remove (self):
+    "Close and delete the checkpoint file: called when the fetch is complete."
+    self.close()
+    if (os.path.exists(self.filepath)):
+      os.remove(self.filepath)
+
+
+  def _open (self):
+    "Open the checkpoint file for appending, starting a new file if nothing is recorded."
+    if (self.offset > 0):
+      self._ckfile = open(self.filepath, 'a')
+    else:
+      self._ckfile = open(self.filepath, 'w')
+      self._ckfile.write(json.dumps({ 'query': self.query }) + '\n')
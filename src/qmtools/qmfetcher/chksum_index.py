@@ -0,0 +1,162 @@
+#
+# Class to keep a persistent, compact index of the checksums of the records already fetched.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Initial creation.
+#
+import bisect
+import fcntl
+import hashlib
+import heapq
+import mmap
+import os
+
+from qmtools.qmfetcher import CHKSUM_INDEX
+
+DIGEST_SIZE = 16                       # size of a binary md5 digest, in bytes
+WRITE_BATCH = 64 * 1024                # number of digests written to the index file at once
+
+
+def to_digest (chksum):
+  """
+  Return the 16-byte binary digest of the given md5 checksum (hex) string.
+  Any other string is reduced to the md5 digest of the string itself.
+  """
+  try:
+    digest = bytes.fromhex(chksum)
+    if (len(digest) == DIGEST_SIZE):
+      return digest
+  except ValueError:
+    pass
+  return hashlib.md5(chksum.encode('utf-8')).digest()
+
+
+class SortedDigests(object):
+  """
+  Read-only sequence view of a buffer of sorted, fixed-size binary digests,
+  so that the buffer can be searched (with bisect) without being copied.
+  """
+
+  def __init__ (self, buffer):
+    self.buffer = buffer
+
+
+  def __getitem__ (self, index):
+    if ((index < 0) or (index >= len(self))):
+      raise IndexError(index)
+    start = index * DIGEST_SIZE
+    return self.buffer[start:start + DIGEST_SIZE]
+
+
+  def __iter__ (self):
+    for start in range(0, len(self) * DIGEST_SIZE, DIGEST_SIZE):
+      yield self.buffer[start:start + DIGEST_SIZE]
+
+
+  def __len__ (self):
+    return len(self.buffer) // DIGEST_SIZE
+
+
+class ChecksumIndex(object):
+  """
+  A persistent set of record checksums, stored as a file of sorted, 16-byte binary
+  md5 digests: a third of the size of the hex strings and a small fraction of the
+  memory of a Python set of them. The file is memory-mapped read-only and searched
+  by bisection, so it is shared (through the page cache) by all of the processes
+  using it and only the checksums added since it was read are held in memory.
+  Saving merges the added checksums into the file under an exclusive lock, so that
+  concurrent runs add to the index rather than overwriting each other's additions.
+  Implements the 'in' and 'add' operations of a set of checksum strings, so it can
+  be used wherever a set of previously seen checksums is expected.
+  """
+
+  def __init__ (self, filepath=CHKSUM_INDEX):
+    self.filepath = filepath
+    self.added = set()
+    self._file = None
+    self._mmap = None
+    self._digests = SortedDigests(b'')
+    self.reload()
+
+
+  def __contains__ (self, chksum):
+    digest = to_digest(chksum)
+    return ((digest in self.added) or self._is_indexed(digest))
+
+
+  def __enter__ (self):
+    return self
+
+
+  def __exit__ (self, exc_type, exc_value, traceback):
+    self.close()
+
+
+  def __len__ (self):
+    return len(self._digests) + len(self.added)
+
+
+  def add (self, chksum):
+    "Add the given checksum to the index (in memory, until saved)."
+    digest = to_digest(chksum)
+    if (not self._is_indexed(digest)):
+      self.added.add(digest)
+
+
+  def close (self):
+    "Release the memory-mapped index file, if it is open."
+    if (self._mmap is not None):
+      self._mmap.close()
+      self._mmap = None
+    if (self._file is not None):
+      self._file.close()
+      self._file = None
+    self._digests = SortedDigests(b'')
+
+
+  def reload (self):
+    "(Re)open the index file, to see the checksums saved by any other runs."
+    self.close()
+    if (os.path.isfile(self.filepath) and (os.path.getsize(self.filepath) > 0)):
+      self._file = open(self.filepath, 'rb')
+      self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+      self._digests = SortedDigests(self._mmap)
+    self.added = set(digest for digest in self.added if not self._is_indexed(digest))
+
+
+  def save (self):
+    """
+    Merge the checksums added since the index was read into the index file, along
+    with any saved by other runs in the meantime, then reopen the index file.
+    """
+    if (not self.added):
+      return
+    os.makedirs(os.path.dirname(self.filepath) or '.', exist_ok=True)
+    with open(f"{self.filepath}.lock", 'a') as lockfile:
+      fcntl.flock(lockfile, fcntl.LOCK_EX)
+      self.reload()                    # merge with the latest saved index
+      tmp_path = f"{self.filepath}.{os.getpid()}.tmp"
+      with open(tmp_path, 'wb') as tmpfile:
+        batch = []
+        for digest in heapq.merge(self._digests, sorted(self.added)):
+          batch.append(digest)
+          if (len(batch) >= WRITE_BATCH):
+            tmpfile.write(b''.join(batch))
+            batch = []
+        tmpfile.write(b''.join(batch))
+        tmpfile.flush()
+        os.fsync(tmpfile.fileno())
+      os.replace(tmp_path, self.filepath)
+      self.added = set()
+      self.reload()
+
+
+  def update (self, chksums):
+    "Add each of the given checksums to the index (in memory, until saved)."
+    for chksum in chksums:
+      self.add(chksum)
+
+
+  def _is_indexed (self, digest):
+    "Tell whether the given binary digest is in the (saved) index file."
+    pos = bisect.bisect_left(self._digests, digest)
+    return ((pos < len(self._digests)) and (self._digests[pos] == digest))
@@ -0,0 +1,241 @@
+#
+# Class to manage a pooled, keep-alive HTTP session for requests to the MRIQC server.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Count responses closed without a body to read (e.g., 304) as healthy.
+#
+import threading
+import time
+
+import requests as req
+from requests.adapters import HTTPAdapter
+
+from qmtools.qmfetcher import FETCH_WORKERS
+from qmtools.qmfetcher.throttle import RETRY_STATUS_CODES, parse_retry_after
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+# errors while reading a streamed response body, after which the rest of the body is requested again
+STREAM_ERRORS = (req.exceptions.ChunkedEncodingError, req.ConnectionError, req.Timeout)
+
+
+class FetcherClient(object):
+  """
+  Owns a requests Session, whose connection pool is sized to the number of
+  concurrent requests expected, so that connections (and their TCP and TLS
+  handshakes) are reused by all the requests made to the MRIQC server.
+  The client may also carry a ResponseCache, which is consulted by do_query, and
+  an AdaptiveLimiter, which paces its requests and retries those which fail
+  because the server is overloaded, and a FetchStats, which collects the
+  measurements of the requests made and of the records they return.
+  """
+
+  def __init__ (self, pool_size=FETCH_WORKERS, cache=None, limiter=None, stats=None):
+    """
+    Create a client whose connection pool can hold the given number of connections
+    and which uses the given (optional) ResponseCache, AdaptiveLimiter, and FetchStats.
+    """
+    self.cache = cache
+    self.limiter = limiter
+    self.stats = stats
+    self.pool_size = max(1, pool_size)
+    self.session = req.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+    self.session.mount('https://', adapter)
+    self.session.mount('http://', adapter)
+
+
+  def __enter__ (self):
+    return self
+
+
+  def __exit__ (self, exc_type, exc_value, traceback):
+    self.close()
+
+
+  def close (self):
+    "Close the session and all of its pooled connections."
+    self.session.close()
+
+
+  def get (self, url, timeout=None, stream=False, headers=None):
+    """
+    Issue a GET request for the given URL, with the given (connection, read)
+    timeout tuple and optional dictionary of request headers, on a pooled
+    connection. Returns the requests Response, whose body is read incrementally
+    if the stream flag is set.
+    If the client has a limiter, the request waits for its turn and requests
+    which time out or are refused by an overloaded server are retried, up to
+    the limiter's maximum number of retries. A streamed response then holds its
+    turn until its body has been read, or it is closed (see LimitedResponse).
+    """
+    if (self.limiter is None):
+      return self.session.get(url, timeout=timeout, stream=stream, headers=headers)
+
+    resp, start = self.limited_get(url, timeout=timeout, stream=stream, headers=headers)
+    if (start is None):                # out of retries: the limiter was already released
+      return resp
+    if (stream):
+      return LimitedResponse(self, url, resp, start, timeout=timeout)
+    self.limiter.release(latency=(time.monotonic() - start))
+    return resp
+
+
+  def limited_get (self, url, timeout=None, stream=False, headers=None):
+    """
+    Issue a GET request for the given URL through the client's limiter, retrying
+    requests which time out or are refused by an overloaded server, and return a
+    tuple of the response and the (monotonic) time its request was started. The
+    caller must release the limiter for a successful response; if the retries run
+    out, the error response is returned with a start time of None, as the limiter
+    was already released.
+    """
+    limiter = self.limiter
+    for attempt in range(limiter.max_retries + 1):
+      limiter.acquire()
+      start = time.monotonic()
+      try:
+        resp = self.session.get(url, timeout=timeout, stream=stream, headers=headers)
+      except req.Timeout:
+        limiter.release(overloaded=True)
+        if (attempt < limiter.max_retries):
+          continue
+        raise
+      except BaseException:
+        limiter.release()
+        raise
+      if (resp.status_code in RETRY_STATUS_CODES):
+        limiter.release(overloaded=True,
+                        retry_after=parse_retry_after(resp.headers.get('Retry-After')))
+        if (attempt < limiter.max_retries):
+          resp.close()                 # release the connection before retrying
+          continue
+        return (resp, None)            # out of retries: let the caller see the error
+      return (resp, start)
+
+
+class LimitedResponse(object):
+  """
+  Wraps a streamed response obtained through a client's limiter, holding the
+  limiter until the body of the response has been read, so that the limiter counts
+  the request as in flight, and measures its latency, until the transfer is done.
+  If reading the body fails (e.g., the read times out or the connection is cut
+  off), the failure is counted as an overload, and the response is requested again,
+  after backing off, and read from where the failed read stopped, up to the
+  limiter's maximum number of retries. Closing the response releases the limiter,
+  if the body was not read: with the latency of the request, if the response has
+  no body to read (e.g., '304 Not Modified'), but not if its body was abandoned.
+  Other attributes are those of the wrapped Response.
+  """
+
+  def __init__ (self, client, url, resp, start, timeout=None):
+    self.client = client
+    self.url = url
+    self.timeout = timeout
+    self._resp = resp
+    self._start = start
+    self._held = True                  # whether this response holds the limiter
+    self._reading = False              # whether the body has begun to be read
+
+
+  def __enter__ (self):
+    return self
+
+
+  def __exit__ (self, exc_type, exc_value, traceback):
+    self.close()
+
+
+  def __getattr__ (self, name):
+    return getattr(self._resp, name)
+
+
+  @property
+  def encoding (self):
+    return self._resp.encoding
+
+
+  @encoding.setter
+  def encoding (self, value):
+    self._resp.encoding = value
+
+
+  def close (self):
+    "Close the response, releasing the limiter if the body was not read (see above)."
+    if (self._reading or (self._resp.status_code == req.codes.ok)):
+      self._release()                  # the body was abandoned: its latency is unknown
+    else:
+      self._release(latency=(time.monotonic() - self._start))
+    self._resp.close()
+
+
+  def iter_content (self, chunk_size=1, decode_unicode=False):
+    """
+    Generator which yields the body of the response in chunks, as it arrives,
+    resuming a body cut off by a failed read (see above). Once the whole body has
+    been read, the limiter is released with the latency of the whole transfer.
+    """
+    limiter = self.client.limiter
+    self._reading = True
+    num_read = 0                       # the length of the body already yielded
+    for attempt in range(limiter.max_retries + 1):
+      position = 0                     # the length of the body received by this attempt
+      try:
+        for chunk in self._resp.iter_content(chunk_size=chunk_size, decode_unicode=decode_unicode):
+          position += len(chunk)
+          if (position > num_read):    # skip any part of the body already yielded
+            chunk = chunk[len(chunk) - (position - num_read):]
+            num_read = position
+            yield chunk
+        self._release(latency=(time.monotonic() - self._start))
+        return
+      except STREAM_ERRORS:
+        self._release(overloaded=True)
+        if (attempt >= limiter.max_retries):
+          raise
+      self._resume()
+
+
+  def _release (self, latency=None, overloaded=False):
+    "Release the limiter, with the given outcome, if this response still holds it."
+    if (self._held):
+      self._held = False
+      self.client.limiter.release(latency=latency, overloaded=overloaded)
+
+
+  def _resume (self):
+    """
+    Request the response again, after its body was cut off, and check that it is
+    the same response, so that reading it may resume where the failed read stopped.
+    """
+    etag = self._resp.headers.get('ETag')
+    encoding = self._resp.encoding
+    self._resp.close()
+    resp, start = self.client.limited_get(self.url, timeout=self.timeout, stream=True)
+    if (start is not None):
+      self._held = True
+    if (resp.status_code != req.codes.ok):
+      self._resp = resp
+      self.close()
+      raise req.HTTPError(f"{resp.status_code} Error resuming the response from {self.url}",
+                          response=resp)
+    if (etag and (resp.headers.get('ETag') != etag)):
+      self._resp = resp
+      self.close()
+      raise req.exceptions.ChunkedEncodingError(
+        f"The response changed while its body was being read from {self.url}")
+    resp.encoding = encoding
+    self._resp = resp
+    self._start = start
+
+
+def get_default_client ():
+  """
+  Return the shared client used when no client is given to the fetcher functions,
+  creating it on first use.
+  """
+  global _default_client
+  with _default_client_lock:
+    if (_default_client is None):
+      _default_client = FetcherClient()
+    return _default_client
@@ -1,26 +1,53 @@
 # Methods to query the MRIQC server and download query result records.
 #   Written by: Tom Hicks and Dianne Patterson.
-#   Last Modified: Subdivide default timeout into connection timeout and read timeout.
+#   Last Modified: Remove an unused import.
 #
 import csv
 import json
+import os
+import sys
+import time
 import requests as req
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
-
-from qmtools import STRUCTURAL_MODALITIES
-from qmtools.mriqc_keywords import BOLD_KEYWORDS, STRUCTURAL_KEYWORDS
-from qmtools.qmfetcher import CONNECTION_TIMEOUT, READ_TIMEOUT, SERVER_PAGE_SIZE
+from email.utils import parsedate_to_datetime
+
+from qmtools.qmfetcher import (CONNECTION_TIMEOUT, FETCH_WORKERS, READ_TIMEOUT,
+                               SERVER_PAGE_SIZE, STREAM_CHUNK_SIZE)
+from qmtools.qmfetcher.checkpoint import Checkpoint, checkpoint_path
+from qmtools.qmfetcher.client import get_default_client
+from qmtools.qmfetcher.flattener import RecordFlattener
+from qmtools.qmfetcher.json_stream import PageStream
+from qmtools.qmfetcher.page_sizer import PageSizer
+from qmtools.qmfetcher.pipeline import PagePipeline
+from qmtools.qmfetcher.stats import ChunkTimer
+from qmtools.qmfetcher.writers import TsvWriter, get_output_fields, get_writer
 from qmtools.qm_utils import validate_modality
 
-SERVER_URL = "https://mriqc.nimh.nih.gov/api/v1"
+# the MRIQC server API, which may be replaced (e.g., by a local stand-in for testing)
+SERVER_URL = os.environ.get('MRIQC_SERVER_URL', "https://mriqc.nimh.nih.gov/api/v1")
+
+# shared flatteners which learn the flattened keys of the records once, for all pages,
+# one for all fields and one for each set of fields to be written:
+FLATTENER = RecordFlattener()
+FLATTENERS = {}
 
+# the fields which order the records for keyset pagination: creation time, then id
+KEYSET_FIELDS = ['_created', '_id']
 
-def build_query (modality, args, page_num=1):
+
+def build_query (modality, args, page_num=1, page_size=None, after=None):
   """
   Construct and return a query string given the modality and a dictionary of
-  optional query arguments; like maximum results, oldest record flag, and
-  dictionary of content query parameter keys and values.
+  optional query arguments; like maximum results, oldest record flag,
+  dictionary of content query parameter keys and values, and list of fields.
+  The query projects the records onto only the fields to be written.
+  If a page size is given, it is requested instead of the number of records.
+  If the arguments select keyset pagination, the records are ordered by creation
+  time and id and, if a cursor (the key of the last record seen) is given, only the
+  records beyond it are selected.
   Returns a single constructed query URL string.
   """
   validate_modality(modality)          # validates or raises ValueError
@@ -29,25 +56,62 @@ def build_query (modality, args, page_num=1):
   if (not page_num or (page_num < 1)):
     page_num = 1
 
-  # use the number of records as the max_results argument
-  max_results = get_num_recs_arg(args)
+  # use the page size or, by default, the number of records as the max_results argument
+  max_results = page_size if (page_size and (page_size > 0)) else get_num_recs_arg(args)
 
   url_str = f"{SERVER_URL}/{modality}?max_results={max_results}&page={page_num}"
 
   # if use_oldest flag is not specified, sort the records to use the most recent
-  if (not args.get('use_oldest', False)):   # uses most recent by default
+  if (args.get('keyset')):             # keyset pages need a total order on the keys
+    url_str = f"{url_str}&sort={build_keyset_sort(args.get('use_oldest', False))}"
+  elif (not args.get('use_oldest', False)):   # uses most recent by default
     url_str = f"{url_str}&sort=-_created"
 
   # add any content query parameters to the URL in the "special" WHERE clause
   query_params = args.get('query_params')
-  if (query_params):
-    pairs = [f"{key}{clean_field(val)}" for key, val in query_params]
+  pairs = [f"{key}{clean_field(val)}" for key, val in query_params] if query_params else []
+  if (args.get('keyset') and after):   # select only the records beyond the cursor
+    pairs.append(build_keyset_clause(after, args.get('use_oldest', False)))
+  if (pairs):
     qps = '%20and%20'.join(pairs)
     url_str = f"{url_str}&where={qps}"
 
+  # ask the server to send only the fields which will be written
+  url_str = f"{url_str}&projection={build_projection(get_fields_arg(modality, args))}"
+
   return url_str
 
 
+def build_keyset_clause (cursor, use_oldest=False):
+  """
+  Return the WHERE clause which selects only the records beyond the given cursor,
+  a (creation time string, id) tuple of the last record seen, in keyset order:
+  those created later (if using the oldest records) or earlier (by default) than the
+  cursor and, of those created at the same time, those with a greater (or lesser) id.
+  """
+  created, rec_id = cursor
+  op = '>' if use_oldest else '<'
+  clause = f'(_created{op}"{created}" or (_created=="{created}" and _id{op}"{rec_id}"))'
+  return clean_field(clause)
+
+
+def build_keyset_sort (use_oldest=False):
+  "Return the value of the sort query parameter which orders the records by their keyset fields."
+  if (use_oldest):
+    return ','.join(KEYSET_FIELDS)
+  return ','.join(f"-{field}" for field in KEYSET_FIELDS)
+
+
+def build_projection (fields):
+  """
+  Return the value of the Eve projection query parameter which includes only
+  the given (flattened) field names; with a stable field order, so that the
+  same fields always give the same query URL.
+  """
+  projection = json.dumps({ field: 1 for field in sorted(fields) }, separators=(',', ':'))
+  return clean_field(projection)
+
+
 def clean_field (field):
   """
   Return a copy of the given string with a few special characters URL encoded.
@@ -74,16 +138,25 @@ def clean_records (json_recs, args=None):
   return json_recs
 
 
-def deduplicate_records (records, chksums=set()):
+def deduplicate_records (records, chksums=None, stats=None):
   """
   Use the given set of previously gathered checksums to identify and
   remove duplicate records from the given list.
   Arguments:
      records: list of records (dictionaries) to be deduplicated.
-     chksums: SET of previously seen checksums; used to identify duplicate records.
+     chksums: SET (or ChecksumIndex) of previously seen checksums; used to identify
+              duplicate records [default: a new, empty set].
+     stats: an optional FetchStats, to which the time taken and the number of
+            duplicates found are added.
   """
+  if (chksums is None):
+    chksums = set()
+  start = time.perf_counter()
   # omit records w/ no checksum or checksum is in list of checksums already seen
-  return ([rec for rec in records if is_not_duplicate(rec, chksums)], chksums)
+  good_recs = [rec for rec in records if is_not_duplicate(rec, chksums)]
+  if (stats is not None):
+    stats.add_dedup(len(records), len(records) - len(good_recs), time.perf_counter() - start)
+  return (good_recs, chksums)
 
 
 def is_not_duplicate (record, chksums):
@@ -93,7 +166,7 @@ def is_not_duplicate (record, chksums):
   adds the checksum to the given set of checksums, by side effect!
   Arguments:
     record: a record (dictionary) of image information.
-    chksums: a SET of previously seen md5sums.
+    chksums: a SET (or ChecksumIndex) of previously seen md5sums.
   """
   recsum = record.get('provenance.md5sum')
   if (recsum is None or (recsum in chksums)):
@@ -103,19 +176,52 @@ def is_not_duplicate (record, chksums):
     return True
 
 
-def do_query (query_str, connection_timeout=CONNECTION_TIMEOUT, read_timeout=READ_TIMEOUT):
+def do_query (query_str, connection_timeout=CONNECTION_TIMEOUT, read_timeout=READ_TIMEOUT,
+              client=None):
   """
   Query the server with the given query string, waiting for the specified
   or default time, then return the parsed JSON data if successful, otherwise
- raise a RequestException.
+  raise a RequestException. The request is made through the given client
+  or, if none is given, through the shared default client. If the client has
+  a response cache, a cached response is returned instead, when available,
+  and successful responses are stored in the cache. A stale (or refreshed)
+  cached response is revalidated with a conditional request and, if the server
+  answers that it is unchanged (304), it is returned without downloading it again.
   """
-  time_tuple = (connection_timeout, read_timeout)
-  resp = req.get(query_str, timeout=time_tuple)
-  if (resp.status_code == req.codes.ok):
-    json_query_result = json.loads(resp.text)
-    return json_query_result
-  else:
-    resp.raise_for_status()
+  if (client is None):
+    client = get_default_client()
+
+  start = time.perf_counter()
+  cache = client.cache
+  query_text = cache.get(query_str) if (cache is not None) else None
+  cached = (query_text is not None)
+  if (not cached):
+    time_tuple = (connection_timeout, read_timeout)
+    resp = get_response(query_str, client, time_tuple)
+    if (resp.status_code == req.codes.not_modified):   # unchanged: use the cached response
+      cached_file = cache.revalidated(query_str)
+      if (cached_file is not None):
+        with cached_file:
+          query_text = cached_file.read()
+        cached = True
+      else:                            # removed meanwhile: fetch it unconditionally
+        resp = client.get(query_str, timeout=time_tuple)
+    if (not cached):
+      if (resp.status_code != req.codes.ok):
+        resp.raise_for_status()
+        return None
+      query_text = resp.text
+  latency = time.perf_counter() - start
+  json_query_result = json.loads(query_text)
+  decode_secs = time.perf_counter() - start - latency
+  if ((cache is not None) and (not cached)):
+    cache.put(query_str, query_text, resp.headers)
+
+  stats = get_stats(client)
+  if (stats is not None):              # the latency includes the transfer of the whole text
+    stats.add_page(query_str, len(query_text.encode('utf-8')),
+                   len(extract_records(json_query_result)), latency, {'decode': decode_secs})
+  return json_query_result
 
 
 def extract_records (json_query_result):
@@ -153,35 +259,307 @@ def flatten_records (json_recs):
   Arguments:
     json_recs: a list of records (dictionaries), each one representing metrics for a single image.
   """
-  return [dict(flatten_a_record(rec)) for rec in json_recs]
+  return FLATTENER.flatten_records(json_recs)
+
+
+def fetch_page (query, args=None, client=None, fields=None):
+  """
+  Query for the first (or numbered) page of results from the MRIQC server.
+  Return a tuple of the cleaned, flattened result records and the metadata
+  dictionary which describes the page (e.g., total, max_results, page).
+  The page is parsed as its text streams in and each record is flattened as
+  soon as it is decoded, so neither the whole page text nor all of the nested
+  records are ever held in memory. If a list of fields is given, all other fields
+  are dropped as the records are flattened.
+  Arguments:
+    query: pre-built query string to use to fetch a page of results.
+    args: a dictionary of arguments to create/control the query, passed to children.
+    client: an optional FetcherClient through which to make the request.
+    fields: an optional list of the (flattened) fields to keep [default: all fields].
+  """
+  flattener = get_flattener(fields)
+  stats = get_stats(client)
+  if (stats is not None):
+    return fetch_measured_page(query, args, client, flattener, stats)
+  page = PageStream(stream_query(query, client=client))
+  flat_recs = [flattener.flatten(rec) for rec in page]
+  clean_records(flat_recs, args)
+  return (flat_recs, page.fields.get('_meta', {}))
+
+
+def fetch_measured_page (query, args, client, flattener, stats):
+  """
+  Fetch, flatten, and clean a page of results, as fetch_page does, while measuring
+  the page and adding the measures to the given FetchStats: the latency of the
+  request (to its first text chunk), the number of bytes received, the time spent
+  waiting for the rest of the text (transfer), decoding the records (decode),
+  and flattening and cleaning them (flatten).
+  """
+  start = time.perf_counter()
+  chunks = ChunkTimer(stream_query(query, client=client))
+  page = PageStream(chunks)
+  flat_recs = []
+  flatten_secs = 0.0
+  for rec in page:
+    flatten_start = time.perf_counter()
+    flat_recs.append(flattener.flatten(rec))
+    flatten_secs += time.perf_counter() - flatten_start
+  flatten_start = time.perf_counter()
+  clean_records(flat_recs, args)
+  flatten_secs += time.perf_counter() - flatten_start
+
+  latency = chunks.latency or 0.0
+  decode_secs = time.perf_counter() - start - chunks.wait_seconds - flatten_secs
+  stats.add_page(query, chunks.num_bytes, len(flat_recs), latency,
+                 { 'transfer': chunks.wait_seconds - latency, 'decode': max(0.0, decode_secs),
+                   'flatten': flatten_secs })
+  return (flat_recs, page.fields.get('_meta', {}))
 
 
-def get_n_records (modality, args):
+def fetch_span (query, page_num, page_size, skip, args=None, client=None, fields=None,
+                sizer=None):
+  """
+  Fetch the page of results with the given number and size, using the given query,
+  and return a tuple of the records of the page from the given number of records
+  to skip onward, the number of records in the whole page, and the page metadata.
+  If the server honors a smaller page size than the size requested, the records
+  returned are those of the smaller page, from the given skip position onward.
+  If a page sizer is given, it is told the size honored and the time taken.
+  Arguments:
+    query: pre-built query string to use to fetch the page of results.
+    page_num: the number of the page requested by the query.
+    page_size: the page size requested by the query.
+    skip: the number of records to skip at the start of the page requested.
+    args: a dictionary of arguments to create/control the query, passed to children.
+    client: an optional FetcherClient through which to make the request.
+    fields: an optional list of the (flattened) fields to keep [default: all fields].
+    sizer: an optional PageSizer to be told of the page fetched.
+  """
+  start_time = time.monotonic()
+  recs, meta = fetch_page(query, args, client, fields)
+  honored_size = meta.get('max_results') or page_size
+  if (sizer is not None):
+    sizer.observe(page_size, honored_size, len(recs), time.monotonic() - start_time)
+  start = ((page_num - 1) * page_size + skip) - ((page_num - 1) * honored_size)
+  return (recs[start:start + page_size - skip], len(recs), meta)
+
+
+def gen_record_pages (modality, args, client=None, first_offset=0, num_wanted=None,
+                      sizer=None, page_meta=None):
+  """
+  Generator which yields (offset, page of records) tuples, where the pages of
+  cleaned, flattened records are yielded in server order and the offset is the
+  number of server records through the end of the page.
+  The first page is fetched alone so that the total number of matching records
+  and the largest page size honored by the server can be used to plan the
+  remaining pages, which are then fetched concurrently by a bounded pool of
+  worker threads. The size of each page is chosen by a page sizer, which adapts
+  it to the server's behavior, and the final page is sized to fetch no more than
+  the records wanted. Only enough pages to satisfy the number of records wanted
+  are planned but, if the caller keeps asking (e.g., because of duplicates),
+  more are fetched.
+  Arguments:
+    modality: the modality to query on (must be one of {ALLOWED_MODALITIES}).
+    args: a dictionary of optional arguments to create/control the query.
+    client: an optional FetcherClient through which to make the requests.
+    first_offset: the number of server records to skip (e.g., when resuming).
+    num_wanted: the number of records wanted [default: the number of records requested].
+    sizer: an optional PageSizer to choose the page sizes [default: a new PageSizer].
+    page_meta: an optional dictionary, updated with the metadata of the first page
+               (e.g., the total number of records available), by side effect.
+  """
+  if (num_wanted is None):
+    num_wanted = get_num_recs_arg(args)
+  workers = get_workers_arg(args)
+  fields = get_fields_arg(modality, args)
+  if (sizer is None):
+    sizer = PageSizer()
+
+  def submit_span (offset, remaining):
+    "Submit the fetch of the page starting at the given offset, returning its end offset."
+    page_num, page_size, skip = sizer.choose(offset, remaining)
+    query = build_query(modality, args, page_num=page_num, page_size=page_size)
+    future = pool.submit(fetch_span, query, page_num, page_size, skip, args, client, fields, sizer)
+    pending.append((offset, offset + page_size - skip, page_size, future))
+    return offset + page_size - skip
+
+  pending = deque()
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    try:
+      # fetch the first page alone, to learn the total and the page size honored
+      offset = first_offset
+      while True:
+        submit_span(offset, num_wanted)
+        _, _, page_size, future = pending.popleft()
+        recs, page_len, meta = future.result()
+        if (recs or (page_len < 1) or (meta.get('max_results', page_size) >= page_size)):
+          break                        # unless a capped page size missed the offset
+      if (page_meta is not None):
+        page_meta.update(meta)
+      offset += len(recs)
+      yield (offset, recs)
+      if (page_len < 1):               # if no records available, then exit
+        return
+
+      # plan the remaining pages up to the total or to the number of records wanted
+      total_recs = meta.get('total', offset)
+      planned_offset = min(total_recs, first_offset + num_wanted)
+      next_offset = offset
+      while ((next_offset < total_recs) or pending):
+        if (not pending and (next_offset >= planned_offset)):  # caller wants more
+          planned_offset = min(total_recs, planned_offset + (workers * sizer.target_size()))
+        while ((next_offset < planned_offset) and (len(pending) < workers)):
+          next_offset = submit_span(next_offset, planned_offset - next_offset)
+        page_offset, planned_end, _, future = pending.popleft()
+        recs, page_len, _ = future.result()
+        offset = page_offset + len(recs)
+        yield (offset, recs)
+        if (page_len < 1):             # if no more records available, then exit
+          break
+        if ((offset < planned_end) and (offset < total_recs)):  # page fell short: replan
+          for (_, _, _, future) in pending:
+            future.cancel()
+          pending.clear()
+          next_offset = offset
+    finally:
+      for (_, _, _, future) in pending:  # abandon any pages no longer wanted
+        future.cancel()
+
+
+def gen_keyset_pages (modality, args, client=None, after=None, num_wanted=None, sizer=None,
+                      page_meta=None):
+  """
+  Generator which yields (offset, page of records) tuples, where the pages of
+  cleaned, flattened records are yielded in keyset order (by creation time, then id)
+  and the offset is the number of server records read through the end of the page.
+  Rather than asking for ever deeper page numbers, which the server must skip through,
+  each page is the first page of the records beyond the key of the last record of the
+  previous page, so the cost of each page stays flat, however many are fetched. As
+  each page depends on the one before, the pages are fetched one at a time.
+  Only enough records to satisfy the number of records wanted are asked for but,
+  if the caller keeps asking (e.g., because of duplicates), more are fetched.
+  Arguments:
+    modality: the modality to query on (must be one of {ALLOWED_MODALITIES}).
+    args: a dictionary of optional arguments to create/control the query.
+    client: an optional FetcherClient through which to make the requests.
+    after: an optional cursor, the (creation time, id) key of the last record already
+           fetched (e.g., when resuming) [default: start with the first record].
+    num_wanted: the number of records wanted [default: the number of records requested].
+    sizer: an optional PageSizer to choose the page sizes [default: a new PageSizer].
+    page_meta: an optional dictionary, updated with the metadata of the first page
+               (e.g., the total number of records available), by side effect.
+  """
+  if (num_wanted is None):
+    num_wanted = get_num_recs_arg(args)
+  fields = get_fields_arg(modality, dict(args, keyset=True))
+  if (sizer is None):
+    sizer = PageSizer()
+
+  cursor = after
+  offset = 0
+  while True:
+    remaining = num_wanted - offset
+    page_size = min(remaining, sizer.target_size()) if (remaining > 0) else sizer.target_size()
+    query = build_query(modality, args, page_size=page_size, after=cursor)
+    recs, page_len, meta = fetch_span(query, 1, page_size, 0, args, client, fields, sizer)
+    if ((page_meta is not None) and (offset == 0)):
+      page_meta.update(meta)
+    offset += len(recs)
+    yield (offset, recs)
+    if (page_len < min(page_size, meta.get('max_results') or page_size)):
+      break                            # a short page is the last page
+    cursor = record_key(recs[-1])
+
+
+def gen_n_record_pages (modality, args, client=None, chksums=None, first_offset=0,
+                        num_wanted=None, sizer=None, page_meta=None, after=None):
+  """
+  Generator which yields (offset, page of records) tuples, where the pages of
+  deduplicated records are yielded in server order, until the number of records
+  wanted have been yielded or no more are available, and the offset is the number
+  of server records through the end of the page. Pages left empty by
+  deduplication are not yielded.
+  Pages are fetched concurrently and the pages are fetched, deduplicated, and
+  consumed by the caller in overlapping stages (see PagePipeline), so the records
+  of up to {workers} pages, plus those queued between the stages, may be held at
+  one time but no more.
+  Arguments:
+    modality: the modality to query on (must be one of {ALLOWED_MODALITIES}).
+    args: a dictionary of optional arguments to create/control the query.
+    client: an optional FetcherClient through which to make the requests.
+    chksums: an optional SET (or ChecksumIndex) of previously seen checksums,
+             updated by side effect.
+    first_offset: the number of server records to skip (e.g., when resuming).
+    num_wanted: the number of records wanted [default: the number of records requested].
+    sizer: an optional PageSizer to choose the page sizes [default: a new PageSizer].
+    page_meta: an optional dictionary, updated with the metadata of the first page
+               (e.g., the total number of records available), by side effect.
+    after: when the arguments select keyset pagination, an optional cursor to start
+           after, in place of the first offset (e.g., when resuming).
+  """
+  if (num_wanted is None):
+    num_wanted = get_num_recs_arg(args)
+  chksums_seen = set() if (chksums is None) else chksums
+  if (args.get('keyset')):
+    pages = gen_keyset_pages(modality, args, client, after=after, num_wanted=num_wanted,
+                             sizer=sizer, page_meta=page_meta)
+  else:
+    pages = gen_record_pages(modality, args, client, first_offset=first_offset,
+                             num_wanted=num_wanted, sizer=sizer, page_meta=page_meta)
+  # fetch, deduplicate (only up to the records asked for, so no others are marked as seen),
+  # and consume (e.g., write) the pages concurrently, as stages of a pipeline:
+  yield from PagePipeline(pages, num_wanted, lambda rec: is_not_duplicate(rec, chksums_seen),
+                          stats=get_stats(client))
+
+
+def get_n_records (modality, args, client=None, sizer=None, chksums=None, page_meta=None):
   """
   Fetch N records from the server using the given parameters. Query then
   clean, flatten, deduplicate and return a list of fetched image quality
-  metrics records (dictionaries).
+  metrics records (dictionaries). Pages are fetched concurrently but the
+  records are returned in server order.
   Arguments:
     modality: the modality to query on (must be one of {ALLOWED_MODALITIES}).
     args: a dictionary of optional arguments to create/control the query.
+    client: an optional FetcherClient through which to make the requests.
+    sizer: an optional PageSizer to choose the page sizes [default: a new PageSizer].
+    chksums: an optional SET (or ChecksumIndex) of the checksums of records to skip,
+             updated by side effect.
+    page_meta: an optional dictionary, updated with the metadata of the first page
+               (e.g., the total number of records available), by side effect.
   """
   good_records = []
-  next_page_num = 1
-  chksums_seen = set()
-
-  # loop until we get the number of records requested by the user or we fail to do so:
-  num_recs = get_num_recs_arg(args)
-  while (len(good_records) < num_recs):
-    query = build_query(modality, args, page_num=next_page_num)
-    recs = query_for_page(query)
-    if (len(recs) < 1):                # if no more records available, then exit
-      break
-    recs, chksums_seen = deduplicate_records(recs, chksums_seen)
+  for (_, recs) in gen_n_record_pages(modality, args, client, chksums=chksums, sizer=sizer,
+                                      page_meta=page_meta):
     good_records.extend(recs)
-    next_page_num += 1
+  return good_records
 
-  # if got more than user asked for, prune off any extra records:
-  return good_records[:num_recs] if (len(good_records) > num_recs) else good_records
+
+def get_fields_arg (modality, args):
+  """
+  Return the sorted list of the (flattened) fields to be fetched and written for the
+  given modality: the subset of fields in the given arguments dictionary, if any,
+  plus the required fields, otherwise all of the output fields of the modality.
+  Keyset pagination also needs the fields of the record keys to be fetched.
+  """
+  fields = get_output_fields(modality, args.get('fields'))
+  if (args.get('keyset')):
+    fields = sorted(set(fields) | set(KEYSET_FIELDS))
+  return fields
+
+
+def get_flattener (fields=None):
+  """
+  Return the shared record flattener which keeps only the given (flattened) fields
+  or, if no fields are given, the shared flattener which keeps all fields.
+  """
+  if (fields is None):
+    return FLATTENER
+  key = frozenset(fields)
+  flattener = FLATTENERS.get(key)
+  if (flattener is None):
+    flattener = FLATTENERS.setdefault(key, RecordFlattener(keep=key))
+  return flattener
 
 
 def get_num_recs_arg (args):
@@ -197,47 +575,129 @@ def get_num_recs_arg (args):
   return num_recs
 
 
-def query_for_page (query, args=None):
+def get_workers_arg (args):
+  """
+  Extract and check the number of concurrent workers argument in the given arguments
+  dictionary. If the value is missing or not valid, reset it to the default value.
+  Return the extracted (or possibly the default) value.
+  """
+  workers = args.get('workers', FETCH_WORKERS)
+  if (workers is None or workers < 1):
+    workers = FETCH_WORKERS
+    args['workers'] = workers
+  return workers
+
+
+def get_response (query_str, client, time_tuple, stream=False):
+  """
+  Issue a GET request for the given query string through the given client and return
+  the response. If the client's response cache holds a stale (or refreshed) response
+  to the query, with validators, the request is made conditional on the response
+  having changed, so the server may answer '304 Not Modified' instead of resending it.
+  """
+  headers = client.cache.conditional_headers(query_str) if (client.cache is not None) else None
+  if (headers):
+    return client.get(query_str, timeout=time_tuple, stream=stream, headers=headers)
+  return client.get(query_str, timeout=time_tuple, stream=stream)
+
+
+def get_stats (client):
+  "Return the FetchStats carried by the given client, if any, otherwise None."
+  return getattr(client, 'stats', None)
+
+
+def query_for_page (query, args=None, client=None, fields=None):
   """
   Query for the first (or numbered) page of results from
   the MRIQC server, and clean and return the result records.
+  If the client carries a FetchStats, the page is measured (see fetch_page).
   Arguments:
     query: pre-built query string to use to fetch a page of results.
     args: a dictionary of arguments to create/control the query, passed to children.
+    client: an optional FetcherClient through which to make the request.
+    fields: an optional list of the (flattened) fields to keep [default: all fields].
   """
-  json_query_result = do_query(query)
-  json_recs = extract_records(json_query_result)
-  flat_recs = flatten_records(json_recs)
-  clean_records(flat_recs, args)
+  flat_recs, _ = fetch_page(query, args, client, fields)
   return flat_recs
 
 
-def save_to_tsv (modality, records, filepath):
+def read_sync_state (filepath):
+  """
+  Read the fetched TSV file at the given filepath and return a tuple of the
+  newest record creation time string found (or None if there are no records)
+  and the set of record checksums found. The file is read one row at a time.
+  """
+  newest_created = None
+  newest_time = None
+  chksums = set()
+  with open(filepath, newline='') as tsvfile:
+    for row in csv.DictReader(tsvfile, delimiter='\t'):
+      if (row.get('provenance.md5sum')):
+        chksums.add(row['provenance.md5sum'])
+      created = row.get('_created')
+      if (created):
+        created_time = parsedate_to_datetime(created)
+        if ((newest_time is None) or (created_time > newest_time)):
+          newest_created = created
+          newest_time = created_time
+  return (newest_created, chksums)
+
+
+def record_key (record):
+  """
+  Return the keyset pagination key of the given (flattened) record: a tuple of its
+  creation time string and its id. Raises ValueError if the record lacks either one.
+  """
+  key = tuple(record.get(field) for field in KEYSET_FIELDS)
+  if (None in key):
+    raise ValueError(f"Keyset pagination requires records with the fields {KEYSET_FIELDS}.")
+  return key
+
+
+def save_records (modality, records, filepath, fmt='tsv', fields=None, stats=None):
+  """
+  Save the given image metric records (list of dictionaries) to the file at the
+  given filepath, in the given output format. If a subset of the output fields
+  is given, only those (and the required) fields are saved. If a FetchStats is
+  given, the time taken and the number of records written are added to it.
+  Raises ValueError if the output format is unknown or unavailable.
+  """
+  if (records):
+    start = time.perf_counter()
+    with get_writer(modality, filepath, fmt, fields=fields) as writer:
+      writer.write_records(records)
+    if (stats is not None):
+      stats.add_written(len(records), time.perf_counter() - start)
+
+
+def save_to_tsv (modality, records, filepath, fields=None, stats=None):
   """
   Save the given image metric records (list of dictionaries) to the
-  file at the given filepath (default standard output).
+  file at the given filepath (default standard output). If a subset of
+  the output fields is given, only those (and the required) fields are saved.
+  If a FetchStats is given, the time taken and the number of records written
+  are added to it.
   """
   if (records):
-    if (modality in STRUCTURAL_MODALITIES):
-      fields = sorted(list(STRUCTURAL_KEYWORDS))
-    else:
-      fields = sorted(list(BOLD_KEYWORDS))
-    with open(filepath, 'w', newline='') as tsvfile:
-      writer = csv.DictWriter(tsvfile, fieldnames=fields, delimiter='\t', extrasaction='ignore')
-      writer.writeheader()
-      for rec in records:
-        writer.writerow(rec)
+    start = time.perf_counter()
+    with TsvWriter(modality, filepath, fields=fields) as writer:
+      writer.write_records(records)
+    if (stats is not None):
+      stats.add_written(len(records), time.perf_counter() - start)
 
 
-def server_status (modality='bold', args=None):
+def server_status (modality='bold', args=None, client=None):
   """
   Query the server with the user's current query parameters but only fetch
-  one record. This serves as a quick health check.
+  one record. This serves as a quick, explicit health check: fetches need not
+  call it, as the first page of records fetched also serves as a health check
+  and its metadata supplies the total.
   Return the total number of records available that satisfy the query with the
   given parameters OR raises a requests.RequestException if the request fails.
   Arguments:
     modality: the modality to query on (must be one of {ALLOWED_MODALITIES}).
     args: a dictionary of arguments to create/control the query, passed to children.
+    client: an optional FetcherClient through which to make the request.
   """
   if (args is None):
     ss_args = {}
@@ -246,7 +706,158 @@ def server_status (modality='bold', args=None):
   ss_args['num_recs'] = 1              # reset number of records to fetch to 1
   health_check_query = build_query(modality, ss_args)
   # the GET request will raise an error if not successful:
-  json_query_result = do_query(health_check_query)
+  json_query_result = do_query(health_check_query, client=client)
   meta = json_query_result.get('_meta')
   total_recs = meta.get('total') if meta else 0
   return total_recs
+
+
+def stream_n_records (modality, args, filepath, client=None, resume=False, sizer=None,
+                      index=None, fmt='tsv', page_meta=None):
+  """
+  Fetch N records from the server using the given parameters, writing each
+  page of deduplicated records to the file at the given filepath, in the given
+  output format, as soon as it arrives, so that memory use is bounded by a few
+  pages of records (or, for the columnar formats, one row group of records),
+  however many records are fetched. Progress is recorded, after each page,
+  in a checkpoint file next to the output file, which is removed when the
+  fetch completes. Returns the total number of records in the output file.
+  Arguments:
+    modality: the modality to query on (must be one of {ALLOWED_MODALITIES}).
+    args: a dictionary of optional arguments to create/control the query.
+    filepath: the path of the file to be written.
+    client: an optional FetcherClient through which to make the requests.
+    resume: if True, continue an interrupted fetch from its checkpoint, if any.
+            Raises ValueError if the checkpoint was made by a different query.
+    sizer: an optional PageSizer to choose the page sizes [default: a new PageSizer].
+    index: an optional ChecksumIndex of the records to skip, updated by side effect.
+    fmt: the output format [default: 'tsv']. Only TSV files can be resumed.
+    page_meta: an optional dictionary, updated with the metadata of the first page
+               (e.g., the total number of records available), by side effect.
+  """
+  query = build_query(modality, args)
+  ckpt = Checkpoint.load(checkpoint_path(filepath)) if resume else None
+  if (ckpt is None):
+    ckpt = Checkpoint(checkpoint_path(filepath), query)
+  elif (ckpt.query != query):
+    raise ValueError(f"Checkpoint '{ckpt.filepath}' was made by a different query: '{ckpt.query}'")
+  elif (os.path.exists(filepath)):     # drop any records written after the checkpoint
+    os.truncate(filepath, ckpt.file_size)
+
+  chksums = ckpt.chksums
+  if (index is not None):              # also skip the records fetched by any earlier runs
+    index.update(ckpt.chksums)
+    chksums = index
+
+  num_wanted = get_num_recs_arg(args) - ckpt.num_written
+  try:
+    with get_writer(modality, filepath, fmt, append=(ckpt.num_written > 0),
+                    fields=args.get('fields')) as writer:
+      if (num_wanted > 0):
+        for (offset, recs) in gen_n_record_pages(modality, args, client, chksums=chksums,
+                                                 first_offset=ckpt.offset,
+                                                 num_wanted=num_wanted, sizer=sizer,
+                                                 page_meta=page_meta, after=ckpt.cursor):
+          write_records(writer, recs, get_stats(client))
+          cursor = record_key(recs[-1]) if args.get('keyset') else None
+          ckpt.record_page(offset, recs, ckpt.num_written + len(recs), writer.file_size(),
+                           cursor=cursor)
+  finally:
+    ckpt.close()
+  ckpt.remove()                        # fetch is complete: checkpoint no longer needed
+  return ckpt.num_written
+
+
+def stream_query (query_str, connection_timeout=CONNECTION_TIMEOUT, read_timeout=READ_TIMEOUT,
+                  client=None):
+  """
+  Generator which queries the server with the given query string, waiting for the
+  specified or default time, then yields the text of the response in chunks, as it
+  arrives, if successful, otherwise raises a RequestException. The request is made
+  through the given client or, if none is given, through the shared default client.
+  If the client has a response cache, a cached response is read instead, when
+  available, and successful responses are stored in the cache as they stream in.
+  A stale (or refreshed) cached response is revalidated with a conditional request
+  and, if the server answers that it is unchanged (304), the cached response is read.
+  """
+  if (client is None):
+    client = get_default_client()
+
+  cache = client.cache
+  if (cache is not None):
+    cached_file = cache.open_entry(query_str)
+    if (cached_file is not None):
+      with cached_file:
+        yield from iter(lambda: cached_file.read(STREAM_CHUNK_SIZE), '')
+      return
+
+  time_tuple = (connection_timeout, read_timeout)
+  resp = get_response(query_str, client, time_tuple, stream=True)
+  if (resp.status_code == req.codes.not_modified):
+    resp.close()
+    cached_file = cache.revalidated(query_str)
+    if (cached_file is not None):
+      with cached_file:
+        yield from iter(lambda: cached_file.read(STREAM_CHUNK_SIZE), '')
+      return
+    resp = client.get(query_str, timeout=time_tuple, stream=True)  # removed meanwhile
+  with resp:
+    if (resp.status_code != req.codes.ok):
+      resp.raise_for_status()
+    if (resp.encoding is None):        # JSON text is UTF-8 unless declared otherwise
+      resp.encoding = 'utf-8'
+    chunks = resp.iter_content(chunk_size=STREAM_CHUNK_SIZE, decode_unicode=True)
+    if (cache is not None):
+      chunks = cache.tee(query_str, chunks, resp.headers)
+    yield from chunks
+
+
+def sync_records (modality, args, filepath, client=None, sizer=None, index=None,
+                  page_meta=None):
+  """
+  Bring the existing fetched TSV file at the given filepath up to date by fetching
+  only the records created no earlier than the newest record already in the file,
+  then appending those not already in the file (by checksum). All such newer records
+  are fetched, regardless of the number of records requested.
+  Returns the number of records appended to the file.
+  Arguments:
+    modality: the modality to query on (must be one of {ALLOWED_MODALITIES}).
+    args: a dictionary of optional arguments to create/control the query.
+    filepath: the path of the existing TSV file to be updated.
+    client: an optional FetcherClient through which to make the requests.
+    sizer: an optional PageSizer to choose the page sizes [default: a new PageSizer].
+    index: an optional ChecksumIndex of the records to skip, updated by side effect.
+    page_meta: an optional dictionary, updated with the metadata of the first page
+               (e.g., the total number of newer records available), by side effect.
+  """
+  newest_created, chksums = read_sync_state(filepath)
+  if (index is not None):              # also skip the records fetched by any earlier runs
+    index.update(chksums)
+    chksums = index
+
+  # query for records created since the newest record, most recent first, a page at a time:
+  sync_args = deepcopy(args)
+  sync_args['num_recs'] = SERVER_PAGE_SIZE
+  sync_args['use_oldest'] = False
+  if (newest_created):
+    query_params = list(sync_args.get('query_params') or [])
+    query_params.append(['_created', f'>="{newest_created}"'])
+    sync_args['query_params'] = query_params
+
+  with TsvWriter(modality, filepath, append=True, fields=args.get('fields')) as writer:
+    for (_, recs) in gen_n_record_pages(modality, sync_args, client, chksums=chksums,
+                                        num_wanted=sys.maxsize, sizer=sizer,
+                                        page_meta=page_meta):
+      write_records(writer, recs, get_stats(client))
+  return writer.num_written
+
+
+def write_records (writer, records, stats=None):
+  """
+  Write the given records with the given (open) writer and, if a FetchStats is
+  given, add the time taken and the number of records written to it.
+  """
+  start = time.perf_counter()
+  writer.write_records(records)
+  if (stats is not None):
+    stats.add_written(len(records), time.perf_counter() - start)
@@ -1,25 +1,53 @@
 # CLI program to query the MRIQC server and download query result records into
 # a file for further processing.
 #   Written by: Tom Hicks and Dianne Patterson.
-# Last Modified: Minor doc/naming cleanups.
+# Last Modified: Wrap the long help strings and messages.
 #
 import argparse
 import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests as req
 
 import qmtools.qm_utils as qmu
+import qmtools.qmfetcher.batch_cli as batch_cli
 import qmtools.qmfetcher.fetcher as fetch
-from qmtools import (ALLOWED_MODALITIES, BIDS_DATA_EXT, FETCHED_DIR,
-                     NUM_RECS_EXIT_CODE, QUERY_FILE_EXIT_CODE)
+import qmtools.qmfetcher.mirror_cli as mirror_cli
+import qmtools.qmfetcher.sampler as sampler
+import qmtools.qmfetcher.shards as shards
+from qmtools import (ALL_MODALITIES, ALLOWED_MODALITIES, FETCHED_DIR, NUM_RECS_EXIT_CODE,
+                     NUM_SAMPLES_EXIT_CODE, NUM_SHARDS_EXIT_CODE, OUTPUT_FIELDS_EXIT_CODE,
+                     OUTPUT_FILE_EXIT_CODE, QUERY_FILE_EXIT_CODE)
 from qmtools.file_utils import good_file_path
-from qmtools.qmfetcher import SERVER_PAGE_SIZE
+from qmtools.qmfetcher import (CACHE_MAX_BYTES, CACHE_TTL, CHKSUM_INDEX, FETCH_WORKERS,
+                               SERVER_PAGE_SIZE)
+from qmtools.qmfetcher.cache import ResponseCache
+from qmtools.qmfetcher.chksum_index import ChecksumIndex
+from qmtools.qmfetcher.client import FetcherClient
+from qmtools.qmfetcher.page_sizer import PageSizer
 from qmtools.qmfetcher.query_parser import parse_query_from_file
+from qmtools.qmfetcher.stats import FetchStats
+from qmtools.qmfetcher.throttle import AdaptiveLimiter
+from qmtools.qmfetcher.writers import (OUTPUT_FORMATS, available_formats, format_for_path,
+                                       get_modality_fields)
 
 PROG_NAME = 'qmfetcher'
 
 
+def check_unavailable (request_exception):
+  """
+  If the given request exception reports that the MRIQC server is unavailable (503),
+  then exit the entire program here with that status as the system exit code.
+  """
+  response = request_exception.response
+  if ((response is not None) and (response.status_code == 503)):
+    errMsg = f"({PROG_NAME}): ERROR: MRIQC WebAPI service currently unavailable (503)."
+    print(errMsg, file=sys.stderr)
+    sys.exit(503)
+
+
 def check_query_file (query_file):
   """
   If a query parameters file path is given, check that it is a good path.
@@ -32,6 +60,38 @@ def check_query_file (query_file):
     sys.exit(QUERY_FILE_EXIT_CODE)
 
 
+def check_fields (modality, fields):
+  """
+  Check that each of the given field names is an output field of the given modality.
+  If not, then exit the entire program here with a specific system exit code.
+  """
+  unknown = [field for field in fields if field not in get_modality_fields(modality)]
+  if (unknown):
+    err_msg = "({}): ERROR: {} Exiting...".format(PROG_NAME,
+      f"The -f flag must specify output fields of the '{modality}' modality, not: {unknown}.")
+    print(err_msg, file=sys.stderr)
+    sys.exit(OUTPUT_FIELDS_EXIT_CODE)
+
+
+def check_format (fmt, appending=False):
+  """
+  Check that the given output format is available (the columnar formats require the
+  pyarrow package) and, if records are to be appended to an existing output file,
+  that the format is TSV. If not, then exit the entire program here with a specific
+  system exit code.
+  """
+  if (fmt not in available_formats()):
+    err_msg = "({}): ERROR: {} Exiting...".format(PROG_NAME,
+      f"The '{fmt}' output format requires the pyarrow package to be installed.")
+    print(err_msg, file=sys.stderr)
+    sys.exit(OUTPUT_FILE_EXIT_CODE)
+  if (appending and (fmt != 'tsv')):
+    err_msg = "({}): ERROR: {} Exiting...".format(PROG_NAME,
+      "The --resume and --sync flags require the 'tsv' output format.")
+    print(err_msg, file=sys.stderr)
+    sys.exit(OUTPUT_FILE_EXIT_CODE)
+
+
 def check_num_recs (num_recs):
   """
   Check that the number of records requested is reasonable (i.e. >= 1).
@@ -44,6 +104,177 @@ def check_num_recs (num_recs):
     sys.exit(NUM_RECS_EXIT_CODE)
 
 
+def check_resume (output_filename):
+  """
+  Check that an output filename was given, so that the checkpoint of an interrupted
+  fetch to that file can be found. If not, then exit the entire program here with a
+  specific system exit code.
+  """
+  if (not output_filename):
+    err_msg = "({}): ERROR: {} Exiting...".format(PROG_NAME,
+      "The --resume flag requires the -o flag to name the output file of the interrupted fetch.")
+    print(err_msg, file=sys.stderr)
+    sys.exit(OUTPUT_FILE_EXIT_CODE)
+
+
+def check_sample (num_samples, args):
+  """
+  Check that the number of records to sample is 1 or more and that the records are
+  not to be streamed, resumed, synced, or fetched in windows, which sampled fetches
+  do not do. If not, then exit the entire program here with a specific system exit code.
+  """
+  if (num_samples < 1):
+    err_msg = "({}): ERROR: {} Exiting...".format(PROG_NAME,
+      "The number of records to sample must be 1 or more.")
+    print(err_msg, file=sys.stderr)
+    sys.exit(NUM_SAMPLES_EXIT_CODE)
+  if (args.get('stream') or args.get('resume') or args.get('sync') or args.get('shards')):
+    err_msg = "({}): ERROR: {} Exiting...".format(PROG_NAME,
+      "The --sample flag cannot be used with the --stream, --resume, --sync, or --shards flags.")
+    print(err_msg, file=sys.stderr)
+    sys.exit(NUM_SAMPLES_EXIT_CODE)
+
+
+def check_shards (num_shards, args):
+  """
+  Check that the given number of time-sharded windows is 1 or more and that the
+  records are not to be streamed, resumed or synced, which sharded fetches do not do.
+  If not, then exit the entire program here with a specific system exit code.
+  """
+  if (num_shards < 1):
+    err_msg = "({}): ERROR: {} Exiting...".format(PROG_NAME,
+      "The number of windows to fetch in parallel must be 1 or more.")
+    print(err_msg, file=sys.stderr)
+    sys.exit(NUM_SHARDS_EXIT_CODE)
+  if (args.get('stream') or args.get('resume') or args.get('sync')):
+    err_msg = "({}): ERROR: {} Exiting...".format(PROG_NAME,
+      "The --shards flag cannot be used with the --stream, --resume, or --sync flags.")
+    print(err_msg, file=sys.stderr)
+    sys.exit(NUM_SHARDS_EXIT_CODE)
+
+
+def check_sync (output_filename, output_filepath):
+  """
+  Check that an output filename was given and names an existing, writeable fetched
+  file to be brought up to date. If not, then exit the entire program here with a
+  specific system exit code.
+  """
+  if ((not output_filename) or (not good_file_path(output_filepath, writeable=True))):
+    err_msg = "({}): ERROR: {} Exiting...".format(PROG_NAME,
+      "The --sync flag requires the -o flag to name an existing, writeable fetched file.")
+    print(err_msg, file=sys.stderr)
+    sys.exit(OUTPUT_FILE_EXIT_CODE)
+
+
+def fetch_modality (modality, args, client, index=None):
+  """
+  Fetch the records of the given modality from the MRIQC server, using the given client,
+  and save them into the output file named by the given arguments. If a checksum index
+  is given, skip the records it holds and add the checksums of the records fetched.
+  Return a dictionary summarizing the fetch.
+  """
+  start_time = time.perf_counter()
+  output_filepath = args.get('output_filepath')
+  sizer = PageSizer()                  # size pages to what the server honors and returns
+  page_meta = {}
+  if (args.get('sync')):               # append only newer records to the existing file
+    num_fetched = fetch.sync_records(modality, args, output_filepath, client=client,
+                                     sizer=sizer, index=index, page_meta=page_meta)
+  elif (args.get('stream')):           # write each page of records as it arrives
+    num_fetched = fetch.stream_n_records(modality, args, output_filepath, client=client,
+                                         resume=args.get('resume'), sizer=sizer,
+                                         index=index, fmt=args.get('format'),
+                                         page_meta=page_meta)
+  elif (args.get('sample')):           # fetch a random sample of all the matching records
+    recs = sampler.get_sampled_records(modality, args, args.get('sample'), client=client,
+                                       seed=args.get('seed'), chksums=index,
+                                       page_meta=page_meta)
+    num_fetched = len(recs)
+    fetch.save_records(modality, recs, output_filepath, fmt=args.get('format'),
+                       fields=args.get('fields'), stats=client.stats)
+  elif (args.get('shards')):           # fetch windows of creation times in parallel
+    recs = shards.get_sharded_records(modality, args, args.get('shards'), client=client,
+                                      sizer=sizer, chksums=index, page_meta=page_meta)
+    num_fetched = len(recs)
+    fetch.save_records(modality, recs, output_filepath, fmt=args.get('format'),
+                       fields=args.get('fields'), stats=client.stats)
+  else:
+    recs = fetch.get_n_records(modality, args, client=client, sizer=sizer, chksums=index,
+                               page_meta=page_meta)
+    num_fetched = len(recs)
+    fetch.save_records(modality, recs, output_filepath, fmt=args.get('format'),
+                       fields=args.get('fields'), stats=client.stats)
+  return {
+    'modality': modality,
+    'num_fetched': num_fetched,
+    'total': page_meta.get('total'),
+    'elapsed': time.perf_counter() - start_time,
+    'filepath': output_filepath,
+    'sizer': sizer
+  }
+
+
+def get_modalities (modality_args):
+  """
+  Return a list of the distinct modalities named by the given modality arguments,
+  in the order given, where 'all' names all of the allowed modalities.
+  """
+  modalities = []
+  for modality in modality_args:
+    for mod in (ALLOWED_MODALITIES if (modality == ALL_MODALITIES) else [modality]):
+      if (mod not in modalities):
+        modalities.append(qmu.validate_modality(mod))
+  return modalities
+
+
+def get_output_filepath (modality, output_filename, output_ext, multiple=False):
+  """
+  Return the path, in the fetched directory, of the output file for the given modality.
+  If no output filename is given, one is generated. If several modalities are being
+  fetched, the modality is appended to the given output filename.
+  """
+  if (not output_filename):            # if none provided, generate an output filename
+    output_filename = qmu.gen_output_name(modality, output_ext)
+  elif (multiple):
+    if (output_filename.endswith(output_ext)):
+      output_filename = output_filename[:-len(output_ext)]
+    output_filename = f"{output_filename}_{modality}{output_ext}"
+
+  # ensure output file path has the correct extension
+  output_filepath = os.path.join(FETCHED_DIR, output_filename)
+  if (not output_filepath.endswith(output_ext)):
+    output_filepath = output_filepath + output_ext
+  return output_filepath
+
+
+def modality_names (modalities):
+  "Return a phrase naming the given modalities, for messages."
+  if (len(modalities) == 1):
+    return f"modality '{modalities[0]}'"
+  return "modalities {}".format(', '.join(f"'{mod}'" for mod in modalities))
+
+
+def print_summary (results, elapsed, multiple=False):
+  """
+  Print a summary of the given results of fetching one or more modalities, with the
+  number of records fetched, of the total matching records, and the time taken.
+  """
+  for result in results:
+    num_fetched = result.get('num_fetched')
+    total_recs = result.get('total')
+    out_of = f" out of {total_recs}" if (total_recs is not None) else ''
+    if (multiple):
+      print("({}): Fetched {} {} records{}, in {:.2f} seconds, into '{}'.".format(
+        PROG_NAME, num_fetched, result.get('modality'), out_of, result.get('elapsed'),
+        result.get('filepath')))
+    else:
+      print(f"({PROG_NAME}): Fetched {num_fetched} records{out_of}.")
+  if (multiple):
+    num_fetched = sum(result.get('num_fetched') for result in results)
+    print(f"({PROG_NAME}): Fetched {num_fetched} records of {len(results)} modalities, "
+          f"in {elapsed:.2f} seconds.")
+
+
 def main (argv=None):
   """
   The main method for the QMView. This method is called from the command line,
@@ -51,17 +282,50 @@ def main (argv=None):
   its work.
   This main method takes no arguments so it can be called by setuptools but
   the program takes arguments from the command line:
-    1) required modality of the IQM records to fetch (one of 'bold', 'T1w', or 'T2w')
+    1) required modalities of the IQM records to fetch (one or more of 'bold', 'T1w', or 'T2w',
+       or 'all'), each fetched concurrently into its own output file
     2) optional number of records to fetch [default: {SERVER_PAGE_SIZE}]
-    3) optional output filename [default: NONE (one will be generated)]
+    3) optional output filename, suffixed with the modality when fetching several modalities
+       [default: NONE (one will be generated)]
     4) optional path to query parameters file [default: NONE]
     5) optional flag to use the oldest records [default: False (use latest records)]
     6) optional flag to produce query URL only and then exit.
+    7) optional maximum number of pages to fetch concurrently [default: {FETCH_WORKERS}]
+    8) optional flag to write records to the output file as they arrive [default: False]
+    9) optional flags to bypass or to refresh the on-disk response cache [default: False]
+   10) optional time-to-live and size cap for the on-disk response cache
+   11) optional flag to resume an interrupted (streaming) fetch [default: False]
+   12) optional flag to append only newer records to an existing fetched file [default: False]
+   13) optional comma-separated list of the output fields to fetch and save [default: all]
+   14) optional path to a checksum index of the records to skip (and to add to) [default: none]
+   15) optional output format: one of 'tsv', 'tsv.gz', 'parquet', or 'feather'
+       [default: the format of the output filename extension, otherwise 'tsv']
+   16) optional flag to only check that the server is up, report the number of matching
+       records, and exit [default: False]
+   17) optional flag to page through the records by their keys (creation time and id),
+       rather than by page number, so deep pages cost no more [default: False]
+   18) optional number of windows of record creation times to fetch in parallel, each
+       holding about the same number of records [default: NONE (no windows)]
+   19) optional path of a JSON file to which to write the measures of the fetch: per page
+       latency, bytes, and records/sec, the duplicate ratio, and per stage totals [default: NONE]
+   20) optional number of records to sample, uniformly at random, from all the matching
+       records, in place of the newest (or oldest) records [default: NONE (no sampling)]
+   21) optional seed for the random sample, which is always reported so that the sample
+       can be reproduced [default: a new, random seed]
+  If the first argument is 'mirror', the remaining arguments are processed by the
+  mirror command instead (see mirror_cli). Likewise, if the first argument is 'batch',
+  they are processed by the batch command (see batch_cli).
   """
   # the main method takes no arguments so it can be called by setuptools
   if (argv is None):                   # if called by setuptools
     argv = sys.argv[1:]                # then fetch the arguments from the system
 
+  if (argv and (argv[0] == 'mirror')): # the mirror command has its own arguments
+    return mirror_cli.main(argv[1:])
+
+  if (argv and (argv[0] == 'batch')):  # the batch command has its own arguments
+    return batch_cli.main(argv[1:])
+
   # setup command line argument parsing and add shared arguments
   parser = argparse.ArgumentParser(
     prog=PROG_NAME,
@@ -76,8 +340,9 @@ def main (argv=None):
   )
 
   parser.add_argument(
-    'modality', choices=ALLOWED_MODALITIES,
-    help=f"Modality of the MRIQC IQM records to fetch. Must be one of: {ALLOWED_MODALITIES}"
+    'modality', nargs='+', choices=ALLOWED_MODALITIES + [ALL_MODALITIES],
+    help=(f"Modalities of the MRIQC IQM records to fetch. Each must be one of: "
+          f"{ALLOWED_MODALITIES}, or '{ALL_MODALITIES}'")
   )
 
   parser.add_argument(
@@ -98,12 +363,126 @@ def main (argv=None):
     help="Path to a query parameters file in or below the run directory [no default]"
   )
 
+  parser.add_argument(
+    '-f', '--fields', dest='fields', metavar='field,...',
+    default=argparse.SUPPRESS,
+    help=('Comma-separated list of the output fields to fetch and save '
+          '[default: all output fields of the modality].')
+  )
+
+  parser.add_argument(
+    '--format', dest='format', choices=list(OUTPUT_FORMATS),
+    default=argparse.SUPPRESS,
+    help=("Format of the output file (the columnar formats require pyarrow) "
+          "[default: the format of the output filename extension, otherwise 'tsv'].")
+  )
+
   parser.add_argument(
     '--use-oldest', dest='use_oldest', action='store_true',
     default=False,
     help='Fetch oldest records [default: False (fetches most recent records)].'
   )
 
+  parser.add_argument(
+    '-w', '--workers', dest='workers', type=int,
+    default=FETCH_WORKERS,
+    help=f"Maximum number of pages of records to fetch concurrently [default: {FETCH_WORKERS}]"
+  )
+
+  parser.add_argument(
+    '--no-cache', dest='no_cache', action='store_true',
+    default=False,
+    help='Do not read or write the on-disk cache of query responses [default: False].'
+  )
+
+  parser.add_argument(
+    '--refresh', dest='refresh', action='store_true',
+    default=False,
+    help=('Revalidate all cached query responses with the server, re-fetching only '
+          'those which have changed [default: False].')
+  )
+
+  parser.add_argument(
+    '--cache-ttl', dest='cache_ttl', type=int, metavar='seconds',
+    default=CACHE_TTL,
+    help=f"Time-to-live of cached query responses, in seconds [default: {CACHE_TTL}]"
+  )
+
+  parser.add_argument(
+    '--cache-size', dest='cache_size', type=int, metavar='megabytes',
+    default=CACHE_MAX_BYTES // (1024 * 1024),
+    help=f"Size cap of the response cache, in megabytes [default: {CACHE_MAX_BYTES // (1024 * 1024)}]"
+  )
+
+  parser.add_argument(
+    '--keyset', dest='keyset', action='store_true',
+    default=False,
+    help=('Page through the records after the key (creation time and id) of the last '
+          'record fetched, rather than by page number [default: False].')
+  )
+
+  parser.add_argument(
+    '--sample', dest='sample', metavar='N', type=int,
+    default=argparse.SUPPRESS,
+    help=('Fetch N distinct records sampled uniformly at random from all the records '
+          'matching the query, fetching only the pages which hold them [default: no sampling].')
+  )
+
+  parser.add_argument(
+    '--seed', dest='seed', type=int,
+    default=argparse.SUPPRESS,
+    help=('Seed for the random sample, to reproduce an earlier sample '
+          '[default: a new, random seed, which is reported].')
+  )
+
+  parser.add_argument(
+    '--shards', dest='shards', metavar='N', type=int,
+    default=argparse.SUPPRESS,
+    help=('Split the records wanted into N windows of creation times, each holding about '
+          'the same number of records, and fetch the windows in parallel [default: no windows].')
+  )
+
+  parser.add_argument(
+    '--stats-json', dest='stats_json', metavar='filepath',
+    default=argparse.SUPPRESS,
+    help=('Write the measures of the fetch (per page latency, bytes, and records/sec, the '
+          'duplicate ratio, and per stage totals) to the given JSON file [default: none].')
+  )
+
+  parser.add_argument(
+    '--stream', dest='stream', action='store_true',
+    default=False,
+    help='Write each page of records to the output file as it arrives [default: False].'
+  )
+
+  parser.add_argument(
+    '--resume', dest='resume', action='store_true',
+    default=False,
+    help=('Resume an interrupted fetch to the named output file from its checkpoint '
+          '(implies --stream) [default: False].')
+  )
+
+  parser.add_argument(
+    '--sync', dest='sync', action='store_true',
+    default=False,
+    help=('Append all records newer than those in the named output file to that file '
+          '[default: False].')
+  )
+
+  parser.add_argument(
+    '--index', dest='index', metavar='filepath', nargs='?',
+    const=CHKSUM_INDEX, default=argparse.SUPPRESS,
+    help=(f"Skip records whose checksums are in the given checksum index file, then add the "
+          f"checksums of the records fetched to it [default path: {CHKSUM_INDEX}].")
+  )
+
+  parser.add_argument(
+    '--check', dest='check_only', action='store_true',
+    default=False,
+    help=('Check that the MRIQC server is up, report the number of records matching the '
+          'query, and exit program [default: False].')
+  )
+
   parser.add_argument(
     '--url-only', dest='url_only', action='store_true',
     default=False,
@@ -113,8 +492,9 @@ def main (argv=None):
   # actually parse the arguments from the command line
   args = vars(parser.parse_args(argv))
 
-  # check modality for validity: assumes arg parse provides valid value
-  modality = qmu.validate_modality(args.get('modality'))
+  # check modalities for validity: assumes arg parse provides valid values
+  modalities = get_modalities(args.get('modality'))
+  multiple = (len(modalities) > 1)
 
   # check if the fetched directory exists and is writeable or try to create it
   qmu.ensure_fetched_dir(PROG_NAME)
@@ -123,58 +503,154 @@ def main (argv=None):
   num_recs = args.get('num_recs')      # total number of records to fetch
   check_num_recs(num_recs)             # if check fails exits here, does not return!
 
+  # if a subset of the output fields is specified, check the field names for validity
+  if (args.get('fields') is not None):
+    fields = [field.strip() for field in args.get('fields').split(',') if field.strip()]
+    for modality in modalities:
+      check_fields(modality, fields)   # if check fails exits here, does not return!
+    args['fields'] = fields
+
   # use output file name given or generate one
   output_filename = args.get('output_filename')
-  if (not output_filename):            # if none provided, generate an output filename
-    output_filename = qmu.gen_output_name(modality, BIDS_DATA_EXT)
-    args['output_filename'] = output_filename
-
-  # ensure output file path has the correct extension
-  output_filepath = os.path.join(FETCHED_DIR, output_filename)
-  if (not output_filepath.endswith(BIDS_DATA_EXT)):
-    output_filepath = output_filepath + BIDS_DATA_EXT
-  args['output_filepath'] = output_filepath
+  if (args.get('resume')):             # resuming requires the name of the output file
+    check_resume(output_filename)      # if check fails exits here, does not return!
+    args['stream'] = True              # and only streamed fetches are checkpointed
+
+  # if fetching windows of creation times in parallel, check the number of windows
+  if (args.get('shards') is not None):
+    check_shards(args.get('shards'), args)   # if check fails exits here, does not return!
+
+  # if sampling records at random, check the sample size and record the seed of the sample
+  if (args.get('sample') is not None):
+    check_sample(args.get('sample'), args)   # if check fails exits here, does not return!
+    if (args.get('seed') is None):
+      args['seed'] = sampler.new_seed()
+
+  # use the output format given or the one named by the output file extension
+  fmt = args.get('format') or format_for_path(output_filename or '')
+  check_format(fmt, appending=(args.get('resume') or args.get('sync')))  # may exit here!
+  args['format'] = fmt
+  output_ext = OUTPUT_FORMATS[fmt]
 
   # if query parameters file path given, check the file path for validity
   query_file = args.get('query_file')
   if (query_file):                     # if filepath provided, validate it
     check_query_file(query_file)       # may exit here and not return!
-    query_params = parse_query_from_file(modality, query_file, PROG_NAME)
-    args['query_params'] = query_params
-  else:
-    query_params = None
+
+  # give each modality its own arguments, output file, and query parameters
+  modality_args = {}
+  for modality in modalities:
+    margs = dict(args, modality=modality)
+    output_filepath = get_output_filepath(modality, output_filename, output_ext, multiple)
+    margs['output_filename'] = os.path.basename(output_filepath)
+    margs['output_filepath'] = output_filepath
+    if (args.get('sync')):             # syncing requires an existing output file
+      check_sync(output_filename, output_filepath)  # if check fails exits here, does not return!
+    if (query_file):
+      margs['query_params'] = parse_query_from_file(modality, query_file, PROG_NAME)
+    else:
+      margs['query_params'] = None
+    modality_args[modality] = margs
 
   if (args.get('url_only')):           # if generating URL only
-    print(fetch.build_query(modality, args))
+    for modality in modalities:
+      print(fetch.build_query(modality, modality_args[modality]))
     sys.exit(0)                        # all done: exit out now
 
   if (args.get('verbose')):
-    print(f"({PROG_NAME}): Querying MRIQC server with modality '{modality}', for {num_recs} records.",
-      file=sys.stderr)
+    if (args.get('sample') is not None):
+      print(f"({PROG_NAME}): Sampling MRIQC server with {modality_names(modalities)}, "
+            f"for {args.get('sample')} records.", file=sys.stderr)
+    else:
+      print(f"({PROG_NAME}): Querying MRIQC server with {modality_names(modalities)}, "
+            f"for {num_recs} records.", file=sys.stderr)
+
+  # unless disabled, serve repeated queries from the on-disk response cache
+  # but, when syncing, always fetch the newest records from the server:
+  if (args.get('no_cache')):
+    cache = None
+  else:
+    cache = ResponseCache(ttl=args.get('cache_ttl'),
+                          max_bytes=args.get('cache_size') * 1024 * 1024,
+                          refresh=(args.get('refresh') or args.get('sync')))
+
+  # share one pooled, keep-alive connection session among all requests to the server,
+  # raising the number of requests in flight, up to the number of workers per modality,
+  # while the server stays healthy and backing off (and retrying) when it is overloaded:
+  workers = fetch.get_workers_arg(args) * len(modalities)
+  limiter = AdaptiveLimiter(max_limit=workers)
+  stats = FetchStats() if args.get('stats_json') else None
+  client = FetcherClient(pool_size=workers, cache=cache, limiter=limiter, stats=stats)
+
+  # if given, skip the records in the checksum index shared with earlier (or concurrent) runs
+  index = ChecksumIndex(args.get('index')) if args.get('index') else None
+
+  # if only checking the server, use user's query to test whether it is up, exit out if not:
+  if (args.get('check_only')):
+    try:
+      for modality in modalities:
+        total_recs = fetch.server_status(modality=modality, args=modality_args[modality],
+                                         client=client)
+        label = f" {modality}" if multiple else ''
+        print(f"({PROG_NAME}): MRIQC server is up: {total_recs}{label} records match the query.")
+    except req.RequestException as re:
+      check_unavailable(re)            # if server unavailable exits here, does not return!
+      raise
+    finally:
+      client.close()
+    sys.exit(0)                        # all done: exit out now
 
-  # Use user's query to test whether the MRIQC server is up, exit out if not:
+  # fetch the records of each modality concurrently, sharing the client session, and
+  # save them into a file per modality: the first page fetched for each modality serves
+  # as its health check and its metadata supplies the total number of records
+  start_time = time.perf_counter()
   try:
-    total_recs = fetch.server_status(modality=modality, args=args)
+    with ThreadPoolExecutor(max_workers=len(modalities)) as executor:
+      futures = [ executor.submit(fetch_modality, modality, modality_args[modality],
+                                  client, index) for modality in modalities ]
+      results = [ future.result() for future in futures ]
   except req.RequestException as re:
-    status = re.response.status_code
-    if (status == 503):
-      errMsg = f"({PROG_NAME}): ERROR: MRIQC WebAPI service currently unavailable ({status})."
-      print(errMsg, file=sys.stderr)
-      sys.exit(status)
-
-  # build the query and fetch some records from the MRIQC server:
-  recs = fetch.get_n_records(modality, args)
+    check_unavailable(re)              # if server unavailable exits here, does not return!
+    raise
+  except ValueError as ve:
+    print(f"({PROG_NAME}): ERROR: {ve} Exiting...", file=sys.stderr)
+    sys.exit(OUTPUT_FILE_EXIT_CODE)
+  finally:
+    client.close()
+  elapsed = time.perf_counter() - start_time
+
+  if (multiple or args.get('verbose')):
+    print_summary(results, elapsed, multiple)
+
+  if (args.get('sample') is not None): # record the seed, so that the sample can be reproduced
+    print(f"({PROG_NAME}): Sampled records at random with seed {args.get('seed')}.",
+          file=sys.stderr)
 
   if (args.get('verbose')):
-    print(f"({PROG_NAME}): Fetched {len(recs)} records out of {total_recs}.")
-
-  # save the fetched records into a TSV file:
-  fetch.save_to_tsv(modality, recs, output_filepath)
-
-  if (args.get('verbose')):
-    if (output_filename is not None):
-      print(f"({PROG_NAME}): Saved query results to '{output_filepath}'.", file=sys.stderr)
-
+    print(f"({PROG_NAME}): Adaptive request {limiter.summary()}.", file=sys.stderr)
+    if ((cache is not None) and cache.num_revalidated):
+      print(f"({PROG_NAME}): Revalidated {cache.num_revalidated} unchanged cached responses.",
+            file=sys.stderr)
+    for result in results:
+      label = f" ({result['modality']})" if multiple else ''
+      print(f"({PROG_NAME}): Adaptive {result['sizer'].summary()}{label}.", file=sys.stderr)
+      print(f"({PROG_NAME}): Saved query results to '{result['filepath']}'.", file=sys.stderr)
+
+  # if asked, write the measures of the fetch, for tuning:
+  if (stats is not None):
+    stats.write_json(args.get('stats_json'))
+    if (args.get('verbose')):
+      print(f"({PROG_NAME}): Fetch statistics: {stats.summary()}.", file=sys.stderr)
+      print(f"({PROG_NAME}): Saved fetch statistics to '{args.get('stats_json')}'.",
+            file=sys.stderr)
+
+  # once the records are saved, add their checksums to the checksum index:
+  if (index is not None):
+    index.save()
+    if (args.get('verbose')):
+      print(f"({PROG_NAME}): Checksum index '{index.filepath}' holds {len(index)} records.",
+            file=sys.stderr)
+    index.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,105 @@
+#
+# Class to flatten nested MRIQC records, reusing the flattened keys learned from earlier records.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Drop unwanted fields while flattening.
+#
+import sys
+
+# marks keys (and nested dictionaries) not yet seen at a level of the key-path layout
+UNSEEN = object()
+
+
+class KeyNode(object):
+  """
+  One level of the learned key-path layout: caches the (interned) flattened key
+  for each key seen at this level and the child node for each nested dictionary.
+  If a set of wanted (flattened) keys is given, unwanted keys are cached as None
+  and nested dictionaries holding no wanted keys are cached as None, so that they
+  can be skipped without being walked.
+  """
+  __slots__ = ('prefix', 'sep', 'keep', 'keys', 'children')
+
+  def __init__ (self, prefix='', sep='.', keep=None):
+    self.prefix = prefix
+    self.sep = sep
+    self.keep = keep
+    self.keys = {}
+    self.children = {}
+
+
+  def child (self, key):
+    """
+    Return the node for the nested dictionary under the given key, learning it if new,
+    or None if none of the keys of the nested dictionary are wanted.
+    """
+    node = self.children.get(key, UNSEEN)
+    if (node is UNSEEN):
+      path = f"{self.prefix}{key}"
+      path_prefix = f"{path}{self.sep}"
+      if ((self.keep is None) or (path in self.keep)):   # keep the whole dictionary
+        node = KeyNode(path_prefix, self.sep)
+      elif (any(wanted.startswith(path_prefix) for wanted in self.keep)):
+        node = KeyNode(path_prefix, self.sep, self.keep)
+      else:
+        node = None
+      self.children[key] = node
+    return node
+
+
+  def flat_key (self, key):
+    """
+    Return the flattened key for the given key at this level, learning it if new,
+    or None if the key is not wanted.
+    """
+    flat_key = self.keys.get(key, UNSEEN)
+    if (flat_key is UNSEEN):
+      flat_key = f"{self.prefix}{key}"
+      if ((self.keep is None) or (flat_key in self.keep)):
+        flat_key = sys.intern(flat_key)
+      else:
+        flat_key = None
+      self.keys[key] = flat_key
+    return flat_key
+
+
+class RecordFlattener(object):
+  """
+  Flattens nested records (dictionaries) into single-level dictionaries whose keys
+  are the key "paths" of the nested values, exactly as flatten_a_record does, but
+  iteratively and without building a new key string for every value of every record:
+  since records share (almost) the same layout, the flattened keys are learned from
+  the first records and reused, as shared interned strings, for all the others.
+  If a collection of wanted (flattened) keys is given, all other fields are dropped
+  as the records are flattened.
+  """
+
+  def __init__ (self, sep='.', keep=None):
+    self.root = KeyNode('', sep, (frozenset(keep) if (keep is not None) else None))
+
+
+  def flatten (self, rec):
+    "Return a flattened copy of the given (possibly nested) record."
+    flat = {}
+    stack = [(iter(rec.items()), self.root)]
+    while stack:
+      items, node = stack[-1]
+      for key, val in items:
+        if (isinstance(val, dict)):
+          child = node.child(key)
+          if (child is not None):      # descend, then resume this level afterwards
+            stack.append((iter(val.items()), child))
+            break
+        else:
+          flat_key = node.keys.get(key, UNSEEN)
+          if (flat_key is UNSEEN):
+            flat_key = node.flat_key(key)
+          if (flat_key is not None):
+            flat[flat_key] = val
+      else:                            # this level is finished
+        stack.pop()
+    return flat
+
+
+  def flatten_records (self, json_recs):
+    "Given a list of records (dictionaries), return a list of flattened dictionaries."
+    return [self.flatten(rec) for rec in json_recs]
@@ -0,0 +1,115 @@
+#
+# Class to incrementally parse a page of query results as its text arrives from the server.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Initial creation.
+#
+import json
+
+WHITESPACE = ' \t\n\r'
+
+
+class PageStream(object):
+  """
+  Incrementally parses the JSON text of a page of query results, given as an
+  iterable of text chunks, yielding each record of the '_items' array as soon
+  as it has been decoded. The other top-level fields of the page (e.g., '_meta')
+  are collected into the 'fields' dictionary, which is complete once all the
+  records have been yielded. Only the current record, and the text chunk(s)
+  which hold it, are kept in memory. Raises ValueError for malformed text.
+  """
+
+  def __init__ (self, chunks, items_key='_items'):
+    self.fields = {}
+    self.items_key = items_key
+    self._chunks = iter(chunks)
+    self._buf = ''
+    self._pos = 0
+    self._eof = False
+    self._decoder = json.JSONDecoder()
+
+
+  def __iter__ (self):
+    return self._parse()
+
+
+  def _decode_value (self):
+    "Decode and return the next complete JSON value, reading more text as needed."
+    self._peek()
+    while True:
+      try:
+        value, end = self._decoder.raw_decode(self._buf, self._pos)
+        if ((end < len(self._buf)) or self._eof):   # a number may continue in the next chunk
+          self._pos = end
+          return value
+      except json.JSONDecodeError:
+        if (self._eof):
+          raise
+      self._more()
+
+
+  def _expect (self, chars):
+    "Consume and return the next non-whitespace character, which must be one of the given characters."
+    ch = self._peek()
+    if (ch not in chars):
+      raise ValueError(f"Expected one of '{chars}' at offset {self._pos} of page but found '{ch}'")
+    self._pos += 1
+    return ch
+
+
+  def _finish (self):
+    "Consume the rest of the text, which must only be whitespace, so that the input is exhausted."
+    while True:
+      while ((self._pos < len(self._buf)) and (self._buf[self._pos] in WHITESPACE)):
+        self._pos += 1
+      if (self._pos < len(self._buf)):
+        raise ValueError(f"Extra text at offset {self._pos} of page")
+      if (not self._more()):
+        return
+
+
+  def _more (self):
+    "Append the next chunk of text to the buffer, discarding the text already consumed."
+    chunk = next(self._chunks, None)
+    if (chunk is None):
+      self._eof = True
+      return False
+    self._buf = self._buf[self._pos:] + chunk
+    self._pos = 0
+    return True
+
+
+  def _parse (self):
+    "Generator which parses the page object, yielding each of its items."
+    self._expect('{')
+    if (self._peek() == '}'):
+      self._pos += 1
+      self._finish()
+      return
+    while True:
+      key = self._decode_value()
+      self._expect(':')
+      if (key == self.items_key):
+        self._expect('[')
+        if (self._peek() == ']'):
+          self._pos += 1
+        else:
+          while True:
+            yield self._decode_value()
+            if (self._expect(',]') == ']'):
+              break
+      else:
+        self.fields[key] = self._decode_value()
+      if (self._expect(',}') == '}'):
+        break
+    self._finish()
+
+
+  def _peek (self):
+    "Skip whitespace and return the next character, without consuming it."
+    while True:
+      while ((self._pos < len(self._buf)) and (self._buf[self._pos] in WHITESPACE)):
+        self._pos += 1
+      if (self._pos < len(self._buf)):
+        return self._buf[self._pos]
+      if (not self._more()):
+        raise ValueError('Unexpected end of page text')
@@ -0,0 +1,178 @@
+#
+# Class to keep a local SQLite mirror of fetched MRIQC records and to query it offline.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Initial creation.
+#
+import sqlite3
+from email.utils import parsedate_to_datetime
+
+from qmtools.qmfetcher import MIRROR_DB
+from qmtools.qmfetcher.writers import get_modality_fields
+from qmtools.qm_utils import validate_modality
+
+# name of the extra column which holds the record creation time as a (sortable) timestamp
+CREATED_TS = '_created_ts'
+
+# columns which are indexed, in addition to the (unique) checksum column
+INDEXED_FIELDS = [
+  CREATED_TS,
+  'bids_meta.EchoTime',
+  'bids_meta.MagneticFieldStrength',
+  'bids_meta.Manufacturer',
+  'bids_meta.ManufacturersModelName',
+  'bids_meta.MultibandAccelerationFactor',
+  'bids_meta.RepetitionTime',
+  'bids_meta.TaskName'
+]
+
+# map from the comparison operators of query parameter files to SQL operators
+SQL_OPERATORS = { '==': '=', '!=': '!=', '<=': '<=', '>=': '>=', '<': '<', '>': '>' }
+
+
+def created_timestamp (created):
+  "Convert the given record creation time string to a timestamp, or None if there is none."
+  return parsedate_to_datetime(created).timestamp() if created else None
+
+
+def criterion_to_sql (key, comparison):
+  """
+  Translate the given query parameter keyword and comparison string (as produced
+  by query_parser.parse_query_from_file) into a tuple of an SQL condition string,
+  with a placeholder for the value, and the value to compare with.
+  Raises ValueError if the comparison operator is not valid.
+  """
+  op = comparison[:2] if (comparison[:2] in SQL_OPERATORS) else comparison[:1]
+  if (op not in SQL_OPERATORS):
+    raise ValueError(f"The comparison operator must be one of {set(SQL_OPERATORS)}")
+  value = parse_sql_value(comparison[len(op):].strip())
+  if (key == '_created'):              # compare creation times as timestamps
+    return (f"{quote_name(CREATED_TS)} {SQL_OPERATORS[op]} ?", created_timestamp(value))
+  return (f"{quote_name(key)} {SQL_OPERATORS[op]} ?", value)
+
+
+def parse_sql_value (value):
+  """
+  Convert the given value string from a query parameter into a string (if quoted),
+  a boolean string (as written to TSV files), or a number.
+  """
+  if ((len(value) >= 2) and (value[0] == value[-1]) and (value[0] in '"\'')):
+    return value[1:-1]
+  if (value.lower() in ['true', 'false']):
+    return value.capitalize()
+  try:
+    return int(value)
+  except ValueError:
+    try:
+      return float(value)
+    except ValueError:
+      return value
+
+
+def quote_name (name):
+  "Return the given table or column name quoted as an SQL identifier."
+  return '"{}"'.format(name.replace('"', '""'))
+
+
+def to_sql_value (value):
+  "Convert the given record value to a value storable in SQLite, as it would be written to a TSV file."
+  if (isinstance(value, (bool, list, dict))):
+    return str(value)
+  return value
+
+
+class RecordMirror(object):
+  """
+  A local SQLite database holding one table of flattened records for each modality,
+  with one column for each output field of the modality. Records are unique by
+  checksum and indexed by creation time and commonly queried BIDS metadata fields.
+  """
+
+  def __init__ (self, db_path=MIRROR_DB):
+    "Open (creating if necessary) the mirror database at the given path."
+    self.db_path = db_path
+    self.conn = sqlite3.connect(db_path)
+    self._tables = set()
+
+
+  def __enter__ (self):
+    return self
+
+
+  def __exit__ (self, exc_type, exc_value, traceback):
+    self.close()
+
+
+  def add_records (self, modality, records):
+    """
+    Add the given flattened records to the table for the given modality, ignoring
+    records without a checksum or already in the mirror.
+    Returns the number of records added.
+    """
+    fields = self.ensure_table(modality)
+    columns = fields + [CREATED_TS]
+    sql = "INSERT OR IGNORE INTO {} ({}) VALUES ({})".format(
+      quote_name(modality), ', '.join(quote_name(col) for col in columns),
+      ', '.join(['?'] * len(columns)))
+    rows = [ [to_sql_value(rec.get(field)) for field in fields] +
+             [created_timestamp(rec.get('_created'))]
+             for rec in records if rec.get('provenance.md5sum') ]
+    with self.conn:
+      before = self.conn.total_changes
+      self.conn.executemany(sql, rows)
+      return self.conn.total_changes - before
+
+
+  def close (self):
+    "Close the connection to the mirror database."
+    self.conn.close()
+
+
+  def count (self, modality):
+    "Return the number of records in the mirror for the given modality."
+    self.ensure_table(modality)
+    sql = f"SELECT COUNT(*) FROM {quote_name(modality)}"
+    return self.conn.execute(sql).fetchone()[0]
+
+
+  def ensure_table (self, modality):
+    """
+    Create the table, and its indices, for the given modality, if they do not already
+    exist. Returns the list of output fields (columns) for the modality.
+    """
+    validate_modality(modality)          # validates or raises ValueError
+    fields = get_modality_fields(modality)
+    if (modality not in self._tables):
+      table = quote_name(modality)
+      columns = [ (f"{quote_name(field)} UNIQUE" if (field == 'provenance.md5sum')
+                   else quote_name(field)) for field in fields ]
+      columns.append(f"{quote_name(CREATED_TS)} REAL")
+      with self.conn:
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(columns)})")
+        for field in INDEXED_FIELDS:
+          index = quote_name(f"{modality}_{field}_idx")
+          self.conn.execute(f"CREATE INDEX IF NOT EXISTS {index} ON {table} ({quote_name(field)})")
+      self._tables.add(modality)
+    return fields
+
+
+  def query (self, modality, args):
+    """
+    Execute the query given by the query parameters, number of records, and oldest
+    records flag in the given arguments dictionary against the mirror. Returns a
+    list of flattened records (dictionaries), most recent first (or oldest first),
+    as fetched from the server.
+    """
+    fields = self.ensure_table(modality)
+    conditions = [criterion_to_sql(key, comparison)
+                  for key, comparison in (args.get('query_params') or [])]
+    sql = "SELECT {} FROM {}".format(', '.join(quote_name(field) for field in fields),
+                                     quote_name(modality))
+    if (conditions):
+      sql = f"{sql} WHERE {' AND '.join(cond for (cond, _) in conditions)}"
+    order = 'ASC' if args.get('use_oldest', False) else 'DESC'
+    sql = f"{sql} ORDER BY {quote_name(CREATED_TS)} {order}, rowid {order}"
+    if (args.get('num_recs')):
+      sql = f"{sql} LIMIT {int(args.get('num_recs'))}"
+    cursor = self.conn.execute(sql, [value for (_, value) in conditions])
+    return [ { field: value for (field, value) in zip(fields, row) if value is not None }
+             for row in cursor ]
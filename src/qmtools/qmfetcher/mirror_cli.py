@@ -0,0 +1,153 @@
+# CLI program to fetch MRIQC records into a local SQLite mirror and to run queries
+# against the mirror offline (the 'qmfetcher mirror' command).
+#   Written by: Tom Hicks and Dianne Patterson.
+# Last Modified: Initial creation.
+#
+import argparse
+import os
+import sys
+
+import requests as req
+
+import qmtools.qm_utils as qmu
+import qmtools.qmfetcher.fetcher as fetch
+from qmtools import (ALLOWED_MODALITIES, BIDS_DATA_EXT, FETCHED_DIR,
+                     NUM_RECS_EXIT_CODE, QUERY_FILE_EXIT_CODE)
+from qmtools.file_utils import good_file_path
+from qmtools.qmfetcher import FETCH_WORKERS, MIRROR_DB, SERVER_PAGE_SIZE
+from qmtools.qmfetcher.cache import ResponseCache
+from qmtools.qmfetcher.client import FetcherClient
+from qmtools.qmfetcher.mirror import RecordMirror
+from qmtools.qmfetcher.query_parser import parse_query_from_file
+
+PROG_NAME = 'qmfetcher mirror'
+
+
+def main (argv=None):
+  """
+  The main method for the mirror command. This method is called from the qmfetcher
+  main method, processes the command line arguments and calls into the fetcher
+  and mirror modules to do its work. The program takes arguments from the command line:
+    1) required modality of the IQM records (one of 'bold', 'T1w', or 'T2w')
+    2) optional number of records to fetch or to select [default: {SERVER_PAGE_SIZE}]
+    3) optional path to query parameters file [default: NONE]
+    4) optional flag to use the oldest records [default: False (use latest records)]
+    5) optional path to the mirror database [default: {MIRROR_DB}]
+    6) optional flag to query the mirror, instead of the server [default: False]
+    7) optional output filename, for offline queries [default: NONE (one will be generated)]
+    8) optional number of pages to fetch concurrently [default: {FETCH_WORKERS}]
+  """
+  if (argv is None):
+    argv = sys.argv[2:]                # skip the 'mirror' command argument
+
+  parser = argparse.ArgumentParser(
+    prog=PROG_NAME,
+    formatter_class=argparse.RawTextHelpFormatter,
+    description='Fetch MRIQC records into a local mirror database or query that mirror offline.'
+  )
+
+  parser.add_argument(
+    '-v', '--verbose', dest='verbose', action='store_true',
+    default=False,
+    help='Print informational messages during processing [default: False (non-verbose mode)].'
+  )
+
+  parser.add_argument(
+    'modality', choices=ALLOWED_MODALITIES,
+    help=f"Modality of the MRIQC IQM records. Must be one of: {ALLOWED_MODALITIES}"
+  )
+
+  parser.add_argument(
+    '-n', '--num-recs', dest='num_recs', type=int,
+    default=SERVER_PAGE_SIZE,
+    help=f"Number of records to fetch into, or select from, the mirror [default: {SERVER_PAGE_SIZE}]"
+  )
+
+  parser.add_argument(
+    '-q', '--query-file', dest='query_file', metavar='filepath',
+    default=argparse.SUPPRESS,
+    help="Path to a query parameters file in or below the run directory [no default]"
+  )
+
+  parser.add_argument(
+    '--use-oldest', dest='use_oldest', action='store_true',
+    default=False,
+    help='Fetch or select the oldest records [default: False (the most recent records)].'
+  )
+
+  parser.add_argument(
+    '--db', dest='db_path', metavar='filepath',
+    default=MIRROR_DB,
+    help=f"Path to the mirror database [default: {MIRROR_DB}]"
+  )
+
+  parser.add_argument(
+    '--offline', dest='offline', action='store_true',
+    default=False,
+    help='Run the query against the mirror, without contacting the server [default: False].'
+  )
+
+  parser.add_argument(
+    '-o', '--output-filename', dest='output_filename', metavar='filename',
+    default=argparse.SUPPRESS,
+    help='Optional name of file to hold offline query results in fetched directory [default: none].'
+  )
+
+  parser.add_argument(
+    '-w', '--workers', dest='workers', type=int,
+    default=FETCH_WORKERS,
+    help=f"Number of pages of records to fetch concurrently [default: {FETCH_WORKERS}]"
+  )
+
+  # actually parse the arguments from the command line
+  args = vars(parser.parse_args(argv))
+
+  modality = qmu.validate_modality(args.get('modality'))
+  qmu.ensure_fetched_dir(PROG_NAME)
+
+  num_recs = args.get('num_recs')
+  if (num_recs < 1):
+    err_msg = "({}): ERROR: {} Exiting...".format(PROG_NAME,
+      "The total number of records must be 1 or more.")
+    print(err_msg, file=sys.stderr)
+    sys.exit(NUM_RECS_EXIT_CODE)
+
+  query_file = args.get('query_file')
+  if (query_file):
+    if (not good_file_path(query_file)):
+      err_msg = "({}): ERROR: {} Exiting...".format(PROG_NAME,
+        "The -q flag must specify a valid, readable query parameters file.")
+      print(err_msg, file=sys.stderr)
+      sys.exit(QUERY_FILE_EXIT_CODE)
+    args['query_params'] = parse_query_from_file(modality, query_file, PROG_NAME)
+
+  with RecordMirror(args.get('db_path')) as mirror:
+    if (args.get('offline')):          # select records from the mirror into a TSV file
+      output_filename = args.get('output_filename')
+      if (not output_filename):
+        output_filename = qmu.gen_output_name(modality, BIDS_DATA_EXT)
+      output_filepath = os.path.join(FETCHED_DIR, output_filename)
+      if (not output_filepath.endswith(BIDS_DATA_EXT)):
+        output_filepath = output_filepath + BIDS_DATA_EXT
+
+      recs = mirror.query(modality, args)
+      fetch.save_to_tsv(modality, recs, output_filepath)
+      if (args.get('verbose')):
+        print(f"({PROG_NAME}): Selected {len(recs)} records out of {mirror.count(modality)}.")
+        print(f"({PROG_NAME}): Saved query results to '{output_filepath}'.", file=sys.stderr)
+
+    else:                              # fetch records from the server into the mirror
+      client = FetcherClient(pool_size=fetch.get_workers_arg(args), cache=ResponseCache())
+      num_added = 0
+      try:
+        for (_, recs) in fetch.gen_n_record_pages(modality, args, client):
+          num_added += mirror.add_records(modality, recs)
+      except req.RequestException as re:
+        err_msg = f"({PROG_NAME}): ERROR: MRIQC WebAPI request failed: {re}"
+        print(err_msg, file=sys.stderr)
+        sys.exit(re.response.status_code if (re.response is not None) else 1)
+      finally:
+        client.close()
+      if (args.get('verbose')):
+        print(f"({PROG_NAME}): Added {num_added} new records to mirror '{mirror.db_path}', " +
+              f"which holds {mirror.count(modality)} {modality} records.")
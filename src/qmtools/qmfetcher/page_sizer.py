@@ -0,0 +1,92 @@
+#
+# Class to adapt the size of the pages requested from the MRIQC server to its behavior.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Initial creation.
+#
+import threading
+
+from qmtools.qmfetcher import MAX_PAGE_SIZE, PAGE_TIME_BUDGET, PAGE_TIME_SMOOTHING, READ_TIMEOUT
+
+
+class PageSizer(object):
+  """
+  Chooses the size of each page of records to request from the server. The largest
+  page size which the server honors is learned from the page metadata (the server
+  silently caps larger requests) and the time the server takes per record is
+  measured, as a smoothed average over the pages fetched. Since a page costs a fixed
+  overhead plus a time per record, records per second grow with the page size, so
+  the best size is the largest one honored whose expected time stays within a
+  budgeted fraction of the read timeout.
+  The server addresses records by page number and page size, so a page of the
+  chosen size may begin before the next record wanted: the page size is chosen to
+  bring the most new records per request and, for the final page, to fetch as few
+  records as possible beyond those wanted.
+  """
+
+  def __init__ (self, max_size=MAX_PAGE_SIZE, read_timeout=READ_TIMEOUT,
+                time_budget=PAGE_TIME_BUDGET, smoothing=PAGE_TIME_SMOOTHING):
+    self.max_size = max(1, max_size)
+    self.honored_size = None
+    self.secs_per_rec = None
+    self.time_limit = read_timeout * time_budget
+    self.smoothing = smoothing
+    self.num_pages = 0
+    self._lock = threading.Lock()
+
+
+  def choose (self, offset, remaining=None):
+    """
+    Return a tuple of the page number, the page size, and the number of records to
+    skip at the start of that page, for a page which starts with the record at the
+    given offset (counting from zero). If the number of records remaining to be
+    fetched is given and fits in one page, the page is sized to hold them all while
+    fetching as few other records as possible.
+    """
+    target = self.target_size()
+    if ((remaining is not None) and (0 < remaining < target)):
+      for size in range(remaining, target + 1):   # smallest page which holds all remaining
+        if ((size - (offset % size)) >= remaining):
+          return ((offset // size) + 1, size, offset % size)
+    # otherwise choose the size which brings the most new records (the smallest on ties)
+    size = max(range(1, target + 1), key=lambda size: (size - (offset % size), -size))
+    return ((offset // size) + 1, size, offset % size)
+
+
+  def observe (self, requested_size, honored_size, num_recs, elapsed):
+    """
+    Record the fetch of a page of the given requested size, for which the server
+    honored the given page size, returning the given number of records in the given
+    elapsed time (in seconds).
+    """
+    with self._lock:
+      self.num_pages += 1
+      if (honored_size and (honored_size < requested_size)):  # server caps the page size
+        self.honored_size = min(honored_size, self.honored_size or honored_size)
+        self.max_size = min(self.max_size, self.honored_size)
+      if (num_recs > 0):
+        secs_per_rec = elapsed / num_recs
+        if (self.secs_per_rec is None):
+          self.secs_per_rec = secs_per_rec
+        else:
+          self.secs_per_rec += self.smoothing * (secs_per_rec - self.secs_per_rec)
+
+
+  def summary (self):
+    "Return a string describing the page sizes learned, for informational messages."
+    with self._lock:
+      per_rec = (f"{self.secs_per_rec * 1000:.1f} ms" if (self.secs_per_rec is not None)
+                 else 'unknown')
+    return (f"page size {self.target_size()} (server maximum {self.honored_size or 'unknown'}), "
+            f"{per_rec} per record over {self.num_pages} pages")
+
+
+  def target_size (self):
+    """
+    Return the largest page size honored by the server whose expected time to fetch
+    stays within the time budget.
+    """
+    with self._lock:
+      size = self.max_size
+      if (self.secs_per_rec):
+        size = min(size, max(1, int(self.time_limit / self.secs_per_rec)))
+    return size
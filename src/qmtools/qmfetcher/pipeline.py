@@ -0,0 +1,181 @@
+#
+# Class to run the stages of a fetch concurrently, connected by bounded queues.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Initial creation.
+#
+import queue
+import threading
+import time
+
+from qmtools.qmfetcher import PIPELINE_DEPTH
+
+# marks the end of the pages passed along the pipeline
+END_OF_PAGES = object()
+
+# how often (in seconds) a stage blocked on a queue checks whether the pipeline was stopped
+STOP_CHECK_INTERVAL = 0.1
+
+
+class PagePipeline(object):
+  """
+  Runs the stages of a fetch concurrently, each in its own thread, passing pages of
+  records from stage to stage through bounded queues:
+    fetch: pulls the pages of cleaned, flattened records from a page generator, whose
+           pool of workers download and decode the pages (each page is decoded and
+           flattened as its text arrives);
+    dedup: keeps only the records which are wanted (e.g., not duplicates), up to the
+           number of records wanted;
+    consume: the caller, iterating over the pipeline, writes or accumulates the pages.
+  So the network is kept busy while records are deduplicated and written, and only
+  a few pages (the depth of each queue) are held between the stages, however many
+  are fetched. Pages are yielded in the order of the page generator, as tuples of
+  (offset, page of records). The fetch stage pulls a page only while the records
+  fetched, but not yet deduplicated, may still fall short of the records wanted,
+  so no more pages are requested than when the stages run in turn. Any exception
+  raised by a stage is raised to the caller.
+  """
+
+  def __init__ (self, pages, num_wanted, is_wanted, stats=None, depth=PIPELINE_DEPTH):
+    """
+    Create a pipeline over the given generator of (offset, page of records) tuples,
+    yielding no more than the given number of records, those for which the given
+    predicate returns True. The predicate is called once for each record considered,
+    in order, from the dedup stage. If a FetchStats is given, the time taken by the
+    dedup stage and the number of duplicates found are added to it.
+    """
+    self.pages = pages
+    self.num_wanted = num_wanted
+    self.is_wanted = is_wanted
+    self.stats = stats
+    self.depth = max(1, depth)
+    self.num_kept = 0                  # records passed on by the dedup stage
+    self._num_unchecked = 0            # records fetched but not yet deduplicated
+    self._fetched = queue.Queue(maxsize=self.depth)
+    self._deduped = queue.Queue(maxsize=self.depth)
+    self._stop = threading.Event()
+    self._progress = threading.Condition()
+
+
+  def __iter__ (self):
+    threads = [ threading.Thread(target=self._fetch_stage, daemon=True),
+                threading.Thread(target=self._dedup_stage, daemon=True) ]
+    for thread in threads:
+      thread.start()
+    try:
+      while True:
+        item = self._deduped.get()
+        if (item is END_OF_PAGES):
+          return
+        if (isinstance(item, BaseException)):
+          raise item
+        yield item
+    finally:
+      self.stop()
+      for thread in threads:
+        thread.join()
+
+
+  def stop (self):
+    "Stop all the stages of the pipeline, e.g., when the caller wants no more pages."
+    self._stop.set()
+    with self._progress:
+      self._progress.notify_all()
+
+
+  def _dedup (self, recs):
+    "Return a list of the wanted records of the given page, up to the records still wanted."
+    start = time.perf_counter()
+    good_recs = []
+    num_examined = 0
+    for rec in recs:
+      if ((self.num_kept + len(good_recs)) >= self.num_wanted):
+        break
+      num_examined += 1
+      if (self.is_wanted(rec)):
+        good_recs.append(rec)
+    if (self.stats is not None):
+      self.stats.add_dedup(num_examined, num_examined - len(good_recs),
+                           time.perf_counter() - start)
+    return good_recs
+
+
+  def _dedup_stage (self):
+    "Deduplicate each page fetched and pass on the records wanted, until enough are kept."
+    try:
+      while True:
+        item = self._get(self._fetched)
+        if (item is None):             # the pipeline was stopped
+          return
+        if ((item is END_OF_PAGES) or isinstance(item, BaseException)):
+          self._put(self._deduped, item)
+          return
+
+        offset, recs = item
+        good_recs = self._dedup(recs)
+        with self._progress:
+          self._num_unchecked -= len(recs)
+          self.num_kept += len(good_recs)
+          self._progress.notify_all()
+        if (good_recs and (not self._put(self._deduped, (offset, good_recs)))):
+          return
+        if (self.num_kept >= self.num_wanted):
+          self._put(self._deduped, END_OF_PAGES)
+          return
+    except Exception as ex:            # pass the failure along, to be raised to the caller
+      self._put(self._deduped, ex)
+
+
+  def _fetch_stage (self):
+    "Pull pages from the page generator while more records may be wanted."
+    try:
+      while self._more_wanted():
+        try:
+          offset, recs = next(self.pages)
+        except StopIteration:
+          break
+        with self._progress:
+          self._num_unchecked += len(recs)
+        if (not self._put(self._fetched, (offset, recs))):
+          return
+      self._put(self._fetched, END_OF_PAGES)
+    except Exception as ex:            # pass the failure along, to be raised to the caller
+      self._put(self._fetched, ex)
+    finally:
+      self.pages.close()               # stop any page fetches still in progress
+
+
+  def _get (self, from_queue):
+    "Return the next item from the given queue, or None if the pipeline is stopped first."
+    while (not self._stop.is_set()):
+      try:
+        return from_queue.get(timeout=STOP_CHECK_INTERVAL)
+      except queue.Empty:
+        pass
+    return None
+
+
+  def _more_wanted (self):
+    """
+    Wait until the records fetched, but not yet deduplicated, may fall short of the
+    records wanted, then return True; or return False if enough records have been
+    kept or the pipeline was stopped.
+    """
+    with self._progress:
+      while (not self._stop.is_set()):
+        if (self.num_kept >= self.num_wanted):
+          return False
+        if ((self.num_kept + self._num_unchecked) < self.num_wanted):
+          return True
+        self._progress.wait(STOP_CHECK_INTERVAL)
+      return False
+
+
+  def _put (self, to_queue, item):
+    "Put the given item on the given queue and return True, or False if the pipeline is stopped first."
+    while (not self._stop.is_set()):
+      try:
+        to_queue.put(item, timeout=STOP_CHECK_INTERVAL)
+        return True
+      except queue.Full:
+        pass
+    return False
@@ -0,0 +1,105 @@
+#
+# Methods to fetch a uniform random sample of the records matching a query.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Keep only the sampled records of each page fetched.
+#
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import qmtools.qmfetcher.fetcher as fetch
+from qmtools.qmfetcher import SERVER_PAGE_SIZE
+
+
+def draw_offsets (rng, total_recs, num_draws, drawn):
+  """
+  Return a sorted list of the given number of record offsets (at most those left),
+  drawn uniformly at random, with the given random number generator, from the offsets
+  below the given total which are not in the given SET of offsets already drawn.
+  The offsets returned are added to that set, by side effect.
+  """
+  num_draws = min(num_draws, total_recs - len(drawn))
+  offsets = []
+  while (len(offsets) < num_draws):
+    offset = rng.randrange(total_recs)
+    if (offset not in drawn):
+      drawn.add(offset)
+      offsets.append(offset)
+  return sorted(offsets)
+
+
+def get_sampled_records (modality, args, num_samples, client=None, seed=None, chksums=None,
+                         page_meta=None):
+  """
+  Fetch a uniform random sample of N records from all the records matching the query,
+  rather than the newest (or oldest) N. The total number of matching records is read
+  from the metadata of the first page; then N record offsets are drawn at random from
+  the whole result set and only the pages which hold them are fetched, concurrently.
+  Duplicate records (by checksum) are dropped and replaced by further draws, so that
+  exactly N distinct records are returned, unless fewer match the query. Only the
+  sampled records of each page are kept, as it arrives, so memory grows with the
+  sample, not with the pages spanned. The records are taken in oldest first order,
+  so that records created during the sampling do not shift the offsets drawn, and
+  are returned in that order.
+  Arguments:
+    modality: the modality to query on (must be one of {ALLOWED_MODALITIES}).
+    args: a dictionary of optional arguments to create/control the query.
+    num_samples: the number of records to sample.
+    client: an optional FetcherClient through which to make the requests.
+    seed: an optional seed for the random draws, so that a sample can be reproduced.
+    chksums: an optional SET (or ChecksumIndex) of the checksums of records to skip,
+             updated by side effect.
+    page_meta: an optional dictionary, updated with the total number of records
+               available, by side effect.
+  """
+  sample_args = dict(args, use_oldest=True)
+  workers = fetch.get_workers_arg(args)
+  fields = fetch.get_fields_arg(modality, sample_args)
+  if (chksums is None):
+    chksums = set()
+
+  # fetch the first page, to learn the total and the page size honored by the server
+  first_recs, meta = fetch.fetch_page(
+    fetch.build_query(modality, sample_args, page_size=SERVER_PAGE_SIZE), sample_args, client, fields)
+  total_recs = meta.get('total', len(first_recs))
+  page_size = meta.get('max_results') or SERVER_PAGE_SIZE
+  if (page_meta is not None):
+    page_meta['total'] = total_recs
+
+  def select_records (page_num, page_offsets, page_recs=None):
+    """
+    Return a list of (offset, record) tuples for the records at the given offsets of
+    the given page, fetching the page unless its records are given, then dropping it.
+    """
+    if (page_recs is None):
+      query = fetch.build_query(modality, sample_args, page_num=page_num, page_size=page_size)
+      page_recs, _ = fetch.fetch_page(query, sample_args, client, fields)
+    first = (page_num - 1) * page_size
+    return [ (offset, page_recs[offset - first]) for offset in page_offsets
+             if ((offset - first) < len(page_recs)) ]
+
+  rng = random.Random(seed)
+  drawn = set()
+  sampled = []                         # tuples of the offset and the record sampled
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    while ((len(sampled) < num_samples) and (len(drawn) < total_recs)):
+      offsets = draw_offsets(rng, total_recs, num_samples - len(sampled), drawn)
+      by_page = {}                     # the offsets drawn, by the number of the page holding them
+      for offset in offsets:
+        by_page.setdefault(offset // page_size + 1, []).append(offset)
+      futures = []
+      for (page_num, page_offsets) in sorted(by_page.items()):
+        if ((page_num == 1) and (first_recs is not None)):   # the first page is already here
+          futures.append(pool.submit(select_records, page_num, page_offsets, first_recs))
+        else:
+          futures.append(pool.submit(select_records, page_num, page_offsets))
+      first_recs = None                # drop the first page: later draws fetch it again
+      for future in futures:           # in offset order, so duplicates are dropped in order
+        for (offset, rec) in future.result():
+          if (fetch.is_not_duplicate(rec, chksums)):
+            sampled.append((offset, rec))
+  return [rec for (_, rec) in sorted(sampled, key=lambda sample: sample[0])]
+
+
+def new_seed ():
+  "Return a new, random seed for sampling, to be recorded so that the sample can be reproduced."
+  return random.SystemRandom().randrange(2 ** 32)
@@ -0,0 +1,174 @@
+#
+# Methods to fetch records from the MRIQC server in parallel, time-sharded windows.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Initial creation.
+#
+import calendar
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from email.utils import format_datetime, parsedate_to_datetime
+
+import qmtools.qmfetcher.fetcher as fetch
+from qmtools.qmfetcher.page_sizer import PageSizer
+
+
+def add_created_bound (args, op, created_secs):
+  """
+  Return a copy of the given arguments dictionary whose query parameters also bound
+  the record creation time with the given operator and time (in epoch seconds).
+  """
+  bound_args = deepcopy(args)
+  query_params = list(bound_args.get('query_params') or [])
+  query_params.append(['_created', f'{op}"{to_created(created_secs)}"'])
+  bound_args['query_params'] = query_params
+  return bound_args
+
+
+def count_beyond (modality, args, client, created_secs):
+  """
+  Return the number of records matching the query which are at or beyond the given
+  creation time (in epoch seconds), in fetch order: those created then or earlier,
+  if using the oldest records, otherwise those created then or later.
+  """
+  op = '<=' if args.get('use_oldest') else '>='
+  return fetch.server_status(modality, add_created_bound(args, op, created_secs), client)
+
+
+def created_range (modality, args, client=None):
+  """
+  Return a tuple of the creation times (in epoch seconds) of the oldest and the newest
+  records matching the query, or None if no records match.
+  """
+  times = []
+  for use_oldest in (True, False):
+    end_args = dict(args, num_recs=1, keyset=True, use_oldest=use_oldest, fields=['_created'])
+    recs = fetch.query_for_page(fetch.build_query(modality, end_args), end_args, client,
+                                fetch.get_fields_arg(modality, end_args))
+    if (not recs):
+      return None
+    times.append(from_created(recs[0]['_created']))
+  return tuple(times)
+
+
+def find_shard_bound (modality, args, client, num_beyond, oldest, newest):
+  """
+  Return a tuple of the creation time (in epoch seconds) which bounds the given number
+  of records, in fetch order, and the number of records actually at or beyond it:
+  a time with exactly that many records at or after it (at or before it, when
+  fetching the oldest records) or, if records created at the same time make that
+  impossible, the nearest time with more. The time is found by bisecting the range
+  of creation times with count-only queries, to the second.
+  """
+  use_oldest = args.get('use_oldest')
+  # the count is at least the number wanted at 'enough' and is less at 'short':
+  enough, short = (newest, oldest - 1) if use_oldest else (oldest, newest + 1)
+  enough_count = None
+  while (abs(short - enough) > 1):
+    mid = (enough + short) // 2
+    count = count_beyond(modality, args, client, mid)
+    if (count >= num_beyond):
+      enough, enough_count = mid, count
+      if (count == num_beyond):
+        break
+    else:
+      short = mid
+  if (enough_count is None):
+    enough_count = count_beyond(modality, args, client, enough)
+  return (enough, enough_count)
+
+
+def from_created (created):
+  "Return the given record creation time string as seconds since the epoch."
+  return calendar.timegm(parsedate_to_datetime(created).utctimetuple())
+
+
+def gen_shard_args (args, bounds):
+  """
+  Generator which yields an arguments dictionary for each window between successive
+  creation times (in epoch seconds) in the given list of bounds, in fetch order, each
+  of which selects only the records of its window. The first window is open at its
+  start, so that it also takes any records created while the windows were planned.
+  """
+  use_oldest = args.get('use_oldest')
+  previous = None
+  for bound in bounds:
+    shard_args = add_created_bound(args, ('<=' if use_oldest else '>='), bound)
+    if (previous is not None):
+      shard_args = add_created_bound(shard_args, ('>' if use_oldest else '<'), previous)
+    previous = bound
+    yield shard_args
+
+
+def get_sharded_records (modality, args, num_shards, client=None, sizer=None, chksums=None,
+                         page_meta=None):
+  """
+  Fetch N records from the server using the given parameters, by splitting the range
+  of creation times which holds the records wanted into windows, each holding about
+  the same number of records, then fetching every window concurrently as a separate
+  paginated query. Count-only queries are used to place the window boundaries. The
+  records are merged in fetch order, deduplicated, and the list of (at most N)
+  records is returned. If duplicates leave too few records, the shortfall is made up
+  from the records beyond the last window.
+  Arguments:
+    modality: the modality to query on (must be one of {ALLOWED_MODALITIES}).
+    args: a dictionary of optional arguments to create/control the query.
+    num_shards: the number of windows to fetch concurrently.
+    client: an optional FetcherClient through which to make the requests.
+    sizer: an optional PageSizer, shared by all windows [default: a new PageSizer].
+    chksums: an optional SET (or ChecksumIndex) of the checksums of records to skip,
+             updated by side effect.
+    page_meta: an optional dictionary, updated with the total number of records
+               available, by side effect.
+  """
+  num_recs = fetch.get_num_recs_arg(args)
+  total_recs = fetch.server_status(modality, args, client)
+  if (page_meta is not None):
+    page_meta['total'] = total_recs
+  if (sizer is None):
+    sizer = PageSizer()
+  if (chksums is None):
+    chksums = set()
+  num_wanted = min(num_recs, total_recs)
+  time_range = created_range(modality, args, client) if (num_wanted > 0) else None
+  if (time_range is None):
+    return []
+
+  # place the window boundaries, so that each window holds about the same number of records
+  num_shards = max(1, min(num_shards, num_wanted))
+  targets = [(num_wanted * shard) // num_shards for shard in range(1, num_shards + 1)]
+  with ThreadPoolExecutor(max_workers=num_shards) as pool:
+    found = list(pool.map(lambda target: find_shard_bound(modality, args, client, target,
+                                                          *time_range), targets))
+  # in fetch order, the number of records beyond each (distinct) boundary grows
+  bound_counts = sorted(dict(found).items(), key=lambda bound_count: bound_count[1])
+  bounds = [bound for (bound, _) in bound_counts]
+  counts = [count for (_, count) in bound_counts]
+
+  # fetch the records of every window concurrently, each window a separate paginated query
+  records = []
+  with ThreadPoolExecutor(max_workers=len(bounds)) as pool:
+    futures = []
+    previous_count = 0
+    for (shard_args, count) in zip(gen_shard_args(args, bounds), counts):
+      shard_args['num_recs'] = max(1, count - previous_count)
+      previous_count = count
+      futures.append(pool.submit(fetch.get_n_records, modality, shard_args, client, sizer))
+    for future in futures:             # merge the windows in fetch order
+      for rec in future.result():
+        if ((len(records) < num_recs) and fetch.is_not_duplicate(rec, chksums)):
+          records.append(rec)
+
+  # if duplicates left too few records, make up the shortfall from beyond the last window
+  if ((len(records) < num_recs) and (counts[-1] < total_recs)):
+    beyond_args = add_created_bound(args, ('>' if args.get('use_oldest') else '<'), bounds[-1])
+    for (_, recs) in fetch.gen_n_record_pages(modality, beyond_args, client, chksums=chksums,
+                                              num_wanted=num_recs - len(records), sizer=sizer):
+      records.extend(recs)
+  return records
+
+
+def to_created (created_secs):
+  "Return the given time, in seconds since the epoch, as a record creation time string."
+  created = datetime.datetime.fromtimestamp(created_secs, tz=datetime.timezone.utc)
+  return format_datetime(created, usegmt=True)
@@ -0,0 +1,143 @@
+#
+# Classes to measure where the time of a fetch goes and to report it.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Remove the unused stage timer.
+#
+import json
+import threading
+import time
+
+# the stages of a fetch, in the order they happen to each page of records
+STAGES = ['request', 'transfer', 'decode', 'flatten', 'dedup', 'write']
+
+
+class ChunkTimer(object):
+  """
+  Wraps an iterable of the text chunks of a response, measuring the time until the
+  first chunk arrives (the latency), the time spent waiting for all the chunks, and
+  the number of bytes (of UTF-8 text) received.
+  """
+
+  def __init__ (self, chunks):
+    self._chunks = chunks
+    self.latency = None
+    self.wait_seconds = 0.0
+    self.num_bytes = 0
+
+
+  def __iter__ (self):
+    chunks = iter(self._chunks)
+    while True:
+      start = time.perf_counter()
+      try:
+        chunk = next(chunks)
+      except StopIteration:
+        self.wait_seconds += time.perf_counter() - start
+        return
+      waited = time.perf_counter() - start
+      if (self.latency is None):
+        self.latency = waited
+      self.wait_seconds += waited
+      self.num_bytes += len(chunk.encode('utf-8')) if isinstance(chunk, str) else len(chunk)
+      yield chunk
+
+
+class FetchStats(object):
+  """
+  Collects the measurements of a fetch, from any number of threads: for each page,
+  its latency, size in bytes, number of records, and the time of each stage; and,
+  for the whole fetch, the total time of each stage (see STAGES), the numbers of
+  bytes, records, and duplicates, and the records written. The collected measures
+  are reported as a dictionary, which may be written as JSON.
+  """
+
+  def __init__ (self):
+    self.start_time = time.perf_counter()
+    self.pages = []
+    self.stages = { stage: { 'seconds': 0.0, 'count': 0 } for stage in STAGES }
+    self.num_bytes = 0
+    self.num_records = 0
+    self.num_examined = 0
+    self.num_duplicates = 0
+    self.num_written = 0
+    self._lock = threading.Lock()
+
+
+  def add_dedup (self, num_examined, num_duplicates, seconds):
+    "Record the deduplication of the given number of records, which found the given duplicates."
+    with self._lock:
+      self.num_examined += num_examined
+      self.num_duplicates += num_duplicates
+      self._add_stage('dedup', seconds)
+
+
+  def add_page (self, url, num_bytes, num_recs, latency, stage_seconds):
+    """
+    Record the fetch of a page of records from the given URL: its size in bytes,
+    number of records, latency (seconds to the first byte), and a dictionary of the
+    seconds spent in each of its stages (e.g., transfer, decode, flatten).
+    """
+    seconds = (latency or 0.0) + sum(stage_seconds.values())
+    page = { 'url': url, 'bytes': num_bytes, 'records': num_recs,
+             'latency': round(latency or 0.0, 6), 'seconds': round(seconds, 6),
+             'records_per_sec': round(num_recs / seconds, 1) if (seconds > 0) else None }
+    page.update({ stage: round(secs, 6) for stage, secs in stage_seconds.items() })
+    with self._lock:
+      self.pages.append(page)
+      self.num_bytes += num_bytes
+      self.num_records += num_recs
+      self._add_stage('request', latency or 0.0)
+      for stage, secs in stage_seconds.items():
+        self._add_stage(stage, secs)
+
+
+  def add_written (self, num_written, seconds):
+    "Record the writing of the given number of records to the output file."
+    with self._lock:
+      self.num_written += num_written
+      self._add_stage('write', seconds)
+
+
+  def report (self):
+    "Return a dictionary reporting the measures of the fetch: per page, per stage, and in total."
+    with self._lock:
+      elapsed = time.perf_counter() - self.start_time
+      dup_ratio = (self.num_duplicates / self.num_examined) if self.num_examined else 0.0
+      return {
+        'elapsed': round(elapsed, 6),
+        'totals': {
+          'pages': len(self.pages),
+          'bytes': self.num_bytes,
+          'records': self.num_records,
+          'records_per_sec': round(self.num_records / elapsed, 1) if (elapsed > 0) else None,
+          'duplicates': self.num_duplicates,
+          'duplicate_ratio': round(dup_ratio, 6),
+          'written': self.num_written
+        },
+        'stages': { stage: { 'seconds': round(totals['seconds'], 6), 'count': totals['count'] }
+                    for stage, totals in self.stages.items() },
+        'pages': list(self.pages)
+      }
+
+
+  def summary (self):
+    "Return a one line summary of the time spent in each stage of the fetch."
+    with self._lock:
+      stage_times = ', '.join(f"{stage} {totals['seconds']:.2f}s"
+                              for stage, totals in self.stages.items())
+      return (f"{len(self.pages)} pages, {self.num_bytes} bytes, {self.num_records} records, "
+              f"{self.num_duplicates} duplicates; {stage_times}")
+
+
+  def write_json (self, filepath):
+    "Write the report of the measures of the fetch, as JSON, to the file at the given path."
+    with open(filepath, 'w') as jsonfile:
+      json.dump(self.report(), jsonfile, indent=2)
+      jsonfile.write('\n')
+
+
+  def _add_stage (self, stage, seconds):
+    "Add the given seconds to the total of the given stage: the caller must hold the lock."
+    totals = self.stages.setdefault(stage, { 'seconds': 0.0, 'count': 0 })
+    totals['seconds'] += seconds
+    totals['count'] += 1
@@ -0,0 +1,121 @@
+#
+# Class to adapt the number of concurrent requests to the MRIQC server to its health.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Initial creation.
+#
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from qmtools.qmfetcher import FETCH_WORKERS, MAX_RETRIES, RETRY_BACKOFF, RETRY_MAX_WAIT
+
+# requests with these HTTP status codes are retried, after backing off
+RETRY_STATUS_CODES = [429, 502, 503, 504]
+
+# a request is healthy if its latency is within this factor of the best latency seen
+LATENCY_FACTOR = 2.0
+
+
+def parse_retry_after (value):
+  """
+  Parse the given Retry-After header value, either a number of seconds or an HTTP
+  date, and return the number of seconds to wait, or None if there is no valid value.
+  """
+  if (not value):
+    return None
+  try:
+    return max(0.0, float(value))
+  except ValueError:
+    try:
+      return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+      return None
+
+
+class AdaptiveLimiter(object):
+  """
+  Limits the number of requests in flight using additive increase, multiplicative
+  decrease: the limit is raised by one after a limit's worth of healthy requests
+  (whose latency stays near the best seen) and is halved when the server reports
+  overload (429, 503, etc.) or a request times out. After an overload, no request
+  is started until the server's Retry-After time (or an exponential backoff) has passed.
+  """
+
+  def __init__ (self, max_limit=FETCH_WORKERS, initial_limit=1, max_retries=MAX_RETRIES,
+                backoff=RETRY_BACKOFF, max_wait=RETRY_MAX_WAIT):
+    self.max_limit = max(1, max_limit)
+    self.limit = min(max(1, initial_limit), self.max_limit)
+    self.peak_limit = self.limit
+    self.max_retries = max_retries
+    self.backoff = backoff
+    self.max_wait = max_wait
+    self.in_flight = 0
+    self.retries = 0
+    self._best_latency = None
+    self._consecutive_overloads = 0
+    self._healthy_count = 0
+    self._paused_until = 0.0
+    self._cond = threading.Condition()
+
+
+  def acquire (self):
+    "Wait until a request may be started within the current limit, then count it as in flight."
+    with self._cond:
+      while True:
+        wait = self._paused_until - time.monotonic()
+        if (wait > 0):                 # backing off after an overload
+          self._cond.wait(wait)
+        elif (self.in_flight >= self.limit):
+          self._cond.wait()
+        else:
+          break
+      self.in_flight += 1
+
+
+  def release (self, latency=None, overloaded=False, retry_after=None):
+    """
+    Count a request as complete, adapting the limit to its outcome: the latency
+    of a successful request, or whether the server was overloaded, in which case
+    any given Retry-After time (in seconds) is honored.
+    """
+    with self._cond:
+      self.in_flight -= 1
+      if (overloaded):
+        self._overloaded(retry_after)
+      elif (latency is not None):
+        self._succeeded(latency)
+      self._cond.notify_all()
+
+
+  def summary (self):
+    "Return a short description of the current state of the limiter."
+    return (f"concurrency {self.limit} (peak {self.peak_limit}, max {self.max_limit}), " +
+            f"{self.retries} retries")
+
+
+  def _overloaded (self, retry_after):
+    "Halve the limit, unless already backing off, and pause before any further requests."
+    now = time.monotonic()
+    self.retries += 1
+    if (now >= self._paused_until):    # only back off once for a burst of overloads
+      self.limit = max(1, self.limit // 2)
+      self._consecutive_overloads += 1
+    self._healthy_count = 0
+    if (retry_after is None):
+      retry_after = self.backoff * (2 ** (self._consecutive_overloads - 1))
+    self._paused_until = max(self._paused_until, now + min(retry_after, self.max_wait))
+
+
+  def _succeeded (self, latency):
+    "Raise the limit by one after a limit's worth of healthy requests."
+    self._consecutive_overloads = 0
+    if ((self._best_latency is None) or (latency < self._best_latency)):
+      self._best_latency = latency
+    if (latency <= LATENCY_FACTOR * self._best_latency):
+      self._healthy_count += 1
+      if ((self._healthy_count >= self.limit) and (self.limit < self.max_limit)):
+        self.limit += 1
+        self.peak_limit = max(self.peak_limit, self.limit)
+        self._healthy_count = 0
+    else:                              # latency is rising: hold the limit steady
+      self._healthy_count = 0
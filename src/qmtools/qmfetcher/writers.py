@@ -0,0 +1,279 @@
+#
+# Classes to incrementally write fetched image quality metrics records to a file.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Type the numeric BIDS metadata fields as floats in the columnar formats.
+#
+import csv
+import gzip
+import os
+
+try:                                   # the columnar output formats are optional
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+except ImportError:
+  pa = None
+
+from qmtools import (BIDS_DATA_EXT, FEATHER_DATA_EXT, GZIP_DATA_EXT, PARQUET_DATA_EXT,
+                     STRUCTURAL_MODALITIES)
+from qmtools.mriqc_keywords import BOLD_KEYWORDS, STRUCTURAL_KEYWORDS
+
+# fields always fetched and written, as they are needed to deduplicate and to sync records
+REQUIRED_FIELDS = set([ '_created', 'provenance.md5sum' ])
+
+# output formats and their file extensions: the columnar formats require pyarrow
+OUTPUT_FORMATS = { 'tsv': BIDS_DATA_EXT, 'tsv.gz': GZIP_DATA_EXT,
+                   'parquet': PARQUET_DATA_EXT, 'feather': FEATHER_DATA_EXT }
+COLUMNAR_FORMATS = [ 'parquet', 'feather' ]
+
+# number of records buffered into each row group (or record batch) of a columnar file
+ROW_GROUP_SIZE = 64 * 1024
+
+# typed columns of the columnar formats: all other output fields are numeric metrics
+BOOLEAN_FIELDS = set([ 'provenance.settings.hmc_fsl', 'provenance.settings.testing' ])
+STRING_FIELDS = set([ 'provenance.email', 'provenance.md5sum', 'provenance.software',
+                      'provenance.version' ])
+
+# the numeric BIDS metadata fields: all other BIDS metadata fields are strings
+NUMERIC_BIDS_FIELDS = set([
+  'bids_meta.AccelNumReferenceLines', 'bids_meta.AccelerationFactorPE', 'bids_meta.DelayTime',
+  'bids_meta.EchoTime', 'bids_meta.EchoTrainLength', 'bids_meta.EffectiveEchoSpacing',
+  'bids_meta.FlipAngle', 'bids_meta.ImagingFrequency', 'bids_meta.InversionTime',
+  'bids_meta.MagneticFieldStrength', 'bids_meta.MultibandAccelerationFactor',
+  'bids_meta.NumberOfAverages', 'bids_meta.NumberOfPhaseEncodingSteps',
+  'bids_meta.NumberOfVolumesDiscardedByScanner', 'bids_meta.NumberOfVolumesDiscardedByUser',
+  'bids_meta.NumberShots', 'bids_meta.ParallelReductionFactorInPlane',
+  'bids_meta.PercentPhaseFieldOfView', 'bids_meta.PercentSampling', 'bids_meta.PixelBandwidth',
+  'bids_meta.RepetitionTime', 'bids_meta.TotalReadoutTime', 'bids_meta.TotalScanTimeSec',
+  'bids_meta.run_id' ])
+
+
+def available_formats ():
+  "Return a list of the output formats available: the columnar formats require pyarrow."
+  return [fmt for fmt in OUTPUT_FORMATS if ((pa is not None) or (fmt not in COLUMNAR_FORMATS))]
+
+
+def field_type (field):
+  "Return the name of the column type of the given output field: 'bool', 'float' or 'string'."
+  if (field in BOOLEAN_FIELDS):
+    return 'bool'
+  if (field in NUMERIC_BIDS_FIELDS):
+    return 'float'
+  if (field.startswith('_') or field.startswith('bids_meta.') or (field in STRING_FIELDS)):
+    return 'string'
+  return 'float'
+
+
+def format_for_path (filepath, default='tsv'):
+  "Return the output format named by the extension of the given file path, or the default."
+  for fmt, ext in sorted(OUTPUT_FORMATS.items(), key=lambda item: -len(item[1])):
+    if (filepath.endswith(ext)):
+      return fmt
+  return default
+
+
+def get_writer (modality, filepath, fmt='tsv', append=False, fields=None):
+  """
+  Return a writer of records to the given file in the given output format. Raises
+  ValueError if the format is unknown or unavailable, or cannot be appended to.
+  """
+  if (fmt not in available_formats()):
+    raise ValueError(f"Output format '{fmt}' is not one of the available formats: {available_formats()}")
+  if (fmt in COLUMNAR_FORMATS):
+    if (append):
+      raise ValueError(f"Records cannot be appended to a file in the '{fmt}' output format.")
+    return ColumnarWriter(modality, filepath, fmt=fmt, fields=fields)
+  return TsvWriter(modality, filepath, append=append, fields=fields)
+
+
+def get_modality_fields (modality):
+  "Return a sorted list of the output field names for the given modality."
+  if (modality in STRUCTURAL_MODALITIES):
+    return sorted(list(STRUCTURAL_KEYWORDS))
+  else:
+    return sorted(list(BOLD_KEYWORDS))
+
+
+def get_output_fields (modality, fields=None):
+  """
+  Return a sorted list of the output field names for the given modality or, if a
+  subset of those fields is given, of the given fields plus the required fields.
+  """
+  if (fields):
+    return sorted(set(fields) | REQUIRED_FIELDS)
+  else:
+    return get_modality_fields(modality)
+
+
+class TsvWriter(object):
+  """
+  Writes batches of records (dictionaries) to a TSV file as they arrive, so that
+  only the current batch need be held in memory. The file and its header line are
+  not written until the first record arrives, so no file is made for zero records.
+  Only the output fields of the given modality (or the given subset of them, plus
+  the required fields) are written. If the append flag is set, records are appended
+  to an existing, non-empty file, without a header line. If the file path has the
+  gzipped TSV extension, the file is gzipped.
+  """
+
+  def __init__ (self, modality, filepath, append=False, fields=None):
+    self.fields = get_output_fields(modality, fields)
+    self.filepath = filepath
+    self.append = append
+    self.compress = filepath.endswith(GZIP_DATA_EXT)
+    self.num_written = 0
+    self._tsvfile = None
+    self._writer = None
+
+
+  def __enter__ (self):
+    return self
+
+
+  def __exit__ (self, exc_type, exc_value, traceback):
+    self.close()
+
+
+  def close (self):
+    "Flush and close the output file, if it was ever opened."
+    if (self._tsvfile is not None):
+      self._tsvfile.close()
+      self._tsvfile = None
+
+
+  def file_size (self):
+    "Return the current size of the output file, in bytes."
+    if ((self._tsvfile is not None) and (not self.compress)):
+      return self._tsvfile.tell()
+    return os.path.getsize(self.filepath) if os.path.exists(self.filepath) else 0
+
+
+  def open (self):
+    "Open the output file and write the header line, unless appending to an existing file."
+    appending = (self.append and (self.file_size() > 0))
+    mode = 'a' if appending else 'w'
+    if (self.compress):
+      self._tsvfile = gzip.open(self.filepath, f"{mode}t", newline='')
+    else:
+      self._tsvfile = open(self.filepath, mode, newline='')
+    self._writer = csv.DictWriter(self._tsvfile, fieldnames=self.fields,
+                                  delimiter='\t', extrasaction='ignore')
+    if (not appending):
+      self._writer.writeheader()
+
+
+  def write_records (self, records):
+    "Write the given list of records to the output file and flush them to disk."
+    if (records):
+      if (self._writer is None):
+        self.open()
+      self._writer.writerows(records)
+      self._tsvfile.flush()
+      self.num_written += len(records)
+
+
+
+class ColumnarWriter(object):
+  """
+  Writes batches of records (dictionaries) to a columnar Parquet or Feather file,
+  with a typed column for each output field, so that the numeric metrics are stored,
+  and loaded, as numbers. Records are buffered and written in large row groups (or
+  record batches). The file is not written until the first records are, so no file
+  is made for zero records. Only the output fields of the given modality (or the given
+  subset of them, plus the required fields) are written. Values which cannot be
+  converted to the type of their column are written as missing values.
+  Requires the optional pyarrow package.
+  """
+
+  def __init__ (self, modality, filepath, fmt='parquet', fields=None, batch_size=ROW_GROUP_SIZE):
+    if (pa is None):
+      raise ValueError(f"The '{fmt}' output format requires the pyarrow package.")
+    self.fields = get_output_fields(modality, fields)
+    self.filepath = filepath
+    self.fmt = fmt
+    self.batch_size = batch_size
+    self.num_written = 0
+    self.schema = pa.schema([ (field, ARROW_TYPES[field_type(field)]()) for field in self.fields ])
+    self._converters = [ CONVERTERS[field_type(field)] for field in self.fields ]
+    self._buffered = []
+    self._writer = None
+
+
+  def __enter__ (self):
+    return self
+
+
+  def __exit__ (self, exc_type, exc_value, traceback):
+    self.close()
+
+
+  def close (self):
+    "Write any buffered records, then finish and close the output file, if it was ever opened."
+    self.flush()
+    if (self._writer is not None):
+      self._writer.close()
+      self._writer = None
+
+
+  def file_size (self):
+    "Return the current size of the output file, in bytes."
+    return os.path.getsize(self.filepath) if os.path.exists(self.filepath) else 0
+
+
+  def flush (self):
+    "Write any buffered records to the output file, as one row group (or record batch)."
+    if (self._buffered):
+      columns = [ pa.array([convert(rec.get(field)) for rec in self._buffered], type=col_type)
+                  for (field, col_type, convert)
+                  in zip(self.fields, self.schema.types, self._converters) ]
+      table = pa.Table.from_arrays(columns, schema=self.schema)
+      if (self._writer is None):
+        self.open()
+      self._writer.write_table(table)
+      self._buffered = []
+
+
+  def open (self):
+    "Open the output file, writing the schema of the columns."
+    if (self.fmt == 'feather'):
+      self._writer = pa.ipc.new_file(self.filepath, self.schema)
+    else:
+      self._writer = pq.ParquetWriter(self.filepath, self.schema)
+
+
+  def write_records (self, records):
+    "Buffer the given list of records, writing a row group whenever enough are buffered."
+    if (records):
+      self._buffered.extend(records)
+      self.num_written += len(records)
+      if (len(self._buffered) >= self.batch_size):
+        self.flush()
+
+
+def to_bool (value):
+  "Return the given value as a boolean, or None if it is missing or not a boolean."
+  if (isinstance(value, bool) or (value is None)):
+    return value
+  if (isinstance(value, str) and (value.lower() in ('true', 'false'))):
+    return (value.lower() == 'true')
+  return None
+
+
+def to_float (value):
+  "Return the given value as a float, or None if it is missing or not numeric."
+  if (value is None):
+    return None
+  try:
+    return float(value)
+  except (TypeError, ValueError):
+    return None
+
+
+def to_string (value):
+  "Return the given value as a string, or None if it is missing."
+  return None if (value is None) else str(value)
+
+
+# how to convert values to, and the arrow types of, the typed columns of the columnar formats
+CONVERTERS = { 'bool': to_bool, 'float': to_float, 'string': to_string }
+ARROW_TYPES = ({ 'bool': pa.bool_, 'float': pa.float64, 'string': pa.string }
+               if (pa is not None) else {})
@@ -0,0 +1,158 @@
+# Benchmarks of fetching records from a local stand-in for the MRIQC WebAPI.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Check that refreshing the response cache is no slower than a cold fetch.
+#
+# These benchmarks are not run with the unit tests. Run them with: make bench
+# (or: pytest -s tests/qmtools/qmfetcher/bench_fetcher.py). The size of the stand-in
+# data set and the server's behavior can be changed with the BENCH_* environment
+# variables below, so that changes to parallelism, caching, and pagination can be
+# measured offline.
+#
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import pytest
+import requests as req
+
+import qmtools.qmfetcher.fetcher as fetch
+import qmtools.qmfetcher.shards as shards
+from qmtools.qmfetcher.cache import ResponseCache
+from qmtools.qmfetcher.client import FetcherClient
+from qmtools.qmfetcher.throttle import AdaptiveLimiter
+
+BENCH_RECORDS = int(os.environ.get('BENCH_RECORDS', 5000))        # records served
+BENCH_FETCH = int(os.environ.get('BENCH_FETCH', 2000))            # records fetched per run
+BENCH_LATENCY = float(os.environ.get('BENCH_LATENCY', 0.02))      # seconds per request
+BENCH_JITTER = float(os.environ.get('BENCH_JITTER', 0.005))       # +/- seconds per request
+BENCH_RECORD_LATENCY = float(os.environ.get('BENCH_RECORD_LATENCY', 0.0002))  # per record served
+BENCH_SKIP_LATENCY = float(os.environ.get('BENCH_SKIP_LATENCY', 0.00002))    # per record skipped
+BENCH_ERROR_RATE = float(os.environ.get('BENCH_ERROR_RATE', 0.0))  # fraction of requests failed
+
+RESULTS = []
+
+
+class RemoteStandin(object):
+  """
+  Runs a stand-in server in its own process, so that the time the server spends
+  answering queries does not compete with the fetcher for this process.
+  """
+
+  def __init__ (self):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(['src', os.environ.get('PYTHONPATH', '')]))
+    self.process = subprocess.Popen(
+      [ sys.executable, '-m', 'tests.qmtools.qmfetcher.standin_server',
+        '--records', str(BENCH_RECORDS), '--latency', str(BENCH_LATENCY),
+        '--jitter', str(BENCH_JITTER), '--record-latency', str(BENCH_RECORD_LATENCY),
+        '--skip-latency', str(BENCH_SKIP_LATENCY), '--error-rate', str(BENCH_ERROR_RATE),
+        '--seed', '1' ],
+      stdout=subprocess.PIPE, text=True, env=env)
+    self.url = self.process.stdout.readline().strip()
+
+
+  @property
+  def stats (self):
+    "The statistics of the server: the counts of requests, errors, and records served."
+    return req.get(self.url.replace('/api/v1', '/_stats')).json()
+
+
+  def stop (self):
+    self.process.terminate()
+    self.process.wait()
+
+
+@pytest.fixture(scope='module')
+def standin():
+  server = RemoteStandin()
+  yield server
+  server.stop()
+  print_results()
+
+
+@pytest.fixture
+def server_url(standin, monkeypatch):
+  monkeypatch.setattr(fetch, 'SERVER_URL', standin.url)
+  return standin.url
+
+
+def print_results ():
+  "Print a table of the results of the benchmarks run."
+  print(f"\nFetch benchmarks: {BENCH_RECORDS} records served, latency {BENCH_LATENCY}s "
+        f"(+/- {BENCH_JITTER}s), {BENCH_RECORD_LATENCY}s per record, "
+        f"{BENCH_SKIP_LATENCY}s per record skipped, error rate {BENCH_ERROR_RATE}")
+  print(f"{'benchmark':<28}{'records':>9}{'seconds':>10}{'recs/sec':>11}{'requests':>10}")
+  for (name, num_recs, elapsed, num_requests) in RESULTS:
+    print(f"{name:<28}{num_recs:>9}{elapsed:>10.2f}{num_recs / elapsed:>11.0f}{num_requests:>10}")
+
+
+def run_bench (name, standin, fetch_fn):
+  """
+  Time the given function, which fetches and returns a list of records, record the
+  result under the given name, and return the records fetched.
+  """
+  start_requests = standin.stats['requests']
+  start_time = time.perf_counter()
+  recs = fetch_fn()
+  elapsed = time.perf_counter() - start_time
+  RESULTS.append((name, len(recs), elapsed, standin.stats['requests'] - start_requests))
+  return recs
+
+
+def new_client (workers, cache=None):
+  "Return a new client for the given number of workers, which adapts to the server."
+  return FetcherClient(pool_size=workers, cache=cache,
+                       limiter=AdaptiveLimiter(max_limit=workers, backoff=0.05))
+
+
+@pytest.mark.parametrize('workers', [1, 2, 4, 8])
+def test_bench_workers(standin, server_url, workers):
+  args = {'num_recs': BENCH_FETCH, 'workers': workers}
+  with new_client(workers) as client:
+    recs = run_bench(f"pages, {workers} workers", standin,
+                     lambda: fetch.get_n_records('bold', args, client=client))
+  assert len(recs) == BENCH_FETCH
+
+
+def test_bench_cache(standin, server_url):
+  args = {'num_recs': BENCH_FETCH, 'workers': 4}
+  with tempfile.TemporaryDirectory() as tmpdir:
+    for run in ('cold', 'warm'):
+      with new_client(4, cache=ResponseCache(cache_dir=tmpdir)) as client:
+        recs = run_bench(f"pages, 4 workers, {run} cache", standin,
+                         lambda: fetch.get_n_records('bold', args, client=client))
+      assert len(recs) == BENCH_FETCH
+
+
+def test_bench_revalidate(standin, server_url):
+  args = {'num_recs': BENCH_FETCH, 'workers': 4}
+  with tempfile.TemporaryDirectory() as tmpdir:
+    with new_client(4, cache=ResponseCache(cache_dir=tmpdir)) as client:
+      run_bench("pages, 4 workers, cold", standin,
+                lambda: fetch.get_n_records('bold', args, client=client))
+    cold_seconds = RESULTS[-1][2]
+    with new_client(4, cache=ResponseCache(cache_dir=tmpdir, refresh=True)) as client:
+      recs = run_bench("pages, 4 workers, refresh", standin,
+                       lambda: fetch.get_n_records('bold', args, client=client))
+    refresh_seconds = RESULTS[-1][2]
+  assert len(recs) == BENCH_FETCH
+  assert client.limiter.peak_limit > 1         # unchanged pages count as healthy requests
+  # revalidating must not cost more than downloading again (within the server's jitter)
+  assert refresh_seconds <= (1.25 * cold_seconds)
+
+
+def test_bench_keyset(standin, server_url):
+  args = {'num_recs': BENCH_FETCH, 'keyset': True}
+  with new_client(1) as client:
+    recs = run_bench('keyset', standin, lambda: fetch.get_n_records('bold', args, client=client))
+  assert len(recs) == BENCH_FETCH
+
+
+@pytest.mark.parametrize('num_shards', [2, 4])
+def test_bench_shards(standin, server_url, num_shards):
+  args = {'num_recs': BENCH_FETCH, 'workers': 2}
+  with new_client(2 * num_shards) as client:
+    recs = run_bench(f"shards, {num_shards} x 2 workers", standin,
+                     lambda: shards.get_sharded_records('bold', args, num_shards, client=client))
+  assert len(recs) == BENCH_FETCH
@@ -0,0 +1,87 @@
+# Shared fixtures for the tests of the MRIQC data fetcher.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Serve keyset (cursor) pagination queries.
+#
+import datetime
+import json
+import operator
+import re
+import threading
+from email.utils import format_datetime, parsedate_to_datetime
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+import requests as req
+
+import qmtools.qmfetcher.fetcher as fetch
+from qmtools.qmfetcher import SERVER_PAGE_SIZE
+
+FAKE_EPOCH = datetime.datetime(2021, 8, 1, tzinfo=datetime.timezone.utc)
+
+CREATED_OPS = { '>=': operator.ge, '<=': operator.le, '>': operator.gt, '<': operator.lt }
+
+
+@pytest.fixture
+def fake_server(monkeypatch):
+  """
+  Replace the fetcher's query functions with ones which serve pages of 120
+  synthetic records, newest first, capping the page size at SERVER_PAGE_SIZE
+  like the server. Bounds on _created in the where clause are honored.
+  When sorted by record keys, the keyset bound in the where clause is honored.
+  Returns a dictionary which records the page numbers and the where clauses
+  requested and which may be changed to set the first record number (lower is
+  newer), the total records, the period of duplicate checksums, the number of
+  records created at the same time, or a page number (or a request number) which
+  fails with a 503 error.
+  """
+  server = { 'start': 0, 'total': 120, 'tied': 1, 'pages': [], 'wheres': [],
+             'lock': threading.Lock() }
+  def key (num):
+    return (fake_created_time(num // server['tied']), num)
+  def fake_do_query (query_str, **kwargs):
+    qargs = parse_qs(urlsplit(query_str).query)
+    page_size = min(int(qargs['max_results'][0]), SERVER_PAGE_SIZE)
+    page_num = int(qargs['page'][0])
+    where = qargs.get('where', [''])[0]
+    with server['lock']:
+      server['pages'].append(page_num)
+      server['wheres'].append(where)
+      num_requests = len(server['pages'])
+    if ((page_num == server.get('fail_page')) or (num_requests == server.get('fail_request'))):
+      raise req.HTTPError('503 Server Error: SERVICE UNAVAILABLE')
+    nums = range(server['start'], server['start'] + server['total'])
+    for (op, bound) in re.findall(r'(?<!\()_created(>=|<=|>|<)"([^"]+)"', where):
+      nums = [num for num in nums if CREATED_OPS[op](key(num)[0], parsedate_to_datetime(bound))]
+    sort = qargs.get('sort', [''])[0]
+    if ('_id' in sort):                # sorted by keys: newest (or oldest) first
+      nums = sorted(nums, key=key, reverse=sort.startswith('-'))
+    cursor = re.search(r'\(_created([<>])"([^"]+)" or \(_created=="[^"]+" and _id[<>]"([^"]+)"\)\)', where)
+    if (cursor):
+      after = (parsedate_to_datetime(cursor.group(2)), int(cursor.group(3)))
+      if (cursor.group(1) == '<'):
+        nums = [num for num in nums if key(num) < after]
+      else:
+        nums = [num for num in nums if key(num) > after]
+    start = (page_num - 1) * page_size
+    items = [ { '_id': str(num), 'snr': num, '_created': fake_created(num // server['tied']),
+                'provenance': { 'md5sum': f"{num % server.get('dups', 9999):032x}" } }
+              for num in nums[start:start + page_size] ]
+    return { '_items': items,
+             '_meta': { 'page': page_num, 'max_results': page_size, 'total': len(nums) } }
+  def fake_stream_query (query_str, **kwargs):
+    text = json.dumps(fake_do_query(query_str))
+    for start in range(0, len(text), 1000):       # in chunks, like a streamed response
+      yield text[start:start + 1000]
+  monkeypatch.setattr(fetch, 'do_query', fake_do_query)
+  monkeypatch.setattr(fetch, 'stream_query', fake_stream_query)
+  return server
+
+
+def fake_created (num):
+  "Return the creation time string of the fake record with the given number."
+  return format_datetime(fake_created_time(num), usegmt=True)
+
+
+def fake_created_time (num):
+  "Return the creation time of the fake record with the given number: lower is newer."
+  return FAKE_EPOCH - datetime.timedelta(hours=num)
@@ -0,0 +1,410 @@
+# A local stand-in for the MRIQC WebAPI (an Eve server), for offline tests and benchmarks.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Optionally cut off the bodies of a random fraction of responses.
+#
+import argparse
+import ast
+import csv
+import datetime
+import functools
+import hashlib
+import json
+import operator
+import random
+import re
+import sys
+import threading
+import time
+from email.utils import format_datetime, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from qmtools import ALLOWED_MODALITIES
+from qmtools.qmfetcher import SERVER_PAGE_SIZE
+
+SAMPLE_RECORDS_FILE = 'samples/fetched/bold_500.tsv'
+
+# the fields which Eve always includes in its responses, whatever the projection
+META_FIELDS = ['_created', '_etag', '_id', '_updated']
+
+STANDIN_EPOCH = datetime.datetime(2021, 8, 1, tzinfo=datetime.timezone.utc)
+
+COMPARE_OPS = {
+  ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt,
+  ast.LtE: operator.le, ast.Gt: operator.gt, ast.GtE: operator.ge
+}
+
+DATE_RE = re.compile(r'^\w{3}, \d{2} \w{3} \d{4} \d{2}:\d{2}:\d{2} GMT$')
+
+
+def convert_value (text):
+  "Return the given TSV field text converted to a bool, int or float, where possible."
+  if (text in ('True', 'False')):
+    return (text == 'True')
+  for convert in (int, float):
+    try:
+      return convert(text)
+    except ValueError:
+      pass
+  return text
+
+
+@functools.lru_cache(maxsize=None)
+def parse_date (text):
+  "Return the datetime of the given creation time string (parsing each string only once)."
+  return parsedate_to_datetime(text)
+
+
+def get_field (record, dotted_key):
+  "Return the value of the given (dotted) field of the given nested record, or None."
+  value = record
+  for key in dotted_key.split('.'):
+    if (not isinstance(value, dict)):
+      return None
+    value = value.get(key)
+  return value
+
+
+def load_sample_records (filepath=SAMPLE_RECORDS_FILE):
+  """
+  Load the flattened records of the given fetched TSV file and return a list of
+  nested records (dictionaries), with typed values and without empty fields.
+  """
+  with open(filepath, newline='') as tsvfile:
+    rows = list(csv.DictReader(tsvfile, delimiter='\t'))
+  return [unflatten({ key: convert_value(val) for key, val in row.items() if (val != '') })
+          for row in rows]
+
+
+def make_records (num_recs, samples, interval=60, tied=1):
+  """
+  Return a list of the given number of synthetic records, in the order the server
+  would insert them (oldest first), made by copying the given sample records (in
+  turn) and giving each copy its own id, checksum, and creation time: successive
+  groups of the given number of records are created the given number of seconds apart.
+  """
+  records = []
+  for num in range(num_recs):
+    rec = json.loads(json.dumps(samples[num % len(samples)]))   # deep copy
+    created = format_datetime(STANDIN_EPOCH + datetime.timedelta(seconds=interval * (num // tied)),
+                              usegmt=True)
+    rec['_id'] = f"{num:024x}"
+    rec['_created'] = created
+    rec['_updated'] = created
+    rec['_etag'] = hashlib.md5(f"etag{num}".encode()).hexdigest()
+    rec.setdefault('provenance', {})['md5sum'] = hashlib.md5(f"rec{num}".encode()).hexdigest()
+    records.append(rec)
+  return records
+
+
+def project (record, fields):
+  "Return a copy of the given record holding only the given (dotted) fields and the meta fields."
+  projected = {}
+  for field in list(fields) + META_FIELDS:
+    value = get_field(record, field)
+    if (value is not None):
+      target = projected
+      keys = field.split('.')
+      for key in keys[:-1]:
+        target = target.setdefault(key, {})
+      target[keys[-1]] = value
+  return projected
+
+
+def unflatten (flat_record):
+  "Return a nested record (dictionary) made from the given record with dotted keys."
+  record = {}
+  for key, val in flat_record.items():
+    target = record
+    keys = key.split('.')
+    for part in keys[:-1]:
+      target = target.setdefault(part, {})
+    target[keys[-1]] = val
+  return record
+
+
+class WhereClause(object):
+  """
+  A compiled Eve "python syntax" WHERE clause (comparisons of fields with constants,
+  combined with 'and', 'or', and parentheses), which tests whether records match it.
+  As Eve does, the clause is parsed by the Python parser, and creation time strings
+  are compared as dates.
+  """
+
+  def __init__ (self, where):
+    self.tree = ast.parse(where, mode='eval').body if where else None
+
+
+  def matches (self, record):
+    "Return True if the given (nested) record matches the clause."
+    return (self.tree is None) or self._eval(self.tree, record)
+
+
+  def _eval (self, node, record):
+    if (isinstance(node, ast.BoolOp)):
+      results = (self._eval(value, record) for value in node.values)
+      return all(results) if isinstance(node.op, ast.And) else any(results)
+    if (isinstance(node, ast.Compare)):
+      left = self._field(node.left, record)
+      for (op, comparator) in zip(node.ops, node.comparators):
+        right = self._constant(comparator)
+        if ((left is None) or not self._compare(op, left, right)):
+          return False
+      return True
+    raise ValueError(f"Unsupported WHERE clause element: {ast.dump(node)}")
+
+
+  def _compare (self, op, left, right):
+    if (isinstance(right, str) and isinstance(left, str) and DATE_RE.match(right)):
+      left, right = parse_date(left), parse_date(right)
+    try:
+      return COMPARE_OPS[type(op)](left, right)
+    except TypeError:                  # values of incomparable types do not match
+      return False
+
+
+  def _constant (self, node):
+    if (isinstance(node, ast.Constant)):
+      return node.value
+    if (isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub)):
+      return -self._constant(node.operand)
+    raise ValueError(f"Unsupported WHERE clause value: {ast.dump(node)}")
+
+
+  def _field (self, node, record):
+    if (isinstance(node, ast.Name)):
+      return get_field(record, node.id)
+    if (isinstance(node, ast.Attribute)):
+      parent = node.value
+      names = [node.attr]
+      while isinstance(parent, ast.Attribute):
+        names.insert(0, parent.attr)
+        parent = parent.value
+      if (isinstance(parent, ast.Name)):
+        return get_field(record, '.'.join([parent.id] + names))
+    raise ValueError(f"Unsupported WHERE clause field: {ast.dump(node)}")
+
+
+class StandinServer(object):
+  """
+  A local, threaded HTTP server which stands in for the MRIQC WebAPI, serving the
+  '/api/v1/{modality}' endpoints with Eve's 'max_results', 'page', 'sort', 'where',
+  and 'projection' query parameters and its '_meta' (page, max_results, total).
+  Like the real server, it caps the page size, and it can be made to add a latency
+  to every request (plus random jitter), a time for each record served, and a time
+  for each record skipped to reach a page (as the database does for deep pages).
+  It can also fail a random fraction of requests with '503 Service Unavailable',
+  and cut off the body of a random fraction of responses, by closing the connection
+  partway through it.
+  Each response carries an ETag and requests conditional on it (If-None-Match)
+  are answered '304 Not Modified' when the response is unchanged.
+  The records served are synthesized from sample records. Counts of the requests,
+  errors, responses not modified, responses cut off, and records served are kept
+  in the 'stats' dictionary, which is also served (as JSON) at '/_stats', for when
+  the server runs in its own process.
+  """
+
+  def __init__ (self, num_recs=1000, samples=None, page_cap=SERVER_PAGE_SIZE, latency=0.0,
+                jitter=0.0, record_latency=0.0, skip_latency=0.0, error_rate=0.0, seed=None,
+                tied=1, cut_rate=0.0):
+    if (samples is None):
+      samples = load_sample_records()
+    self.records = make_records(num_recs, samples, tied=tied)
+    self.page_cap = page_cap
+    self.latency = latency
+    self.jitter = jitter
+    self.record_latency = record_latency
+    self.skip_latency = skip_latency
+    self.error_rate = error_rate
+    self.cut_rate = cut_rate
+    self.random = random.Random(seed)
+    self.stats = { 'requests': 0, 'errors': 0, 'not_modified': 0, 'cuts': 0, 'records': 0 }
+    self._lock = threading.Lock()
+    self._httpd = None
+    self._thread = None
+
+
+  def __enter__ (self):
+    return self.start()
+
+
+  def __exit__ (self, exc_type, exc_value, traceback):
+    self.stop()
+
+
+  @property
+  def url (self):
+    "The base URL of the API served, to be used in place of the MRIQC server URL."
+    host, port = self._httpd.server_address[:2]
+    return f"http://{host}:{port}/api/v1"
+
+
+  def query (self, modality, params):
+    """
+    Answer the query with the given (parsed) query parameters for the given modality:
+    return a tuple of the HTTP status and the response body (a dictionary).
+    """
+    if (modality not in ALLOWED_MODALITIES):
+      return (404, { '_status': 'ERR', '_error': { 'code': 404, 'message': 'Not Found' } })
+    try:
+      max_results = min(int(params.get('max_results', ['25'])[0]), self.page_cap)
+      page = max(1, int(params.get('page', ['1'])[0]))
+      where = WhereClause(params.get('where', [''])[0])
+      projection = json.loads(params.get('projection', ['{}'])[0])
+    except (ValueError, SyntaxError) as err:
+      return (400, { '_status': 'ERR', '_error': { 'code': 400, 'message': str(err) } })
+
+    records = [rec for rec in self.records if where.matches(rec)]
+    for key in reversed(params.get('sort', [''])[0].split(',')):
+      if (key):
+        field = key.lstrip('-')
+        records.sort(key=lambda rec: self._sort_key(rec, field), reverse=key.startswith('-'))
+
+    skip = (page - 1) * max_results
+    items = records[skip:skip + max_results]
+    fields = [field for (field, include) in projection.items() if include]
+    if (fields):
+      items = [project(rec, fields) for rec in items]
+    self._wait(skip, len(items))
+    with self._lock:
+      self.stats['records'] += len(items)
+    return (200, { '_items': items,
+                   '_meta': { 'page': page, 'max_results': max_results, 'total': len(records) } })
+
+
+  def start (self, port=0):
+    """
+    Start serving, on the given local port (by default, a free port), in a background
+    thread. Returns this server.
+    """
+    server = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'    # keep connections alive, like the real server
+
+      def do_GET (self):
+        server._handle(self)
+
+      def log_message (self, format, *args):
+        pass
+
+    self._httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    self._httpd.daemon_threads = True
+    self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+    self._thread.start()
+    return self
+
+
+  def stop (self):
+    "Stop serving and close the server socket."
+    if (self._httpd is not None):
+      self._httpd.shutdown()
+      self._httpd.server_close()
+      self._httpd = None
+
+
+  def _handle (self, handler):
+    url = urlsplit(handler.path)
+    if (url.path == '/_stats'):
+      with self._lock:
+        stats = dict(self.stats)
+      self._respond(handler, 200, stats)
+      return
+    with self._lock:
+      self.stats['requests'] += 1
+      failed = (self.random.random() < self.error_rate)
+      if (failed):
+        self.stats['errors'] += 1
+    if (failed):
+      status, body = (503, { '_status': 'ERR', '_error': { 'code': 503, 'message': 'Service Unavailable' } })
+    elif (not url.path.startswith('/api/v1/')):
+      status, body = (404, { '_status': 'ERR', '_error': { 'code': 404, 'message': 'Not Found' } })
+    else:
+      status, body = self.query(url.path[len('/api/v1/'):], parse_qs(url.query))
+    self._respond(handler, status, body)
+
+
+  def _respond (self, handler, status, body):
+    text = json.dumps(body).encode('utf-8')
+    etag = f'"{hashlib.sha1(text).hexdigest()}"'
+    if ((status == 200) and (handler.headers.get('If-None-Match') == etag)):
+      with self._lock:
+        self.stats['not_modified'] += 1
+      handler.send_response(304)
+      handler.send_header('ETag', etag)
+      handler.end_headers()
+      return
+    handler.send_response(status)
+    handler.send_header('Content-Type', 'application/json')
+    if (status == 200):
+      handler.send_header('ETag', etag)
+    handler.send_header('Content-Length', str(len(text)))
+    handler.end_headers()
+    with self._lock:
+      cut = ((status == 200) and (self.cut_rate > 0) and (self.random.random() < self.cut_rate))
+      if (cut):
+        self.stats['cuts'] += 1
+    if (cut):                          # send only part of the body, then drop the connection
+      handler.wfile.write(text[:len(text) // 2])
+      handler.wfile.flush()
+      handler.close_connection = True
+      return
+    handler.wfile.write(text)
+
+
+  def _sort_key (self, record, field):
+    value = get_field(record, field)
+    if ((field == '_created') and value):
+      return (0, parse_date(value))
+    return (0, value) if (value is not None) else (-1, '')
+
+
+  def _wait (self, num_skipped, num_served):
+    with self._lock:
+      jitter = self.random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0
+    delay = (self.latency + jitter + (num_skipped * self.skip_latency) +
+             (num_served * self.record_latency))
+    if (delay > 0):
+      time.sleep(delay)
+
+
+def main (argv=None):
+  """
+  Run a stand-in server in this process, until interrupted, printing its URL first:
+    PYTHONPATH=src python -m tests.qmtools.qmfetcher.standin_server [options]
+  To fetch from it, set the MRIQC_SERVER_URL environment variable to the URL printed.
+  """
+  parser = argparse.ArgumentParser(description='Serve a local stand-in for the MRIQC WebAPI.')
+  parser.add_argument('--port', type=int, default=0, help='Port to serve on [default: any free port]')
+  parser.add_argument('--records', type=int, default=1000, help='Number of records to serve [default: 1000]')
+  parser.add_argument('--samples', default=SAMPLE_RECORDS_FILE,
+                      help=f"Fetched TSV file of sample records [default: {SAMPLE_RECORDS_FILE}]")
+  parser.add_argument('--page-cap', type=int, default=SERVER_PAGE_SIZE,
+                      help=f"Largest page size served [default: {SERVER_PAGE_SIZE}]")
+  parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to each request')
+  parser.add_argument('--jitter', type=float, default=0.0, help='Random +/- seconds added to each request')
+  parser.add_argument('--record-latency', type=float, default=0.0, help='Seconds added for each record served')
+  parser.add_argument('--skip-latency', type=float, default=0.0,
+                      help='Seconds added for each record skipped to reach the page')
+  parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests failed with 503')
+  parser.add_argument('--cut-rate', type=float, default=0.0,
+                      help='Fraction of response bodies cut off partway through')
+  parser.add_argument('--seed', type=int, default=None, help='Seed for the jitter, errors, and cuts')
+  args = parser.parse_args(argv)
+
+  server = StandinServer(num_recs=args.records, samples=load_sample_records(args.samples),
+                         page_cap=args.page_cap, latency=args.latency, jitter=args.jitter,
+                         record_latency=args.record_latency, skip_latency=args.skip_latency,
+                         error_rate=args.error_rate, seed=args.seed, cut_rate=args.cut_rate)
+  server.start(args.port)
+  print(server.url, flush=True)
+  try:
+    server._thread.join()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.stop()
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,109 @@
+# Tests of the asyncio methods to query the MRIQC server, using a local stand-in server.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Initial creation.
+#
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+import qmtools.qmfetcher.async_fetcher as afetch
+import qmtools.qmfetcher.fetcher as fetch
+from qmtools.qmfetcher import SERVER_PAGE_SIZE
+
+
+def make_app (total, requests_seen, delay=0, fail_page=None):
+  "Make a stand-in MRIQC server application which serves the given number of records."
+  async def handle_modality (request):
+    page_size = min(int(request.query.get('max_results', SERVER_PAGE_SIZE)), SERVER_PAGE_SIZE)
+    page_num = int(request.query.get('page', 1))
+    requests_seen.append(page_num)
+    if (page_num == fail_page):
+      raise web.HTTPServiceUnavailable()
+    await asyncio.sleep(delay)
+    start = (page_num - 1) * page_size
+    items = [ { '_id': str(num), 'snr': num, 'provenance': { 'md5sum': f"{num:032x}" } }
+              for num in range(start, min(start + page_size, total)) ]
+    return web.json_response({
+      '_items': items,
+      '_meta': { 'page': page_num, 'max_results': page_size, 'total': total } })
+
+  app = web.Application()
+  app.router.add_get('/api/v1/{modality}', handle_modality)
+  return app
+
+
+async def run_with_server (app, coro_fn, monkeypatch):
+  "Start the given app on a free local port, point the fetcher at it, and await the coroutine."
+  runner = web.AppRunner(app)
+  await runner.setup()
+  site = web.TCPSite(runner, '127.0.0.1', 0)
+  await site.start()
+  port = site._server.sockets[0].getsockname()[1]
+  monkeypatch.setattr(fetch, 'SERVER_URL', f"http://127.0.0.1:{port}/api/v1")
+  try:
+    return await coro_fn()
+  finally:
+    await runner.cleanup()
+
+
+class TestAsyncFetcher(object):
+
+  def test_aget_n_records_one_page(self, monkeypatch):
+    seen = []
+    app = make_app(120, seen)
+    recs = asyncio.run(run_with_server(app,
+      lambda: afetch.aget_n_records('bold', {'num_recs': 10}), monkeypatch))
+    assert [rec['snr'] for rec in recs] == list(range(10))
+    assert seen == [1]
+
+
+  def test_aget_n_records_pages(self, monkeypatch):
+    seen = []
+    app = make_app(1000, seen, delay=0.05)
+    recs = asyncio.run(run_with_server(app,
+      lambda: afetch.aget_n_records('T1w', {'num_recs': 730}, concurrency=20), monkeypatch))
+    assert len(recs) == 730
+    assert [int(rec['_id']) for rec in recs] == list(range(730))   # in server order
+    assert sorted(seen) == list(range(1, 16))
+
+
+  def test_aget_n_records_all(self, monkeypatch):
+    seen = []
+    app = make_app(120, seen)
+    recs = asyncio.run(run_with_server(app,
+      lambda: afetch.aget_n_records('bold', {'num_recs': 500}, concurrency=2), monkeypatch))
+    assert [rec['snr'] for rec in recs] == list(range(120))
+    assert sorted(seen) == [1, 2, 3]
+
+
+  def test_aget_n_records_norecs(self, monkeypatch):
+    seen = []
+    app = make_app(0, seen)
+    recs = asyncio.run(run_with_server(app,
+      lambda: afetch.aget_n_records('bold', {'num_recs': 5}), monkeypatch))
+    assert recs == []
+
+
+  def test_aget_n_records_error(self, monkeypatch):
+    seen = []
+    app = make_app(500, seen, fail_page=3)
+    with pytest.raises(aiohttp.ClientResponseError) as cre:
+      asyncio.run(run_with_server(app,
+        lambda: afetch.aget_n_records('bold', {'num_recs': 500}), monkeypatch))
+    assert cre.value.status == 503
+
+
+  def test_aget_n_records_cancel(self, monkeypatch):
+    seen = []
+    app = make_app(1000, seen, delay=1)
+    async def cancel_fetch ():
+      task = asyncio.create_task(afetch.aget_n_records('bold', {'num_recs': 1000}))
+      await asyncio.sleep(0.2)
+      task.cancel()
+      with pytest.raises(asyncio.CancelledError):
+        await task
+      return seen
+    seen = asyncio.run(run_with_server(app, cancel_fetch, monkeypatch))
+    assert seen == [1]                 # cancelled while waiting for the first page
@@ -0,0 +1,91 @@
+# Tests of the MRIQC data fetcher batch command CLI code.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Initial creation.
+#
+import csv
+import os
+import pytest
+import tempfile
+
+from qmtools import BATCH_FAILURE_EXIT_CODE, FETCHED_DIR, QUERY_FILE_EXIT_CODE
+import qmtools.qmfetcher.batch_cli as batch_cli
+import qmtools.qmfetcher.fetcher_cli as cli
+from tests import TEST_RESOURCES_DIR
+
+
+@pytest.fixture
+def popdir(request):
+  yield
+  os.chdir(request.config.invocation_dir)
+
+
+class TestBatchCLI(object):
+
+  manmaf_query_fyl = f"{TEST_RESOURCES_DIR}/manmaf.qp"
+  metrics_query_fyl = f"{TEST_RESOURCES_DIR}/metrics.qp"
+
+
+  def read_manifest(self, filepath):
+    with open(filepath) as manifest_file:
+      return list(csv.DictReader(manifest_file, delimiter='\t'))
+
+
+  def test_find_query_files(self):
+    found = batch_cli.find_query_files([TEST_RESOURCES_DIR])
+    assert self.manmaf_query_fyl in found
+    assert all(qfile.endswith('.qp') for qfile in found)
+    assert found == sorted(found)
+    found = batch_cli.find_query_files([f"{TEST_RESOURCES_DIR}/m*.qp", self.metrics_query_fyl])
+    assert found == [self.manmaf_query_fyl, self.metrics_query_fyl]
+    assert batch_cli.find_query_files(['NOSUCH.qp']) == ['NOSUCH.qp']
+
+
+  def test_get_output_filepaths(self):
+    filepaths = batch_cli.get_output_filepaths('bold', ['a/one.qp', 'two.qp', 'b/one.qp'])
+    assert filepaths == [ f"{FETCHED_DIR}/one_bold.tsv", f"{FETCHED_DIR}/two_bold.tsv",
+                          f"{FETCHED_DIR}/one_2_bold.tsv" ]
+
+
+  def test_batch_no_query_files(self, capsys, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      with pytest.raises(SystemExit) as se:
+        cli.main(['batch', 'bold', 'NOSUCH_DIR/*.qp'])
+      assert se.value.code == QUERY_FILE_EXIT_CODE
+
+
+  def test_batch(self, capsys, fake_server, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      cli.main([ 'batch', '-v', 'bold', self.manmaf_query_fyl, self.metrics_query_fyl,
+                 '-n', '30', '-m', 'test' ])
+      sysout, syserr = capsys.readouterr()
+      print(f"CAPTURED SYS.OUT:\n{sysout}")
+      assert 'Fetched 60 records for 2 of 2 query files' in sysout
+      manifest = self.read_manifest(f"{FETCHED_DIR}/test.tsv")
+      assert [entry['query_file'] for entry in manifest] == [self.manmaf_query_fyl,
+                                                             self.metrics_query_fyl]
+      for entry in manifest:
+        assert entry['num_fetched'] == '30'
+        assert entry['total'] == '120'
+        assert entry['error'] == ''
+        with open(entry['output_file']) as tstf:
+          assert len(tstf.readlines()) == 31
+
+
+  def test_batch_failures(self, capsys, fake_server, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      with open('bad.qp', 'w') as bad:
+        bad.write('no_such_keyword == 1\n')
+      with pytest.raises(SystemExit) as se:
+        cli.main([ 'batch', 'bold', 'bad.qp', self.manmaf_query_fyl, '-n', '20', '-m', 'test.tsv' ])
+      assert se.value.code == BATCH_FAILURE_EXIT_CODE
+      sysout, syserr = capsys.readouterr()
+      assert 'Fetched 20 records for 1 of 2 query files' in sysout
+      (bad_entry, good_entry) = self.read_manifest(f"{FETCHED_DIR}/test.tsv")
+      assert bad_entry['num_fetched'] == '0'
+      assert 'no_such_keyword' in bad_entry['error']
+      assert not os.path.exists(bad_entry['output_file'])
+      assert good_entry['num_fetched'] == '20'
+      assert good_entry['error'] == ''
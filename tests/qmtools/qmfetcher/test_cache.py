@@ -0,0 +1,136 @@
+# Tests of the on-disk cache of MRIQC server query responses.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Remove an unused import.
+#
+import os
+import tempfile
+import time
+
+import qmtools.qmfetcher.cache as qmc
+
+
+class TestCache(object):
+
+  url1 = 'https://mriqc.nimh.nih.gov/api/v1/bold?max_results=50&page=1&sort=-_created'
+  url2 = 'https://mriqc.nimh.nih.gov/api/v1/bold?max_results=50&page=2&sort=-_created'
+  url3 = 'https://mriqc.nimh.nih.gov/api/v1/bold?max_results=50&page=3&sort=-_created'
+
+  def test_normalize_url(self):
+    assert qmc.normalize_url(self.url1) == \
+      'https://mriqc.nimh.nih.gov/api/v1/bold?max_results=50&page=1&sort=-_created'
+    assert qmc.normalize_url('HTTPS://MRIQC.nimh.nih.gov/api/v1/bold?page=1&sort=-_created&max_results=50') == \
+      qmc.normalize_url(self.url1)
+    assert qmc.normalize_url(self.url1) != qmc.normalize_url(self.url2)
+    assert qmc.normalize_url('http://host/api/v1/T1w') == 'http://host/api/v1/T1w'
+
+
+  def test_get_put(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      cache = qmc.ResponseCache(cache_dir=os.path.join(tmpdir, 'cache'))
+      assert cache.get(self.url1) is None
+      cache.put(self.url1, '{"_items": []}')
+      assert cache.get(self.url1) == '{"_items": []}'
+      assert cache.get(self.url1.replace('page=1&sort=-_created', 'sort=-_created&page=1')) is not None
+      assert cache.get(self.url2) is None
+      cache.put(self.url1, '{"_items": [1]}')
+      assert cache.get(self.url1) == '{"_items": [1]}'
+      assert len(cache.entries()) == 1
+
+
+  def test_persistent(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      qmc.ResponseCache(cache_dir=tmpdir).put(self.url1, 'TEXT')
+      assert qmc.ResponseCache(cache_dir=tmpdir).get(self.url1) == 'TEXT'
+
+
+  def test_ttl(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      cache = qmc.ResponseCache(cache_dir=tmpdir, ttl=60)
+      cache.put(self.url1, 'TEXT')
+      path = cache.path_for(self.url1)
+      past = time.time() - 120
+      os.utime(path, (past, past))     # pretend the response was fetched long ago
+      assert cache.get(self.url1) is None
+      assert not os.path.exists(path)
+
+
+  def test_refresh(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      qmc.ResponseCache(cache_dir=tmpdir).put(self.url1, 'OLD')
+      cache = qmc.ResponseCache(cache_dir=tmpdir, refresh=True)
+      assert cache.get(self.url1) is None
+      cache.put(self.url1, 'NEW')
+      assert qmc.ResponseCache(cache_dir=tmpdir).get(self.url1) == 'NEW'
+
+
+  def test_lru_eviction(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      cache = qmc.ResponseCache(cache_dir=tmpdir, max_bytes=25)
+      cache.put(self.url1, 'A' * 10)
+      cache.put(self.url2, 'B' * 10)
+      now = time.time()
+      os.utime(cache.path_for(self.url1), (now - 10, now))   # used least recently
+      os.utime(cache.path_for(self.url2), (now - 5, now))
+      cache.put(self.url3, 'C' * 10)   # exceeds size cap: evicts url1 only
+      assert cache.get(self.url1) is None
+      assert cache.get(self.url2) == 'B' * 10
+      assert cache.get(self.url3) == 'C' * 10
+
+
+  def test_clear(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      cache = qmc.ResponseCache(cache_dir=tmpdir)
+      cache.put(self.url1, 'A')
+      cache.put(self.url2, 'B')
+      assert len(cache.entries()) == 2
+      cache.clear()
+      assert cache.entries() == []
+      assert cache.get(self.url1) is None
+
+
+  def test_validators(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      cache = qmc.ResponseCache(cache_dir=tmpdir)
+      cache.put(self.url1, 'TEXT', {'ETag': '"abc"', 'Content-Type': 'application/json'})
+      cache.put(self.url2, 'TEXT')
+      assert cache.validators(self.url1) == {'ETag': '"abc"'}
+      assert cache.conditional_headers(self.url1) == {'If-None-Match': '"abc"'}
+      assert cache.conditional_headers(self.url2) == {}
+      assert cache.conditional_headers(self.url3) == {}
+      cache.put(self.url1, 'TEXT', {'Last-Modified': 'Tue, 01 Jan 2019 00:00:00 GMT'})
+      assert cache.conditional_headers(self.url1) == \
+        {'If-Modified-Since': 'Tue, 01 Jan 2019 00:00:00 GMT'}
+      cache.clear()
+      assert os.listdir(tmpdir) == []
+
+
+  def test_revalidated(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      cache = qmc.ResponseCache(cache_dir=tmpdir, ttl=60)
+      cache.put(self.url1, 'TEXT', {'ETag': '"abc"'})
+      cache.put(self.url2, 'TEXT')
+      past = time.time() - 120
+      for url in (self.url1, self.url2):  # pretend the responses were fetched long ago
+        os.utime(cache.path_for(url), (past, past))
+      assert cache.get(self.url1) is None
+      assert cache.get(self.url2) is None
+      assert os.path.exists(cache.path_for(self.url1))    # kept, to be revalidated
+      assert not os.path.exists(cache.path_for(self.url2))
+      with cache.revalidated(self.url1) as cfyl:
+        assert cfyl.read() == 'TEXT'
+      assert cache.get(self.url1) == 'TEXT'               # fresh again
+      assert cache.num_revalidated == 1
+      assert cache.revalidated(self.url3) is None
+
+
+  def test_total_bytes(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      cache = qmc.ResponseCache(cache_dir=tmpdir, ttl=60)
+      cache.put(self.url1, 'A' * 10)
+      cache.put(self.url1, 'B' * 20)   # replaces the first response
+      cache.put(self.url2, 'C' * 5)
+      assert cache._total_bytes == sum(size for (_, _, size) in cache.entries()) == 25
+      past = time.time() - 120
+      os.utime(cache.path_for(self.url2), (past, past))
+      assert cache.get(self.url2) is None                 # expired and removed
+      assert cache._total_bytes == sum(size for (_, _, size) in cache.entries()) == 20
@@ -0,0 +1,105 @@
+# Tests of the checkpoints which allow an interrupted fetch to be resumed.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Test resuming after a partially written checkpoint line.
+#
+import os
+import tempfile
+
+import pytest
+
+import qmtools.qmfetcher.checkpoint as ck
+
+
+@pytest.fixture
+def recs():
+  return [
+    { '_id': '1', 'provenance.md5sum': '19cf39e8895fcf98e46f6017caebbbf1' },
+    { '_id': '2', 'provenance.md5sum': '42febfb2ff72767655b0901dbde42ecb' },
+    { '_id': '3', 'provenance.md5sum': 'af34ecc2a49a550d49216f5b5b5b22d7' }
+  ]
+
+
+class TestCheckpoint(object):
+
+  query = 'https://mriqc.nimh.nih.gov/api/v1/bold?max_results=50&page=1&sort=-_created'
+
+  def test_checkpoint_path(self):
+    assert ck.checkpoint_path('fetched/bold.tsv') == 'fetched/bold.tsv.ckpt'
+
+
+  def test_load_nofile(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      assert ck.Checkpoint.load(os.path.join(tmpdir, 'NO_SUCH.ckpt')) is None
+
+
+  def test_record_and_load(self, recs):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      ckpath = os.path.join(tmpdir, 'test.tsv.ckpt')
+      ckpt = ck.Checkpoint(ckpath, self.query)
+      ckpt.record_page(50, recs[:2], 2, 100)
+      ckpt.record_page(150, recs[2:], 3, 150)
+      ckpt.close()
+      loaded = ck.Checkpoint.load(ckpath)
+      assert loaded.query == self.query
+      assert loaded.offset == 150
+      assert loaded.num_written == 3
+      assert loaded.file_size == 150
+      assert loaded.chksums == set(rec['provenance.md5sum'] for rec in recs)
+
+
+  def test_record_and_load_cursor(self, recs):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      ckpath = os.path.join(tmpdir, 'test.tsv.ckpt')
+      ckpt = ck.Checkpoint(ckpath, self.query)
+      ckpt.record_page(2, recs[:2], 2, 100)
+      assert ck.Checkpoint.load(ckpath).cursor is None
+      ckpt.record_page(3, recs[2:], 3, 150, cursor=('Sun, 01 Aug 2021 00:00:00 GMT', '7'))
+      ckpt.close()
+      loaded = ck.Checkpoint.load(ckpath)
+      assert loaded.cursor == ('Sun, 01 Aug 2021 00:00:00 GMT', '7')
+      assert loaded.offset == 3
+
+
+  def test_load_partial_line(self, recs):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      ckpath = os.path.join(tmpdir, 'test.tsv.ckpt')
+      ckpt = ck.Checkpoint(ckpath, self.query)
+      ckpt.record_page(50, recs[:1], 1, 60)
+      ckpt.close()
+      with open(ckpath, 'a') as ckfile:
+        ckfile.write('{"offset": 100, "md5s')   # interrupted while writing
+      loaded = ck.Checkpoint.load(ckpath)
+      assert loaded.offset == 50
+      assert loaded.num_written == 1
+      loaded.record_page(100, recs[1:], 3, 150)  # resumed: appended after the partial line
+      loaded.close()
+      resumed = ck.Checkpoint.load(ckpath)
+      assert resumed.offset == 100
+      assert resumed.num_written == 3
+      assert resumed.chksums == set(rec['provenance.md5sum'] for rec in recs)
+
+
+  def test_resume_appends(self, recs):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      ckpath = os.path.join(tmpdir, 'test.tsv.ckpt')
+      ckpt = ck.Checkpoint(ckpath, self.query)
+      ckpt.record_page(50, recs[:1], 1, 60)
+      ckpt.close()
+      loaded = ck.Checkpoint.load(ckpath)
+      loaded.record_page(100, recs[1:], 3, 180)
+      loaded.close()
+      reloaded = ck.Checkpoint.load(ckpath)
+      assert reloaded.query == self.query
+      assert reloaded.offset == 100
+      assert len(reloaded.chksums) == 3
+
+
+  def test_remove(self, recs):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      ckpath = os.path.join(tmpdir, 'test.tsv.ckpt')
+      ckpt = ck.Checkpoint(ckpath, self.query)
+      ckpt.record_page(50, recs, 3, 160)
+      assert os.path.exists(ckpath)
+      ckpt.remove()
+      assert not os.path.exists(ckpath)
+      ckpt.remove()                    # removing twice is harmless
@@ -0,0 +1,88 @@
+# Tests of the persistent index of the checksums of the records already fetched.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Initial creation.
+#
+import os
+import tempfile
+
+import qmtools.qmfetcher.chksum_index as ci
+import qmtools.qmfetcher.fetcher as fetch
+
+
+def md5 (num):
+  "Return a fake md5 checksum string for the given number."
+  return f"{num:032x}"
+
+
+class TestChecksumIndex(object):
+
+  def test_to_digest(self):
+    assert ci.to_digest('19cf39e8895fcf98e46f6017caebbbf1') == bytes.fromhex('19cf39e8895fcf98e46f6017caebbbf1')
+    assert len(ci.to_digest('not hex')) == ci.DIGEST_SIZE
+    assert len(ci.to_digest('abcd')) == ci.DIGEST_SIZE     # hex, but too short
+    assert ci.to_digest('not hex') != ci.to_digest('not hex either')
+
+
+  def test_sorted_digests(self):
+    digests = ci.SortedDigests(b''.join(ci.to_digest(md5(num)) for num in range(5)))
+    assert len(digests) == 5
+    assert digests[4] == ci.to_digest(md5(4))
+    assert list(digests) == [ci.to_digest(md5(num)) for num in range(5)]
+
+
+  def test_add_unsaved(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      index = ci.ChecksumIndex(os.path.join(tmpdir, 'test.idx'))
+      assert len(index) == 0
+      assert md5(1) not in index
+      index.update([md5(1), md5(2), md5(1)])
+      assert md5(1) in index
+      assert len(index) == 2
+      index.close()
+      assert not os.path.exists(os.path.join(tmpdir, 'test.idx'))
+
+
+  def test_save_and_reload(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      idxpath = os.path.join(tmpdir, 'sub', 'test.idx')
+      with ci.ChecksumIndex(idxpath) as index:
+        index.update([md5(num) for num in range(999, 0, -3)])
+        index.save()
+        assert not index.added
+        assert len(index) == 333
+      assert os.path.getsize(idxpath) == 333 * ci.DIGEST_SIZE
+      with ci.ChecksumIndex(idxpath) as index:
+        assert all((md5(num) in index) for num in range(999, 0, -3))
+        assert not any((md5(num) in index) for num in range(998, 0, -3))
+        index.add(md5(999))            # already indexed
+        assert not index.added
+
+
+  def test_save_merges_runs(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      idxpath = os.path.join(tmpdir, 'test.idx')
+      run1 = ci.ChecksumIndex(idxpath)
+      run2 = ci.ChecksumIndex(idxpath)
+      run1.update([md5(num) for num in range(0, 100, 2)])
+      run2.update([md5(num) for num in range(0, 100, 5)])
+      run1.save()
+      run2.save()                      # adds to, does not overwrite, the first run's save
+      with ci.ChecksumIndex(idxpath) as index:
+        expected = set(range(0, 100, 2)) | set(range(0, 100, 5))
+        assert len(index) == len(expected)
+        assert all((md5(num) in index) for num in expected)
+        assert list(index._digests) == sorted(ci.to_digest(md5(num)) for num in expected)
+      run1.close()
+      run2.close()
+
+
+  def test_dedup_with_index(self, fake_server):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      idxpath = os.path.join(tmpdir, 'test.idx')
+      with ci.ChecksumIndex(idxpath) as index:
+        recs = fetch.get_n_records('bold', {'num_recs': 30}, chksums=index)
+        assert [rec['snr'] for rec in recs] == list(range(30))
+        index.save()
+      with ci.ChecksumIndex(idxpath) as index:    # a later run skips those already fetched
+        recs = fetch.get_n_records('bold', {'num_recs': 30}, chksums=index)
+        assert [rec['snr'] for rec in recs] == list(range(30, 60))
@@ -0,0 +1,192 @@
+# Tests of the pooled HTTP client used by the MRIQC data fetcher.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Add tests of revalidating cached responses.
+#
+import json
+import tempfile
+import time
+
+import pytest
+import requests as req
+
+import qmtools.qmfetcher.client as qmc
+from qmtools.qmfetcher.cache import ResponseCache
+import qmtools.qmfetcher.fetcher as fetch
+from qmtools.qmfetcher.fetcher import SERVER_URL
+from tests import TEST_RESOURCES_DIR
+
+
+class FakeResponse(object):
+  def __init__ (self, text, status_code=req.codes.ok, headers=None):
+    self.text = text
+    self.status_code = status_code
+    self.headers = headers or {}
+    self.encoding = None
+
+  def close (self):
+    pass
+
+  def __enter__ (self):
+    return self
+
+  def __exit__ (self, exc_type, exc_value, traceback):
+    pass
+
+  def iter_content (self, chunk_size=1, decode_unicode=False):
+    for start in range(0, len(self.text), chunk_size):
+      yield self.text[start:start + chunk_size]
+
+  def raise_for_status (self):
+    raise req.HTTPError(f"{self.status_code} Error", response=self)
+
+
+class FakeClient(object):
+  """
+  Client which records the URLs (and any conditional request headers) requested and
+  answers from a results file, with the given ETag, if any: requests conditional on
+  that ETag are answered '304 Not Modified'.
+  """
+  def __init__ (self, results_file, status_code=req.codes.ok, cache=None, etag=None):
+    with open(results_file) as rfyl:
+      self.text = rfyl.read()
+    self.cache = cache
+    self.status_code = status_code
+    self.etag = etag
+    self.urls = []
+    self.conditions = []
+
+  def get (self, url, timeout=None, stream=False, headers=None):
+    self.urls.append(url)
+    self.conditions.append((headers or {}).get('If-None-Match'))
+    if (self.etag and (self.etag == (headers or {}).get('If-None-Match'))):
+      return FakeResponse('', req.codes.not_modified)
+    return FakeResponse(self.text, self.status_code, { 'ETag': self.etag } if self.etag else None)
+
+
+class TestClient(object):
+
+  page1_results_fyl = f"{TEST_RESOURCES_DIR}/reptime1.json"
+  page1_results_cnt = 25
+  page1_results_total = 15346
+
+  def test_client_pool_size(self):
+    with qmc.FetcherClient(pool_size=6) as client:
+      assert client.pool_size == 6
+      adapter = client.session.get_adapter(SERVER_URL)
+      assert adapter._pool_maxsize == 6
+      assert client.session.get_adapter('http://localhost') is adapter
+
+
+  def test_client_pool_size_min(self):
+    with qmc.FetcherClient(pool_size=0) as client:
+      assert client.pool_size == 1
+
+
+  def test_get_default_client(self):
+    client = qmc.get_default_client()
+    assert isinstance(client, qmc.FetcherClient)
+    assert qmc.get_default_client() is client
+
+
+  def test_do_query_client(self):
+    client = FakeClient(self.page1_results_fyl)
+    results = fetch.do_query('http://fake/bold', client=client)
+    assert client.urls == ['http://fake/bold']
+    assert len(fetch.extract_records(results)) == self.page1_results_cnt
+
+
+  def test_do_query_client_error(self):
+    client = FakeClient(self.page1_results_fyl, status_code=503)
+    with pytest.raises(req.RequestException) as re:
+      fetch.do_query('http://fake/bold', client=client)
+    assert re.value.response.status_code == 503
+
+
+  def test_do_query_cache(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      client = FakeClient(self.page1_results_fyl, cache=ResponseCache(cache_dir=tmpdir))
+      results1 = fetch.do_query('http://fake/bold?page=1', client=client)
+      results2 = fetch.do_query('http://fake/bold?page=1', client=client)
+      assert results1 == results2
+      assert client.urls == ['http://fake/bold?page=1']    # second served from cache
+      fetch.do_query('http://fake/bold?page=2', client=client)
+      assert len(client.urls) == 2
+
+
+  def test_do_query_cache_error(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      cache = ResponseCache(cache_dir=tmpdir)
+      client = FakeClient(self.page1_results_fyl, status_code=503, cache=cache)
+      with pytest.raises(req.RequestException):
+        fetch.do_query('http://fake/bold', client=client)
+      assert cache.entries() == []     # failures are not cached
+
+
+  def test_do_query_revalidate(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      cache = ResponseCache(cache_dir=tmpdir, refresh=True)   # never read without revalidating
+      client = FakeClient(self.page1_results_fyl, cache=cache, etag='"v1"')
+      results1 = fetch.do_query('http://fake/bold?page=1', client=client)
+      results2 = fetch.do_query('http://fake/bold?page=1', client=client)
+      assert results1 == results2
+      assert client.conditions == [None, '"v1"']           # second revalidated
+      assert cache.num_revalidated == 1
+      client.etag = '"v2"'                                  # the response has changed
+      fetch.do_query('http://fake/bold?page=1', client=client)
+      assert cache.num_revalidated == 1
+      assert cache.validators('http://fake/bold?page=1') == {'ETag': '"v2"'}
+
+
+  def test_query_for_page_revalidate(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      cache = ResponseCache(cache_dir=tmpdir, ttl=0)        # cached responses are always stale
+      client = FakeClient(self.page1_results_fyl, cache=cache, etag='"v1"')
+      recs1 = fetch.query_for_page('http://fake/bold', client=client)
+      time.sleep(0.01)
+      recs2 = fetch.query_for_page('http://fake/bold', client=client)
+      assert recs1 == recs2
+      assert len(recs2) == self.page1_results_cnt
+      assert client.conditions == [None, '"v1"']
+      assert cache.num_revalidated == 1
+
+
+  def test_query_for_page_client(self):
+    client = FakeClient(self.page1_results_fyl)
+    recs = fetch.query_for_page('http://fake/bold', client=client)
+    assert len(recs) == self.page1_results_cnt
+    assert 'bids_meta.RepetitionTime' in recs[0]
+
+
+  def test_query_for_page_cache(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      client = FakeClient(self.page1_results_fyl, cache=ResponseCache(cache_dir=tmpdir))
+      recs1 = fetch.query_for_page('http://fake/bold', client=client)
+      recs2 = fetch.query_for_page('http://fake/bold', client=client)
+      assert recs1 == recs2
+      assert len(recs2) == self.page1_results_cnt
+      assert client.urls == ['http://fake/bold']        # second served from cache
+      assert client.cache.get('http://fake/bold') == client.text
+
+
+  def test_stream_query_error(self):
+    client = FakeClient(self.page1_results_fyl, status_code=503)
+    with pytest.raises(req.RequestException) as re:
+      list(fetch.stream_query('http://fake/bold', client=client))
+    assert re.value.response.status_code == 503
+
+
+  def test_fetch_page_streamed(self):
+    with open(self.page1_results_fyl) as rfyl:
+      results = json.load(rfyl)
+    client = FakeClient(self.page1_results_fyl)
+    recs, meta = fetch.fetch_page('http://fake/bold', client=client)
+    assert meta == results['_meta']
+    assert recs == fetch.flatten_records(results['_items'])
+
+
+  def test_server_status_client(self):
+    client = FakeClient(self.page1_results_fyl)
+    total_recs = fetch.server_status('bold', client=client)
+    assert total_recs == self.page1_results_total
+    assert len(client.urls) == 1
+    assert 'max_results=1' in client.urls[0]
@@ -1,7 +1,8 @@
 # Tests of the MRIQC data fetcher library code.
 #   Written by: Tom Hicks and Dianne Patterson. 8/7/2021.
-#   Last Modified: Add test for some characters encoded in value strings.
+#   Last Modified: Add tests of keyset (cursor) pagination.
 #
+import csv
 import json
 import os
 import tempfile
@@ -11,9 +12,11 @@ import pytest
 import requests as req
 
 import qmtools.qmfetcher.fetcher as fetch
-from qmtools.qmfetcher import SERVER_PAGE_SIZE
+from qmtools.mriqc_keywords import STRUCTURAL_KEYWORDS
+from qmtools.qmfetcher import FETCH_WORKERS, SERVER_PAGE_SIZE
 from qmtools.qmfetcher.fetcher import SERVER_URL
 from tests import TEST_RESOURCES_DIR
+from tests.qmtools.qmfetcher.conftest import fake_created
 
 SYSEXIT_ERROR_CODE = 2                 # seems to be error exit code from argparse
 
@@ -181,7 +184,7 @@ class TestFetcher(object):
     qstr = fetch.build_query('bold', {'use_oldest': True})
     assert f"{SERVER_URL}/bold?max_results={SERVER_PAGE_SIZE}&page=1" in qstr
     assert 'sort=' not in qstr
-    assert '_created' not in qstr
+    assert '-_created' not in qstr
 
 
   def test_build_query_qps(self):
@@ -219,6 +222,51 @@ class TestFetcher(object):
     assert '"%20Sp\tTab"' in qstr
 
 
+  def test_build_query_projection(self):
+    qstr = fetch.build_query('bold', {})
+    assert 'projection={' in qstr
+    assert '"snr":1' in qstr
+    assert '"provenance.md5sum":1' in qstr
+    assert '"cjv":1' not in qstr
+    qstr = fetch.build_query('T1w', {'fields': ['cjv']})
+    assert qstr.endswith('&projection={"_created":1,"cjv":1,"provenance.md5sum":1}')
+
+
+  def test_build_query_keyset(self):
+    qstr = fetch.build_query('bold', {'keyset': True, 'fields': ['snr']})
+    assert 'sort=-_created,-_id' in qstr
+    assert 'where=' not in qstr
+    assert qstr.endswith('&projection={"_created":1,"_id":1,"provenance.md5sum":1,"snr":1}')
+    qstr = fetch.build_query('bold', {'keyset': True, 'use_oldest': True})
+    assert 'sort=_created,_id' in qstr
+
+
+  def test_build_query_keyset_after(self):
+    qparams = [ ['dummy_trs', '==0'] ]
+    cursor = (fake_created(3), '3')
+    qstr = fetch.build_query('bold', {'keyset': True, 'query_params': qparams}, after=cursor)
+    print(f"QUERY={qstr}")
+    assert 'page=1' in qstr
+    created = fake_created(3).replace(' ', '%20')
+    assert (f'where=dummy_trs==0%20and%20(_created<"{created}"%20or%20' +
+            f'(_created=="{created}"%20and%20_id<"3"))') in qstr
+    qstr = fetch.build_query('bold', {'keyset': True, 'use_oldest': True}, after=cursor)
+    assert f'where=(_created>"{created}"%20or%20' in qstr
+    qstr = fetch.build_query('bold', {'query_params': qparams}, after=cursor)
+    assert '_id' not in qstr.split('&projection=')[0]     # cursor unused without keyset
+
+
+  def test_record_key(self):
+    assert fetch.record_key({'_created': 'Sun', '_id': '7', 'snr': 3}) == ('Sun', '7')
+    with pytest.raises(ValueError):
+      fetch.record_key({'_created': 'Sun'})
+
+
+  def test_build_projection(self):
+    assert fetch.build_projection(['b', 'a']) == '{"a":1,"b":1}'
+    assert fetch.build_projection([]) == '{}'
+
+
   def test_clean_records_empty(self):
     with open(self.empty_results_fyl) as jfyl:
       results = json.load(jfyl)
@@ -240,6 +288,14 @@ class TestFetcher(object):
         assert rec.get(field) is None
 
 
+  def test_deduplicate_records_default(self, dedup_recs):
+    recs, chksums = fetch.deduplicate_records(dedup_recs)
+    assert len(recs) == 3
+    recs, chksums2 = fetch.deduplicate_records(dedup_recs)
+    assert len(recs) == 3              # a new set each time, not one shared set
+    assert chksums2 is not chksums
+
+
   def test_deduplicate_records_0_1st(self, dedup_recs):
     # Also tests is_not_duplicate
     recs, _ = fetch.deduplicate_records(dedup_recs, set())
@@ -382,6 +438,205 @@ class TestFetcher(object):
     assert 'aqi' not in d
 
 
+  def test_get_n_records_one_page(self, fake_server):
+    recs = fetch.get_n_records('bold', {'num_recs': 10})
+    assert len(recs) == 10
+    assert [rec['snr'] for rec in recs] == list(range(10))
+    assert fake_server['pages'] == [1]
+
+
+  def test_get_n_records_fields(self, fake_server):
+    recs = fetch.get_n_records('bold', {'num_recs': 60, 'fields': ['_id']})
+    assert len(recs) == 60
+    assert [int(rec['_id']) for rec in recs] == list(range(60))
+    assert set(recs[0].keys()) == set(['_created', '_id', 'provenance.md5sum'])
+
+
+  def test_get_fields_arg(self):
+    assert fetch.get_fields_arg('T1w', {}) == sorted(STRUCTURAL_KEYWORDS)
+    assert fetch.get_fields_arg('bold', {'fields': ['snr']}) == [
+      '_created', 'provenance.md5sum', 'snr' ]
+
+
+  def test_get_flattener(self):
+    assert fetch.get_flattener() is fetch.FLATTENER
+    flattener = fetch.get_flattener(['snr', '_id'])
+    assert fetch.get_flattener(['_id', 'snr']) is flattener
+    assert flattener.flatten({ '_id': 'X', 'snr': 1, 'bids_meta': { 'a': 2 } }) == { '_id': 'X', 'snr': 1 }
+
+
+  def test_get_n_records_page_meta(self, fake_server):
+    page_meta = {}
+    recs = fetch.get_n_records('bold', {'num_recs': 70}, page_meta=page_meta)
+    assert len(recs) == 70
+    assert page_meta['total'] == fake_server['total']
+    assert page_meta['page'] == 1
+
+
+  def test_get_n_records_concurrent(self, fake_server):
+    recs = fetch.get_n_records('bold', {'num_recs': 100, 'workers': 3})
+    assert len(recs) == 100
+    assert [rec['snr'] for rec in recs] == list(range(100))   # in server order
+    assert sorted(fake_server['pages']) == [1, 2]
+
+
+  def test_get_n_records_all(self, fake_server):
+    recs = fetch.get_n_records('bold', {'num_recs': 500, 'workers': 8})
+    assert len(recs) == fake_server['total']
+    assert [rec['snr'] for rec in recs] == list(range(fake_server['total']))
+    assert sorted(fake_server['pages']) == [1, 2, 6]   # last 20 records in a page of 20
+
+
+  def test_get_n_records_dups(self, fake_server):
+    fake_server['dups'] = 60           # second half of the records are duplicates
+    recs = fetch.get_n_records('bold', {'num_recs': 100, 'workers': 2})
+    assert len(recs) == 60
+    assert [rec['snr'] for rec in recs] == list(range(60))
+    assert sorted(fake_server['pages']) == [1, 2, 6]
+
+
+  def test_get_n_records_keyset(self, fake_server):
+    fake_server['total'] = 300
+    fake_server['tied'] = 7            # records created at the same time need the id tie-break
+    recs = fetch.get_n_records('bold', {'num_recs': 260, 'keyset': True, 'fields': ['snr']})
+    assert [rec['snr'] for rec in recs] == sorted(range(300), key=lambda num: (num // 7, -num))[:260]
+    assert fake_server['pages'] == [1] * 6          # never a deeper page
+    assert fake_server['wheres'][0] == ''
+    assert all('_id<' in where for where in fake_server['wheres'][1:])
+
+
+  def test_get_n_records_keyset_all(self, fake_server):
+    recs = fetch.get_n_records('bold', {'num_recs': 500, 'keyset': True, 'use_oldest': True})
+    assert [rec['snr'] for rec in recs] == list(reversed(range(120)))
+    assert len(fake_server['pages']) == 3           # the last page is short
+
+
+  def test_stream_n_records_keyset_resume(self, fake_server):
+    fake_server['total'] = 300
+    fake_server['fail_request'] = 4
+    args = {'num_recs': 260, 'keyset': True}
+    with tempfile.TemporaryDirectory() as tmpdir:
+      tmpfile = os.path.join(tmpdir, 'test.tsv')
+      with pytest.raises(req.RequestException):
+        fetch.stream_n_records('bold', args, tmpfile)
+      fake_server['fail_request'] = None
+      fake_server['wheres'] = []
+      num_written = fetch.stream_n_records('bold', args, tmpfile, resume=True)
+      assert num_written == 260
+      assert '_id<"149"' in fake_server['wheres'][0]   # continues after the last record written
+      with open(tmpfile) as tmpf:
+        rows = list(csv.DictReader(tmpf, delimiter='\t'))
+      assert [row['_id'] for row in rows] == [str(num) for num in range(260)]
+
+
+  def test_stream_n_records(self, fake_server):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      tmpfile = os.path.join(tmpdir, 'test.tsv')
+      num_written = fetch.stream_n_records('bold', {'num_recs': 75, 'workers': 2}, tmpfile)
+      assert num_written == 75
+      with open(tmpfile) as tmpf:
+        rows = list(csv.DictReader(tmpf, delimiter='\t'))
+      assert len(rows) == 75
+      assert 'provenance.md5sum' in rows[0]
+      assert [row['_id'] for row in rows] == [str(num) for num in range(75)]
+
+
+  def test_stream_n_records_norecs(self, fake_server):
+    fake_server['total'] = 0
+    with tempfile.TemporaryDirectory() as tmpdir:
+      tmpfile = os.path.join(tmpdir, 'test.tsv')
+      num_written = fetch.stream_n_records('bold', {'num_recs': 5}, tmpfile)
+      assert num_written == 0
+      assert not os.path.exists(tmpfile)
+
+
+  def test_stream_n_records_resume(self, fake_server):
+    fake_server['total'] = 300
+    fake_server['fail_page'] = 4
+    args = {'num_recs': 260, 'workers': 1}
+    with tempfile.TemporaryDirectory() as tmpdir:
+      tmpfile = os.path.join(tmpdir, 'test.tsv')
+      with pytest.raises(req.RequestException):
+        fetch.stream_n_records('bold', args, tmpfile)
+      assert os.path.exists(f"{tmpfile}.ckpt")
+
+      fake_server['fail_page'] = None
+      fake_server['pages'] = []
+      num_written = fetch.stream_n_records('bold', args, tmpfile, resume=True)
+      assert num_written == 260
+      # after one probe (page 2 of 150) to learn the page size, only records not yet written:
+      assert fake_server['pages'] == [2, 4, 5, 26]
+      assert not os.path.exists(f"{tmpfile}.ckpt")
+      with open(tmpfile) as tmpf:
+        rows = list(csv.DictReader(tmpf, delimiter='\t'))
+      assert [row['_id'] for row in rows] == [str(num) for num in range(260)]
+
+
+  def test_stream_n_records_resume_nockpt(self, fake_server):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      tmpfile = os.path.join(tmpdir, 'test.tsv')
+      num_written = fetch.stream_n_records('bold', {'num_recs': 70}, tmpfile, resume=True)
+      assert num_written == 70
+      assert fake_server['pages'] == [1, 3]           # then the last 20 from a page of 25
+
+
+  def test_stream_n_records_resume_badquery(self, fake_server):
+    fake_server['fail_page'] = 2
+    with tempfile.TemporaryDirectory() as tmpdir:
+      tmpfile = os.path.join(tmpdir, 'test.tsv')
+      with pytest.raises(req.RequestException):
+        fetch.stream_n_records('bold', {'num_recs': 100}, tmpfile)
+      with pytest.raises(ValueError) as ve:
+        fetch.stream_n_records('T1w', {'num_recs': 100}, tmpfile, resume=True)
+      assert 'different query' in str(ve)
+
+
+  def test_read_sync_state(self, fake_server):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      tmpfile = os.path.join(tmpdir, 'test.tsv')
+      fetch.stream_n_records('bold', {'num_recs': 30, 'use_oldest': True}, tmpfile)
+      newest, chksums = fetch.read_sync_state(tmpfile)
+      assert newest == fake_created(0)
+      assert len(chksums) == 30
+
+
+  def test_sync_records(self, fake_server):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      tmpfile = os.path.join(tmpdir, 'test.tsv')
+      fetch.stream_n_records('bold', {'num_recs': 50}, tmpfile)
+      fake_server['start'] = -10        # ten newer records have been added
+      fake_server['total'] = 130
+      fake_server['pages'] = []
+      num_added = fetch.sync_records('bold', {'num_recs': 5}, tmpfile)
+      assert num_added == 10
+      assert fake_server['pages'] == [1]
+      with open(tmpfile) as tmpf:
+        rows = list(csv.DictReader(tmpf, delimiter='\t'))
+      assert len(rows) == 60
+      assert [row['_id'] for row in rows[50:]] == [str(num) for num in range(-10, 0)]
+      assert fetch.sync_records('bold', {}, tmpfile) == 0    # already up to date
+
+
+  def test_sync_records_many(self, fake_server):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      tmpfile = os.path.join(tmpdir, 'test.tsv')
+      fetch.stream_n_records('bold', {'num_recs': 20}, tmpfile)
+      fake_server['start'] = -200
+      fake_server['total'] = 320
+      num_added = fetch.sync_records('bold', {'workers': 3}, tmpfile)
+      assert num_added == 200
+      newest, chksums = fetch.read_sync_state(tmpfile)
+      assert newest == fake_created(-200)
+      assert len(chksums) == 220
+
+
+  def test_get_workers_arg(self):
+    assert fetch.get_workers_arg({}) == FETCH_WORKERS
+    assert fetch.get_workers_arg({'workers': 0}) == FETCH_WORKERS
+    assert fetch.get_workers_arg({'workers': None}) == FETCH_WORKERS
+    assert fetch.get_workers_arg({'workers': 7}) == 7
+
+
   def test_query_for_page_bad_query(self):
     with pytest.raises(req.RequestException) as re:
       fetch.query_for_page('BAD_QUERY')
@@ -1,18 +1,33 @@
 # Tests of the MRIQC data fetcher CLI code.
 #   Written by: Tom Hicks and Dianne Patterson. 8/4/2021.
-#   Last Modified: Remove unused libraries.
+#   Last Modified: Add tests of fetching a random sample of the matching records.
 #
+import csv
+import json
+import os
 import pytest
+import requests as req
 import sys
+import tempfile
 from pathlib import Path
 
-from qmtools import ALLOWED_MODALITIES, FETCHED_DIR, NUM_RECS_EXIT_CODE, QUERY_FILE_EXIT_CODE
+from qmtools import (ALLOWED_MODALITIES, FETCHED_DIR, NUM_RECS_EXIT_CODE, NUM_SAMPLES_EXIT_CODE,
+                     NUM_SHARDS_EXIT_CODE, OUTPUT_FIELDS_EXIT_CODE, OUTPUT_FILE_EXIT_CODE,
+                     QUERY_FILE_EXIT_CODE)
 from qmtools.qmfetcher.fetcher import SERVER_URL
 import qmtools.qmfetcher.fetcher_cli as cli
+import qmtools.qmfetcher.writers as writers
+from qmtools.qm_utils import load_tsv
 from tests import TEST_RESOURCES_DIR
 
 SYSEXIT_ERROR_CODE = 2                 # seems to be error exit code from argparse
 
+@pytest.fixture
+def popdir(request):
+  yield
+  os.chdir(request.config.invocation_dir)
+
+
 class TestFetcherCLI(object):
 
   bold_test_fyl    = f"{TEST_RESOURCES_DIR}/bold_test.tsv"
@@ -37,6 +52,36 @@ class TestFetcherCLI(object):
     assert se.value.code == QUERY_FILE_EXIT_CODE
 
 
+  def test_check_fields(self):
+    cli.check_fields('bold', ['snr', 'provenance.md5sum'])      # does not exit
+    with pytest.raises(SystemExit) as se:
+      cli.check_fields('T1w', ['cjv', 'snr'])
+    assert se.value.code == OUTPUT_FIELDS_EXIT_CODE
+
+
+  def test_check_format(self, monkeypatch):
+    cli.check_format('tsv', appending=True)                  # does not exit
+    cli.check_format('tsv.gz')
+    with pytest.raises(SystemExit) as se:
+      cli.check_format('tsv.gz', appending=True)
+    assert se.value.code == OUTPUT_FILE_EXIT_CODE
+    monkeypatch.setattr(writers, 'pa', None)
+    with pytest.raises(SystemExit) as se:
+      cli.check_format('parquet')
+    assert se.value.code == OUTPUT_FILE_EXIT_CODE
+
+
+  def test_check_unavailable(self):
+    cli.check_unavailable(req.HTTPError('no response'))      # does not exit
+    resp = req.Response()
+    resp.status_code = 500
+    cli.check_unavailable(req.HTTPError('500 Error', response=resp))
+    resp.status_code = 503
+    with pytest.raises(SystemExit) as se:
+      cli.check_unavailable(req.HTTPError('503 Error', response=resp))
+    assert se.value.code == 503
+
+
   def test_check_num_recs_zero(self):
     with pytest.raises(SystemExit) as se:
       cli.check_num_recs(0)
@@ -49,6 +94,57 @@ class TestFetcherCLI(object):
     assert se.value.code == NUM_RECS_EXIT_CODE
 
 
+  def test_check_resume_nofile(self):
+    with pytest.raises(SystemExit) as se:
+      cli.check_resume(None)
+    assert se.value.code == OUTPUT_FILE_EXIT_CODE
+
+
+  def test_check_sample(self):
+    cli.check_sample(10, {})           # does not exit
+    with pytest.raises(SystemExit) as se:
+      cli.check_sample(0, {})
+    assert se.value.code == NUM_SAMPLES_EXIT_CODE
+    with pytest.raises(SystemExit) as se:
+      cli.check_sample(10, {'shards': 2})
+    assert se.value.code == NUM_SAMPLES_EXIT_CODE
+
+
+  def test_check_shards(self):
+    cli.check_shards(4, {})            # does not exit
+    with pytest.raises(SystemExit) as se:
+      cli.check_shards(0, {})
+    assert se.value.code == NUM_SHARDS_EXIT_CODE
+    with pytest.raises(SystemExit) as se:
+      cli.check_shards(4, {'stream': True})
+    assert se.value.code == NUM_SHARDS_EXIT_CODE
+
+
+  def test_check_sync_nofile(self):
+    with pytest.raises(SystemExit) as se:
+      cli.check_sync('NO_SUCH', self.nosuch_test_fyl)
+    assert se.value.code == OUTPUT_FILE_EXIT_CODE
+    with pytest.raises(SystemExit) as se:
+      cli.check_sync(None, self.bold_test_fyl)
+    assert se.value.code == OUTPUT_FILE_EXIT_CODE
+
+
+  def test_get_modalities(self):
+    assert cli.get_modalities(['T1w']) == ['T1w']
+    assert cli.get_modalities(['T2w', 'bold', 'T2w']) == ['T2w', 'bold']
+    assert cli.get_modalities(['all']) == ALLOWED_MODALITIES
+    assert cli.get_modalities(['T2w', 'all']) == ['T2w', 'bold', 'T1w']
+
+
+  def test_get_output_filepath(self):
+    assert cli.get_output_filepath('bold', 'test', '.tsv') == f"{FETCHED_DIR}/test.tsv"
+    assert cli.get_output_filepath('bold', 'test.tsv', '.tsv', multiple=True) == f"{FETCHED_DIR}/test_bold.tsv"
+    assert cli.get_output_filepath('T1w', 'test', '.tsv.gz', multiple=True) == f"{FETCHED_DIR}/test_T1w.tsv.gz"
+    genpath = cli.get_output_filepath('T2w', None, '.tsv', multiple=True)
+    assert genpath.startswith(f"{FETCHED_DIR}/T2w_")
+    assert genpath.endswith('.tsv')
+
+
   def test_main_noargs(self, capsys):
     with pytest.raises(SystemExit) as se:
       cli.main()
@@ -132,3 +228,194 @@ class TestFetcherCLI(object):
     assert SERVER_URL in sysout
     assert '/bold' in sysout
     assert 'sort=' not in sysout
+
+
+  def test_main_fetch(self, capsys, fake_server, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      sys.argv = [ 'qmtools', '-v', 'bold', '-n', '60', '-o', 'test' ]
+      cli.main()
+      sysout, syserr = capsys.readouterr()
+      print(f"CAPTURED SYS.OUT:\n{sysout}")
+      print(f"CAPTURED SYS.ERR:\n{syserr}")
+      assert 'Fetched 60 records out of 120' in sysout
+      assert fake_server['pages'] == [1, 6]     # no separate health check query
+      tstfile = f"{FETCHED_DIR}/test.tsv"
+      assert f"Saved query results to '{tstfile}'" in syserr
+      with open(tstfile) as tstf:
+        lines = tstf.readlines()
+      assert len(lines) == 61
+
+
+  def test_main_urlonly_multi(self, capsys):
+    with pytest.raises(SystemExit) as se:
+      sys.argv = [ 'qmtools', 'bold', 'T1w', '-n', '4', '--url-only' ]
+      cli.main()
+    assert se.value.code == 0
+    sysout, syserr = capsys.readouterr()
+    urls = sysout.splitlines()
+    assert len(urls) == 2
+    assert '/bold?' in urls[0]
+    assert '/T1w?' in urls[1]
+
+
+  def test_main_fetch_all(self, capsys, fake_server, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      sys.argv = [ 'qmtools', 'all', '-n', '30', '-o', 'test' ]
+      cli.main()
+      sysout, syserr = capsys.readouterr()
+      print(f"CAPTURED SYS.OUT:\n{sysout}")
+      for modality in ALLOWED_MODALITIES:
+        tstfile = f"{FETCHED_DIR}/test_{modality}.tsv"
+        assert f"Fetched 30 {modality} records out of 120" in sysout
+        assert f"into '{tstfile}'" in sysout
+        with open(tstfile) as tstf:
+          lines = tstf.readlines()
+        assert len(lines) == 31
+      assert 'Fetched 90 records of 3 modalities' in sysout
+      assert len(fake_server['pages']) == 3    # one page for each modality
+
+
+  def test_main_shards(self, capsys, fake_server, popdir):
+    fake_server['total'] = 300
+    with tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      sys.argv = [ 'qmtools', '-v', 'bold', '-n', '200', '-o', 'test', '--shards', '4' ]
+      cli.main()
+      sysout, syserr = capsys.readouterr()
+      assert 'Fetched 200 records out of 300' in sysout
+      with open(f"{FETCHED_DIR}/test.tsv") as tstf:
+        rows = list(csv.DictReader(tstf, delimiter='\t'))
+      assert [row['snr'] for row in rows] == [str(num) for num in range(200)]
+
+
+  def test_main_sample(self, capsys, fake_server, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      cli.main([ 'bold', '-v', '-o', 'test', '--sample', '30', '--seed', '11' ])
+      sysout, syserr = capsys.readouterr()
+      assert 'Fetched 30 records out of 120' in sysout
+      assert 'Sampled records at random with seed 11' in syserr
+      with open(f"{FETCHED_DIR}/test.tsv") as tstf:
+        snrs1 = [row['snr'] for row in csv.DictReader(tstf, delimiter='\t')]
+      assert len(set(snrs1)) == 30
+      cli.main([ 'bold', '-o', 'test', '--sample', '30' ])
+      sysout, syserr = capsys.readouterr()
+      seed = int(syserr.strip().split('seed ')[-1].rstrip('.'))   # a new seed is reported
+      cli.main([ 'bold', '-o', 'again', '--sample', '30', '--seed', str(seed) ])
+      with open(f"{FETCHED_DIR}/test.tsv") as tstf, open(f"{FETCHED_DIR}/again.tsv") as agf:
+        assert tstf.read() == agf.read()                  # reproduced by the seed
+
+
+  def test_main_check(self, capsys, fake_server, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      with pytest.raises(SystemExit) as se:
+        sys.argv = [ 'qmtools', 'bold', '--check' ]
+        cli.main()
+      assert se.value.code == 0
+      sysout, syserr = capsys.readouterr()
+      assert 'MRIQC server is up: 120 records match the query' in sysout
+      assert fake_server['pages'] == [1]
+      assert not [name for name in os.listdir(FETCHED_DIR) if name.endswith('.tsv')]
+
+
+  def test_main_fetch_fields(self, capsys, fake_server, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      sys.argv = [ 'qmtools', 'bold', '-n', '20', '-o', 'test', '-f', '_id, snr' ]
+      cli.main()
+      with open(f"{FETCHED_DIR}/test.tsv") as tstf:
+        lines = tstf.readlines()
+      assert len(lines) == 21
+      assert lines[0] == '_created\t_id\tprovenance.md5sum\tsnr\n'
+
+
+  def test_main_index(self, capsys, fake_server, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      sys.argv = [ 'qmtools', 'bold', '-n', '20', '-o', 'test1', '--index' ]
+      cli.main()
+      assert os.path.exists(f"{FETCHED_DIR}/md5sums.idx")
+      sys.argv = [ 'qmtools', '-v', 'bold', '-n', '20', '-o', 'test2', '--index' ]
+      cli.main()
+      sysout, syserr = capsys.readouterr()
+      assert "holds 40 records" in syserr
+      with open(f"{FETCHED_DIR}/test2.tsv") as tstf:
+        rows = list(csv.DictReader(tstf, delimiter='\t'))
+      assert [row['snr'] for row in rows] == [str(num) for num in range(20, 40)]
+
+
+  def test_main_format_gzip(self, capsys, fake_server, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      sys.argv = [ 'qmtools', 'bold', '-n', '60', '-o', 'test', '--format', 'tsv.gz' ]
+      cli.main()
+      qm_df = load_tsv(f"{FETCHED_DIR}/test.tsv.gz")
+      assert qm_df['snr'].tolist() == list(range(60))
+
+
+  def test_main_format_by_ext(self, capsys, fake_server, popdir):
+    pytest.importorskip('pyarrow')
+    with tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      sys.argv = [ 'qmtools', 'bold', '-n', '60', '-o', 'test.parquet', '--stream' ]
+      cli.main()
+      qm_df = load_tsv(f"{FETCHED_DIR}/test.parquet")
+      assert qm_df['snr'].tolist() == list(range(60))
+      assert str(qm_df['snr'].dtype) == 'float64'
+
+
+  def test_main_stream(self, capsys, fake_server, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      sys.argv = [ 'qmtools', '-v', 'bold', '-n', '110', '-o', 'test', '--stream', '-w', '2' ]
+      cli.main()
+      sysout, syserr = capsys.readouterr()
+      print(f"CAPTURED SYS.OUT:\n{sysout}")
+      print(f"CAPTURED SYS.ERR:\n{syserr}")
+      assert 'Fetched 110 records out of 120' in sysout
+      with open(f"{FETCHED_DIR}/test.tsv") as tstf:
+        lines = tstf.readlines()
+      assert len(lines) == 111
+
+
+  def test_main_resume(self, capsys, fake_server, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      sys.argv = [ 'qmtools', '-v', 'bold', '-n', '100', '-o', 'test', '--resume' ]
+      cli.main()
+      sysout, syserr = capsys.readouterr()
+      assert 'Fetched 100 records out of 120' in sysout
+      assert os.path.exists(f"{FETCHED_DIR}/test.tsv")
+      assert not os.path.exists(f"{FETCHED_DIR}/test.tsv.ckpt")
+
+
+  def test_main_sync(self, capsys, fake_server, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      sys.argv = [ 'qmtools', 'bold', '-n', '40', '-o', 'test' ]
+      cli.main()
+      fake_server['start'] = -5
+      sys.argv = [ 'qmtools', '-v', 'bold', '-o', 'test', '--sync' ]
+      cli.main()
+      sysout, syserr = capsys.readouterr()
+      assert 'Fetched 5 records' in sysout
+      with open(f"{FETCHED_DIR}/test.tsv") as tstf:
+        lines = tstf.readlines()
+      assert len(lines) == 46
+
+
+  def test_main_stats_json(self, capsys, fake_server, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      cli.main([ 'bold', '-v', '-n', '60', '-o', 'test', '--stats-json', 'stats.json' ])
+      sysout, syserr = capsys.readouterr()
+      assert 'Fetched 60 records out of 120' in sysout
+      assert "Saved fetch statistics to 'stats.json'" in syserr
+      with open('stats.json') as jsonfile:
+        report = json.load(jsonfile)
+      assert report['totals']['pages'] == 2
+      assert report['totals']['written'] == 60
+      assert report['stages']['write']['count'] == 1
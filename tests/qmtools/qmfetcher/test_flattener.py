@@ -0,0 +1,80 @@
+# Tests of the schema-caching record flattener.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Add tests for dropping unwanted fields while flattening.
+#
+import json
+
+import qmtools.qmfetcher.fetcher as fetch
+from qmtools.qmfetcher.flattener import RecordFlattener
+from tests import TEST_RESOURCES_DIR
+
+
+class TestFlattener(object):
+
+  page_fyl = f"{TEST_RESOURCES_DIR}/api_bold_50.json"
+
+  def get_recs(self):
+    with open(self.page_fyl) as jfyl:
+      return json.load(jfyl)['_items']
+
+
+  def test_flatten_equivalent(self):
+    recs = self.get_recs()
+    flattener = RecordFlattener()
+    for rec in recs:
+      flat = flattener.flatten(rec)
+      expected = dict(fetch.flatten_a_record(rec))
+      assert flat == expected
+      assert list(flat.keys()) == list(expected.keys())
+
+
+  def test_flatten_records_equivalent(self):
+    recs = self.get_recs()
+    assert RecordFlattener().flatten_records(recs) == [dict(fetch.flatten_a_record(rec)) for rec in recs]
+    assert fetch.flatten_records(recs) == [dict(fetch.flatten_a_record(rec)) for rec in recs]
+
+
+  def test_flatten_varying_layout(self):
+    flattener = RecordFlattener()
+    rec1 = { 'a': 1, 'b': { 'c': 2, 'd': { 'e': 3 } }, 'f': 4 }
+    rec2 = { 'b': 5, 'a': { 'x': {}, 'y': 6 }, 'g': { 'c': 7 } }
+    rec3 = { 'b': { 'd': { 'e': 8, 'z': 9 } } }
+    for rec in [rec1, rec2, rec3, rec1]:
+      flat = flattener.flatten(rec)
+      assert list(flat.items()) == fetch.flatten_a_record(rec)
+
+
+  def test_flatten_sep(self):
+    flattener = RecordFlattener(sep='/')
+    flat = flattener.flatten({ 'a': { 'b': { 'c': 1 } }, 'd': 2 })
+    assert flat == { 'a/b/c': 1, 'd': 2 }
+
+
+  def test_flatten_shares_keys(self):
+    flattener = RecordFlattener()
+    recs = self.get_recs()
+    keys1 = list(flattener.flatten(recs[0]).keys())
+    keys2 = list(flattener.flatten(recs[1]).keys())
+    shared = [key for key in keys1 if key in keys2]
+    for key in shared:
+      assert next(k2 for k2 in keys2 if k2 == key) is key
+
+
+  def test_flatten_keep(self):
+    keep = ['_id', 'provenance.md5sum', 'provenance.settings.fd_thres', 'bids_meta.TaskName']
+    flattener = RecordFlattener(keep=keep)
+    for rec in self.get_recs():
+      expected = { key: val for (key, val) in fetch.flatten_a_record(rec) if key in keep }
+      assert flattener.flatten(rec) == expected
+    assert flattener.root.child('_links') is None    # skipped, without being walked
+
+
+  def test_flatten_keep_dict(self):
+    flattener = RecordFlattener(keep=['a', 'b.c'])
+    flat = flattener.flatten({ 'a': { 'x': 1, 'y': { 'z': 2 } }, 'b': { 'c': 3, 'd': 4 }, 'e': 5 })
+    assert flat == { 'a.x': 1, 'a.y.z': 2, 'b.c': 3 }
+
+
+  def test_flatten_empty(self):
+    assert RecordFlattener().flatten({}) == {}
+    assert RecordFlattener().flatten({ 'a': {} }) == {}
@@ -0,0 +1,71 @@
+# Tests of the incremental parser of pages of query results.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Initial creation.
+#
+import json
+
+import pytest
+
+from qmtools.qmfetcher.json_stream import PageStream
+from tests import TEST_RESOURCES_DIR
+
+
+def chunked (text, size):
+  "Return the given text split into chunks of the given size."
+  return [text[start:start + size] for start in range(0, len(text), size)]
+
+
+class TestJsonStream(object):
+
+  page_fyl = f"{TEST_RESOURCES_DIR}/api_bold_10.json"
+  empty_fyl = f"{TEST_RESOURCES_DIR}/no_results.json"
+
+  def test_page_chunk_sizes(self):
+    with open(self.page_fyl) as jfyl:
+      text = jfyl.read()
+    page = json.loads(text)
+    for size in [1, 7, 1000, len(text)]:
+      stream = PageStream(chunked(text, size))
+      assert list(stream) == page['_items']
+      assert stream.fields['_meta'] == page['_meta']
+      assert stream.fields['_links'] == page['_links']
+
+
+  def test_page_items_last(self):
+    text = json.dumps({ '_meta': { 'total': 1234 }, '_items': [12, 3.5, True, None, 'x'] })
+    stream = PageStream(chunked(text, 3))
+    assert list(stream) == [12, 3.5, True, None, 'x']
+    assert stream.fields == { '_meta': { 'total': 1234 } }
+
+
+  def test_page_empty(self):
+    with open(self.empty_fyl) as jfyl:
+      text = jfyl.read()
+    stream = PageStream(chunked(text, 16))
+    assert list(stream) == []
+    assert stream.fields['_meta']['total'] == 0
+    assert list(PageStream(['  {  }  '])) == []
+
+
+  def test_page_yields_incrementally(self):
+    chunks = iter(['{"_items": [{"a": 1}, ', '{"a": 2}', ']}'])
+    stream = iter(PageStream(chunks))
+    assert next(stream) == {'a': 1}
+    assert next(chunks) == '{"a": 2}'  # second record not yet read
+
+
+  def test_page_consumes_all_chunks(self):
+    chunks = iter(['{"_items": []}', '  \n'])
+    assert list(PageStream(chunks)) == []
+    assert next(chunks, None) is None
+
+
+  def test_page_malformed(self):
+    with pytest.raises(ValueError):
+      list(PageStream(['[1, 2]']))
+    with pytest.raises(ValueError):
+      list(PageStream(['{"_items": [1, 2']))
+    with pytest.raises(ValueError):
+      list(PageStream(['{"_items": [1 2]}']))
+    with pytest.raises(ValueError):
+      list(PageStream(['{"_items": []} junk']))
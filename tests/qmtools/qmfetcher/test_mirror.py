@@ -0,0 +1,121 @@
+# Tests of the local SQLite mirror of fetched MRIQC records.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Initial creation.
+#
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+
+import qmtools.qmfetcher.fetcher as fetch
+import qmtools.qmfetcher.fetcher_cli as cli
+import qmtools.qmfetcher.mirror as qmm
+from qmtools import FETCHED_DIR
+from qmtools.qmfetcher.query_parser import parse_query_from_file
+from tests import TEST_RESOURCES_DIR
+
+
+@pytest.fixture
+def popdir(request):
+  yield
+  os.chdir(request.config.invocation_dir)
+
+
+@pytest.fixture
+def flrecs():
+  "The flattened records of a page of bold records."
+  with open(f"{TEST_RESOURCES_DIR}/api_bold_50.json") as jfyl:
+    return fetch.flatten_records(fetch.extract_records(json.load(jfyl)))
+
+
+class TestMirror(object):
+
+  manmaf_query_fyl = f"{TEST_RESOURCES_DIR}/manmaf.qp"
+
+  def test_parse_sql_value(self):
+    assert qmm.parse_sql_value('"Siemens"') == 'Siemens'
+    assert qmm.parse_sql_value("'GE'") == 'GE'
+    assert qmm.parse_sql_value('3') == 3
+    assert qmm.parse_sql_value('2.5') == 2.5
+    assert qmm.parse_sql_value('true') == 'True'
+    assert qmm.parse_sql_value('abc') == 'abc'
+
+
+  def test_criterion_to_sql(self):
+    assert qmm.criterion_to_sql('snr', '>5') == ('"snr" > ?', 5)
+    assert qmm.criterion_to_sql('bids_meta.Manufacturer', '=="Siemens"') == \
+      ('"bids_meta.Manufacturer" = ?', 'Siemens')
+    assert qmm.criterion_to_sql('fber', '<=1.5') == ('"fber" <= ?', 1.5)
+    cond, value = qmm.criterion_to_sql('_created', '>="Sat, 30 Sep 2017 14:43:11 GMT"')
+    assert cond == '"_created_ts" >= ?'
+    assert value == 1506782591.0
+    with pytest.raises(ValueError):
+      qmm.criterion_to_sql('snr', '~5')
+
+
+  def test_add_records(self, flrecs):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with qmm.RecordMirror(os.path.join(tmpdir, 'mirror.sqlite')) as mirror:
+        assert mirror.count('bold') == 0
+        assert mirror.add_records('bold', flrecs) == len(flrecs)
+        assert mirror.add_records('bold', flrecs) == 0     # duplicates are ignored
+        assert mirror.add_records('bold', [{'_id': 'NO_CHECKSUM'}]) == 0
+        assert mirror.count('bold') == len(flrecs)
+        assert mirror.count('T1w') == 0
+
+
+  def test_query_same_as_tsv(self, flrecs):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with qmm.RecordMirror(os.path.join(tmpdir, 'mirror.sqlite')) as mirror:
+        mirror.add_records('bold', flrecs)
+        recs = mirror.query('bold', {'num_recs': 100, 'use_oldest': True})
+        assert len(recs) == len(flrecs)
+        fetched_fyl = os.path.join(tmpdir, 'fetched.tsv')
+        mirror_fyl = os.path.join(tmpdir, 'mirror.tsv')
+        ordered = sorted(flrecs, key=lambda rec: qmm.created_timestamp(rec['_created']))
+        fetch.save_to_tsv('bold', ordered, fetched_fyl)
+        fetch.save_to_tsv('bold', recs, mirror_fyl)
+        with open(fetched_fyl) as ffyl, open(mirror_fyl) as mfyl:
+          assert ffyl.read() == mfyl.read()
+
+
+  def test_query_criteria(self, flrecs):
+    query_params = parse_query_from_file('bold', self.manmaf_query_fyl)
+    expected = [ rec for rec in flrecs
+                 if ((rec.get('bids_meta.Manufacturer') == 'Siemens') and
+                     (rec.get('bids_meta.MultibandAccelerationFactor', 0) > 3)) ]
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with qmm.RecordMirror(os.path.join(tmpdir, 'mirror.sqlite')) as mirror:
+        mirror.add_records('bold', flrecs)
+        recs = mirror.query('bold', {'query_params': query_params, 'num_recs': 100})
+        assert set(rec['_id'] for rec in recs) == set(rec['_id'] for rec in expected)
+        created = [qmm.created_timestamp(rec['_created']) for rec in recs]
+        assert created == sorted(created, reverse=True)    # most recent first
+        recs = mirror.query('bold', {'query_params': query_params, 'num_recs': 2})
+        assert len(recs) == min(2, len(expected))
+
+
+  def test_main_mirror(self, capsys, fake_server, popdir):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      os.chdir(tmpdir)
+      sys.argv = [ 'qmfetcher', 'mirror', '-v', 'bold', '-n', '100' ]
+      cli.main()
+      sysout, syserr = capsys.readouterr()
+      assert 'Added 100 new records' in sysout
+      sys.argv = [ 'qmfetcher', 'mirror', '-v', 'bold', '-n', '120' ]
+      cli.main()
+      sysout, syserr = capsys.readouterr()
+      assert 'Added 20 new records' in sysout
+      assert 'holds 120 bold records' in sysout
+      fake_server['pages'] = []
+
+      sys.argv = [ 'qmfetcher', 'mirror', '-v', 'bold', '-n', '10', '--offline', '-o', 'test' ]
+      cli.main()
+      sysout, syserr = capsys.readouterr()
+      assert fake_server['pages'] == []          # the server was not contacted
+      assert 'Selected 10 records out of 120' in sysout
+      with open(f"{FETCHED_DIR}/test.tsv") as tstf:
+        lines = tstf.readlines()
+      assert len(lines) == 11
@@ -0,0 +1,85 @@
+# Tests of the adaptive sizing of the pages requested from the MRIQC server.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Initial creation.
+#
+import qmtools.qmfetcher.fetcher as fetch
+from qmtools.qmfetcher import MAX_PAGE_SIZE, SERVER_PAGE_SIZE
+from qmtools.qmfetcher.page_sizer import PageSizer
+
+
+class TestPageSizer(object):
+
+  def test_choose_first(self):
+    sizer = PageSizer()
+    assert sizer.choose(0) == (1, MAX_PAGE_SIZE, 0)
+    assert sizer.choose(0, 730) == (1, 730, 0)
+    assert sizer.choose(0, 5000) == (1, MAX_PAGE_SIZE, 0)
+
+
+  def test_choose_aligned(self):
+    sizer = PageSizer(max_size=50)
+    assert sizer.choose(100) == (3, 50, 0)
+    assert sizer.choose(150, 500) == (4, 50, 0)
+    assert sizer.choose(30) == (2, 30, 0)            # more new records than (1, 50, 30)
+
+
+  def test_choose_final(self):
+    sizer = PageSizer(max_size=50)
+    assert sizer.choose(100, 10) == (11, 10, 0)      # exactly the records wanted
+    assert sizer.choose(50, 20) == (3, 24, 2)        # fetches 22 for the 20 wanted
+    assert sizer.choose(45, 5) == (10, 5, 0)
+    page_num, size, skip = sizer.choose(49, 30)      # skips the fewest records possible
+    assert (page_num - 1) * size + skip == 49
+    assert size - skip >= 30
+
+
+  def test_observe_capped(self):
+    sizer = PageSizer()
+    sizer.observe(730, SERVER_PAGE_SIZE, SERVER_PAGE_SIZE, 0.5)
+    assert sizer.honored_size == SERVER_PAGE_SIZE
+    assert sizer.target_size() == SERVER_PAGE_SIZE
+    sizer.observe(20, 20, 20, 0.1)                   # smaller requests are not caps
+    assert sizer.target_size() == SERVER_PAGE_SIZE
+    assert sizer.num_pages == 2
+
+
+  def test_observe_slow(self):
+    sizer = PageSizer(max_size=50, read_timeout=10, time_budget=0.5, smoothing=0.5)
+    sizer.observe(50, 50, 50, 1.0)                   # 20 ms per record: within budget
+    assert sizer.target_size() == 50
+    sizer.observe(50, 50, 50, 49.0)                  # now ~0.5 sec per record
+    assert sizer.secs_per_rec == 0.5
+    assert sizer.target_size() == 10                 # 10 records in the 5 sec budget
+    sizer.observe(50, 50, 0, 99.0)                   # empty pages tell nothing of records
+    assert sizer.target_size() == 10
+
+
+  def test_summary(self):
+    sizer = PageSizer()
+    assert 'unknown' in sizer.summary()
+    sizer.observe(100, 50, 50, 0.5)
+    assert 'page size 50' in sizer.summary()
+    assert '10.0 ms per record over 1 pages' in sizer.summary()
+
+
+  def test_gen_record_pages_offsets(self, fake_server):
+    sizer = PageSizer()
+    pages = list(fetch.gen_n_record_pages('bold', {'num_recs': 95, 'workers': 2}, sizer=sizer))
+    assert [offset for (offset, _) in pages] == [50, 96]   # page 2 of 48, less 2 skipped
+    assert [rec['snr'] for (_, recs) in pages for rec in recs] == list(range(95))
+    assert fake_server['pages'] == [1, 2]
+    assert sizer.honored_size == SERVER_PAGE_SIZE
+
+
+  def test_gen_record_pages_more(self, fake_server):
+    pages = list(fetch.gen_record_pages('bold', {'num_recs': 10, 'workers': 2}))
+    # the size cap is learned from a page 1 of 1000 which falls short, at 50 records:
+    assert [offset for (offset, _) in pages] == [10, 50, 100, 120]
+    assert fake_server['pages'] == [1, 1, 2, 6]
+    assert [rec['snr'] for (_, recs) in pages for rec in recs] == list(range(120))
+
+
+  def test_gen_record_pages_first_offset(self, fake_server):
+    pages = list(fetch.gen_n_record_pages('bold', {'num_recs': 30}, first_offset=60))
+    assert [rec['snr'] for (_, recs) in pages for rec in recs] == list(range(60, 90))
+    assert pages[-1][0] == 90
@@ -0,0 +1,99 @@
+# Tests of running the stages of a fetch concurrently, connected by bounded queues.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Initial creation.
+#
+import threading
+import time
+
+import pytest
+
+from qmtools.qmfetcher.pipeline import PagePipeline
+from qmtools.qmfetcher.stats import FetchStats
+
+
+def gen_pages (num_pages, page_size=10, pulled=None, closed=None, fail_at=None):
+  """
+  Generator of (offset, page of records) tuples, whose records are numbers, which
+  records the numbers of the pages pulled and whether it was closed.
+  """
+  try:
+    for page_num in range(num_pages):
+      if (page_num == fail_at):
+        raise ValueError(f"Page {page_num} failed")
+      if (pulled is not None):
+        pulled.append(page_num)
+      recs = list(range(page_num * page_size, (page_num + 1) * page_size))
+      yield ((page_num + 1) * page_size, recs)
+  finally:
+    if (closed is not None):
+      closed.set()
+
+
+def is_new (seen):
+  "Return a predicate which is True for the records not yet seen, adding them to the given set."
+  def check (rec):
+    if (rec in seen):
+      return False
+    seen.add(rec)
+    return True
+  return check
+
+
+class TestPipeline(object):
+
+  def test_pipeline(self):
+    closed = threading.Event()
+    pages = list(PagePipeline(gen_pages(5, closed=closed), 100, is_new(set())))
+    assert [offset for (offset, _) in pages] == [10, 20, 30, 40, 50]
+    assert [rec for (_, recs) in pages for rec in recs] == list(range(50))
+    assert closed.is_set()
+
+
+  def test_pipeline_wanted(self):
+    pulled = []
+    pages = list(PagePipeline(gen_pages(10, pulled=pulled), 25, is_new(set())))
+    assert [rec for (_, recs) in pages for rec in recs] == list(range(25))
+    assert pulled == [0, 1, 2]         # no pages pulled beyond those wanted
+
+
+  def test_pipeline_dups(self):
+    pulled = []
+    stats = FetchStats()
+    seen = set(range(5, 15))           # already seen: fetch more pages to make up for them
+    pipeline = PagePipeline(gen_pages(10, pulled=pulled), 25, is_new(seen), stats=stats)
+    recs = [rec for (_, recs) in pipeline for rec in recs]
+    assert recs == list(range(5)) + list(range(15, 35))
+    assert pulled == [0, 1, 2, 3]
+    assert pipeline.num_kept == 25
+    assert stats.num_duplicates == 10
+
+
+  def test_pipeline_empty(self):
+    assert list(PagePipeline(gen_pages(0), 10, is_new(set()))) == []
+
+
+  def test_pipeline_error(self):
+    with pytest.raises(ValueError) as ve:
+      list(PagePipeline(gen_pages(5, fail_at=2), 100, is_new(set())))
+    assert 'Page 2 failed' in str(ve.value)
+
+
+  def test_pipeline_early_stop(self):
+    closed = threading.Event()
+    pipeline = PagePipeline(gen_pages(1000, closed=closed), 10000, is_new(set()), depth=2)
+    pages = iter(pipeline)
+    next(pages)
+    pages.close()                      # the caller wants no more pages
+    assert closed.is_set()
+
+
+  def test_pipeline_overlap(self):
+    pulled = []
+    pipeline = PagePipeline(gen_pages(10, pulled=pulled), 100, is_new(set()), depth=2)
+    pages = iter(pipeline)
+    next(pages)
+    time.sleep(0.2)                    # while the caller is busy, later pages are fetched
+    assert len(pulled) > 2
+    # but no more than the queues, and the stages blocked on them, hold
+    assert len(pulled) <= 1 + 2 * (2 + 1)
+    assert len(list(pages)) == 9
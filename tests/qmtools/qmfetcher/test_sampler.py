@@ -0,0 +1,68 @@
+# Tests of fetching a uniform random sample of the records matching a query.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Remove an unused import.
+#
+import random
+
+import qmtools.qmfetcher.sampler as sampler
+
+
+class TestSampler(object):
+
+  def test_draw_offsets(self):
+    rng = random.Random(7)
+    drawn = set()
+    offsets = sampler.draw_offsets(rng, 100, 30, drawn)
+    assert len(set(offsets)) == 30
+    assert offsets == sorted(offsets)
+    assert all((0 <= offset < 100) for offset in offsets)
+    more = sampler.draw_offsets(rng, 100, 100, drawn)
+    assert len(more) == 70             # only the offsets not yet drawn are left
+    assert sorted(offsets + more) == list(range(100))
+    assert sampler.draw_offsets(rng, 100, 10, drawn) == []
+
+
+  def test_get_sampled_records(self, fake_server):
+    page_meta = {}
+    recs = sampler.get_sampled_records('bold', {}, 20, seed=42, page_meta=page_meta)
+    assert len(recs) == 20
+    assert len(set(rec['snr'] for rec in recs)) == 20
+    assert page_meta['total'] == 120
+    assert len(fake_server['pages']) <= 3      # only the pages which hold the sample
+    again = sampler.get_sampled_records('bold', {}, 20, seed=42)
+    assert [rec['snr'] for rec in again] == [rec['snr'] for rec in recs]
+    other = sampler.get_sampled_records('bold', {}, 20, seed=43)
+    assert [rec['snr'] for rec in other] != [rec['snr'] for rec in recs]
+
+
+  def test_get_sampled_records_spread(self, fake_server):
+    fake_server['total'] = 1000
+    recs = sampler.get_sampled_records('bold', {}, 100, seed=1)
+    snrs = [rec['snr'] for rec in recs]
+    assert min(snrs) < 200             # drawn from across the whole result set
+    assert max(snrs) >= 800
+
+
+  def test_get_sampled_records_dups(self, fake_server):
+    fake_server['dups'] = 60           # only 60 distinct checksums
+    chksums = set()
+    recs = sampler.get_sampled_records('bold', {}, 50, seed=3, chksums=chksums)
+    assert len(recs) == 50             # exactly the number asked for, after deduplication
+    assert len(set(rec['provenance.md5sum'] for rec in recs)) == 50
+    assert len(chksums) == 50
+    recs = sampler.get_sampled_records('bold', {}, 100, seed=3)
+    assert len(recs) == 60             # no more distinct records exist
+
+
+  def test_get_sampled_records_all(self, fake_server):
+    recs = sampler.get_sampled_records('bold', {}, 500, seed=5)
+    assert sorted(rec['snr'] for rec in recs) == list(range(120))
+
+
+  def test_get_sampled_records_none(self, fake_server):
+    fake_server['total'] = 0
+    assert sampler.get_sampled_records('bold', {}, 10, seed=5) == []
+
+
+  def test_new_seed(self):
+    assert isinstance(sampler.new_seed(), int)
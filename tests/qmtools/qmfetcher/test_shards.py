@@ -0,0 +1,80 @@
+# Tests of fetching records from the MRIQC server in parallel, time-sharded windows.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Remove an unused import.
+#
+import qmtools.qmfetcher.shards as shards
+from tests.qmtools.qmfetcher.conftest import fake_created
+
+
+class TestShards(object):
+
+  def test_created_times(self):
+    created = fake_created(5)
+    assert shards.to_created(shards.from_created(created)) == created
+    assert shards.from_created(fake_created(4)) - shards.from_created(created) == 3600
+
+
+  def test_add_created_bound(self):
+    args = {'query_params': [['dummy_trs', '==0']]}
+    bound_args = shards.add_created_bound(args, '<', shards.from_created(fake_created(2)))
+    assert bound_args['query_params'] == [['dummy_trs', '==0'],
+                                          ['_created', f'<"{fake_created(2)}"']]
+    assert args == {'query_params': [['dummy_trs', '==0']]}     # unchanged
+
+
+  def test_created_range(self, fake_server):
+    oldest, newest = shards.created_range('bold', {})
+    assert shards.to_created(oldest) == fake_created(119)
+    assert shards.to_created(newest) == fake_created(0)
+    fake_server['total'] = 0
+    assert shards.created_range('bold', {}) is None
+
+
+  def test_find_shard_bound(self, fake_server):
+    time_range = shards.created_range('bold', {})
+    bound, count = shards.find_shard_bound('bold', {}, None, 30, *time_range)
+    assert shards.from_created(fake_created(30)) < bound <= shards.from_created(fake_created(29))
+    assert count == 30
+    bound, count = shards.find_shard_bound('bold', {'use_oldest': True}, None, 30, *time_range)
+    assert shards.from_created(fake_created(90)) <= bound < shards.from_created(fake_created(89))
+    assert count == 30
+    fake_server['tied'] = 20           # only multiples of 20 records can be bounded
+    time_range = shards.created_range('bold', {})
+    bound, count = shards.find_shard_bound('bold', {}, None, 30, *time_range)
+    assert bound == shards.from_created(fake_created(1))
+    assert count == 40
+
+
+  def test_get_sharded_records(self, fake_server):
+    fake_server['total'] = 300
+    page_meta = {}
+    recs = shards.get_sharded_records('bold', {'num_recs': 260}, 4, page_meta=page_meta)
+    assert [rec['snr'] for rec in recs] == list(range(260))
+    assert page_meta['total'] == 300
+    windows = [where for where in fake_server['wheres'] if ('>=' in where) and ('<' in where)]
+    assert windows                     # the later windows are bounded at both ends
+
+
+  def test_get_sharded_records_tied(self, fake_server):
+    fake_server['tied'] = 7            # windows cannot split records created at the same time
+    recs = shards.get_sharded_records('bold', {'num_recs': 100}, 3)
+    assert [rec['snr'] for rec in recs] == list(range(100))
+
+
+  def test_get_sharded_records_oldest(self, fake_server):
+    args = {'num_recs': 60, 'use_oldest': True, 'keyset': True}
+    recs = shards.get_sharded_records('bold', args, 3)
+    assert [rec['snr'] for rec in recs] == list(range(119, 59, -1))
+
+
+  def test_get_sharded_records_dups(self, fake_server):
+    fake_server['dups'] = 50           # only 50 distinct checksums
+    chksums = set()
+    recs = shards.get_sharded_records('bold', {'num_recs': 60}, 2, chksums=chksums)
+    assert [rec['snr'] for rec in recs] == list(range(50))
+    assert len(chksums) == 50
+
+
+  def test_get_sharded_records_none(self, fake_server):
+    fake_server['total'] = 0
+    assert shards.get_sharded_records('bold', {'num_recs': 60}, 2) == []
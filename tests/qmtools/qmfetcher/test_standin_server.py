@@ -0,0 +1,107 @@
+# Tests of the local stand-in for the MRIQC WebAPI, driven by the fetcher.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Add a test of resuming response bodies which are cut off.
+#
+import tempfile
+
+import pytest
+import requests as req
+
+import qmtools.qmfetcher.fetcher as fetch
+from qmtools.qmfetcher.cache import ResponseCache
+from qmtools.qmfetcher.client import FetcherClient
+from qmtools.qmfetcher.throttle import AdaptiveLimiter
+from tests.qmtools.qmfetcher.standin_server import StandinServer, WhereClause, make_records
+
+
+@pytest.fixture(scope='module')
+def standin():
+  with StandinServer(num_recs=120, seed=42) as server:
+    yield server
+
+
+@pytest.fixture
+def client(standin, monkeypatch):
+  monkeypatch.setattr(fetch, 'SERVER_URL', standin.url)
+  with FetcherClient() as client:
+    yield client
+
+
+class TestStandinServer(object):
+
+  def test_where_clause(self):
+    (rec,) = make_records(1, [{'snr': 3, 'bids_meta': {'Manufacturer': 'Siemens'}}])
+    assert WhereClause('').matches(rec)
+    assert WhereClause('snr>2 and bids_meta.Manufacturer=="Siemens"').matches(rec)
+    assert not WhereClause('snr>2 and bids_meta.Manufacturer=="GE"').matches(rec)
+    assert WhereClause('(snr==1 or (snr>=3 and snr<4))').matches(rec)
+    assert WhereClause(f'_created>="{rec["_created"]}"').matches(rec)
+    assert not WhereClause(f'_created<"{rec["_created"]}"').matches(rec)
+    assert not WhereClause('no_such_field==1').matches(rec)
+    with pytest.raises(ValueError):
+      WhereClause('snr>len(snr)').matches(rec)
+
+
+  def test_get_n_records(self, standin, client):
+    page_meta = {}
+    recs = fetch.get_n_records('bold', {'num_recs': 70}, client=client, page_meta=page_meta)
+    assert page_meta['total'] == 120
+    assert page_meta['max_results'] == 50          # the page size is capped, like the server
+    assert [int(rec['_id'], 16) for rec in recs] == list(range(119, 49, -1))
+    assert recs[0]['bids_meta.RepetitionTime'] > 0
+
+
+  def test_get_n_records_fields(self, standin, client):
+    recs = fetch.get_n_records('bold', {'num_recs': 10, 'use_oldest': True, 'fields': ['snr']},
+                               client=client)
+    assert len(recs) == 10
+    assert recs[0]['_created'] == standin.records[0]['_created']   # oldest first
+    assert set(recs[0].keys()) == set(['_created', 'provenance.md5sum', 'snr'])
+
+
+  def test_get_n_records_where(self, standin, client):
+    (rec,) = fetch.get_n_records('bold', {'num_recs': 1}, client=client)
+    args = {'num_recs': 500, 'query_params': [['_created', f'<"{rec["_created"]}"']]}
+    recs = fetch.get_n_records('bold', args, client=client)
+    assert len(recs) == 119
+
+
+  def test_get_n_records_keyset(self, standin, client):
+    recs = fetch.get_n_records('T1w', {'num_recs': 500, 'keyset': True}, client=client)
+    assert [int(rec['_id'], 16) for rec in recs] == list(range(119, -1, -1))
+
+
+  def test_errors(self, client):
+    with StandinServer(num_recs=10, error_rate=1.0) as failing:
+      fetch.SERVER_URL = failing.url             # restored by the client fixture
+      with pytest.raises(req.HTTPError) as he:
+        fetch.server_status('bold', {}, client)
+      assert he.value.response.status_code == 503
+      assert failing.stats['errors'] == 1
+
+
+  def test_cut_bodies(self, client):
+    recs1 = fetch.get_n_records('bold', {'num_recs': 100}, client=client)
+    with StandinServer(num_recs=120, seed=7, cut_rate=0.5) as cutting:
+      fetch.SERVER_URL = cutting.url             # restored by the client fixture
+      limiter = AdaptiveLimiter(max_retries=10, backoff=0.01)
+      with FetcherClient(limiter=limiter) as limited:
+        recs2 = fetch.get_n_records('bold', {'num_recs': 100}, client=limited)
+      assert recs2 == recs1              # the bodies cut off were read again, in full
+      assert cutting.stats['cuts'] > 0
+      assert limiter.retries >= cutting.stats['cuts']   # each cut counted as an overload
+      assert limiter.in_flight == 0
+
+
+  def test_revalidate(self, standin, monkeypatch):
+    monkeypatch.setattr(fetch, 'SERVER_URL', standin.url)
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with FetcherClient(cache=ResponseCache(cache_dir=tmpdir)) as client:
+        recs1 = fetch.get_n_records('bold', {'num_recs': 70}, client=client)
+      start_stats = dict(standin.stats)
+      cache = ResponseCache(cache_dir=tmpdir, refresh=True)
+      with FetcherClient(cache=cache) as client:
+        recs2 = fetch.get_n_records('bold', {'num_recs': 70}, client=client)
+      assert recs1 == recs2
+      assert cache.num_revalidated == 2
+      assert standin.stats['not_modified'] - start_stats['not_modified'] == 2
@@ -0,0 +1,106 @@
+# Tests of the measurement of fetches and of their reports.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Remove the test of the unused stage timer.
+#
+import json
+import os
+import tempfile
+
+import pytest
+
+import qmtools.qmfetcher.fetcher as fetch
+from qmtools.qmfetcher.client import FetcherClient
+from qmtools.qmfetcher.stats import STAGES, ChunkTimer, FetchStats
+from tests.qmtools.qmfetcher.standin_server import StandinServer
+
+
+@pytest.fixture(scope='module')
+def standin():
+  with StandinServer(num_recs=120, seed=42) as server:
+    yield server
+
+
+@pytest.fixture
+def client(standin, monkeypatch):
+  monkeypatch.setattr(fetch, 'SERVER_URL', standin.url)
+  with FetcherClient(stats=FetchStats()) as client:
+    yield client
+
+
+class TestStats(object):
+
+  def test_chunk_timer(self):
+    chunks = ChunkTimer(['ab', 'cé'])
+    assert ''.join(chunks) == 'abcé'
+    assert chunks.num_bytes == 5       # bytes, not characters
+    assert chunks.latency is not None
+    assert chunks.wait_seconds >= chunks.latency
+
+
+  def test_add_page(self):
+    stats = FetchStats()
+    stats.add_page('http://fake/bold', 1000, 50, 0.2, {'transfer': 0.2, 'decode': 0.1})
+    (page,) = stats.report()['pages']
+    assert page['records'] == 50
+    assert page['seconds'] == pytest.approx(0.5)
+    assert page['records_per_sec'] == pytest.approx(100.0)
+    assert stats.stages['request']['seconds'] == pytest.approx(0.2)
+    assert stats.stages['decode']['count'] == 1
+
+
+  def test_report(self):
+    stats = FetchStats()
+    stats.add_dedup(10, 4, 0.01)
+    stats.add_dedup(10, 0, 0.01)
+    stats.add_written(16, 0.05)
+    report = stats.report()
+    assert list(report['stages']) == STAGES
+    assert report['totals']['duplicates'] == 4
+    assert report['totals']['duplicate_ratio'] == pytest.approx(0.2)
+    assert report['totals']['written'] == 16
+    assert report['stages']['dedup']['count'] == 2
+    assert '4 duplicates' in stats.summary()
+
+
+  def test_write_json(self):
+    stats = FetchStats()
+    stats.add_page('http://fake/bold', 10, 1, 0.1, {})
+    with tempfile.TemporaryDirectory() as tmpdir:
+      filepath = os.path.join(tmpdir, 'stats.json')
+      stats.write_json(filepath)
+      with open(filepath) as jsonfile:
+        report = json.load(jsonfile)
+    assert report['totals']['pages'] == 1
+    assert report['pages'][0]['url'] == 'http://fake/bold'
+
+
+  def test_deduplicate_records(self):
+    stats = FetchStats()
+    recs = [{'provenance.md5sum': 'a'}, {'provenance.md5sum': 'a'}, {'snr': 1}]
+    good_recs, _ = fetch.deduplicate_records(recs, stats=stats)
+    assert len(good_recs) == 1
+    assert (stats.num_examined, stats.num_duplicates) == (3, 2)
+
+
+  def test_fetch_measured(self, standin, client):
+    recs = fetch.get_n_records('bold', {'num_recs': 70}, client=client)
+    report = client.stats.report()
+    assert report['totals']['pages'] == 2
+    assert report['totals']['records'] >= 70       # the last page may hold a few extra records
+    assert report['totals']['bytes'] > 0
+    assert report['stages']['dedup']['count'] == 2
+    for page in report['pages']:
+      assert page['bytes'] > 0
+      assert page['latency'] > 0
+      assert set(['transfer', 'decode', 'flatten']) <= set(page)
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fetch.save_to_tsv('bold', recs, os.path.join(tmpdir, 'test.tsv'), stats=client.stats)
+    assert client.stats.num_written == 70
+
+
+  def test_do_query_measured(self, standin, client):
+    assert fetch.server_status('bold', {}, client) == 120
+    (page,) = client.stats.report()['pages']
+    assert page['records'] == 1
+    assert page['bytes'] > 0
+    assert 'decode' in page
@@ -0,0 +1,212 @@
+# Tests of the adaptive limiter on concurrent requests to the MRIQC server.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Test that responses without a body (e.g., 304) count as healthy.
+#
+import threading
+import time
+from email.utils import formatdate
+
+import pytest
+import requests as req
+
+import qmtools.qmfetcher.fetcher as fetch
+from qmtools.qmfetcher.client import FetcherClient
+from qmtools.qmfetcher.throttle import AdaptiveLimiter, parse_retry_after
+
+
+class FakeResponse(object):
+  def __init__ (self, status_code=req.codes.ok, headers=None, text='{"_items": []}', cut_at=None):
+    self.status_code = status_code
+    self.headers = headers or {}
+    self.text = text
+    self.encoding = None
+    self.cut_at = cut_at               # the length of the body sent before it is cut off
+
+  def iter_content (self, chunk_size=1, decode_unicode=False):
+    text = self.text if (self.cut_at is None) else self.text[:self.cut_at]
+    for start in range(0, len(text), chunk_size):
+      yield text[start:start + chunk_size]
+    if (self.cut_at is not None):
+      raise req.exceptions.ChunkedEncodingError('Connection broken: IncompleteRead')
+
+  def close (self):
+    pass
+
+  def raise_for_status (self):
+    raise req.HTTPError(f"{self.status_code} Error", response=self)
+
+
+class FakeSession(object):
+  "Session which answers requests from a list of (response or exception) outcomes."
+  def __init__ (self, outcomes):
+    self.outcomes = list(outcomes)
+    self.calls = 0
+
+  def get (self, url, timeout=None, stream=False, headers=None):
+    self.calls += 1
+    outcome = self.outcomes.pop(0) if self.outcomes else FakeResponse()
+    if (isinstance(outcome, Exception)):
+      raise outcome
+    return outcome
+
+  def close (self):
+    pass
+
+
+class TestThrottle(object):
+
+  def test_parse_retry_after(self):
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('') is None
+    assert parse_retry_after('7') == 7.0
+    assert parse_retry_after('-3') == 0.0
+    assert parse_retry_after('junk') is None
+    wait = parse_retry_after(formatdate(time.time() + 30, usegmt=True))
+    assert 25 < wait <= 30
+
+
+  def test_additive_increase(self):
+    limiter = AdaptiveLimiter(max_limit=3)
+    assert limiter.limit == 1
+    for _ in range(10):
+      limiter.acquire()
+      limiter.release(latency=0.1)
+    assert limiter.limit == 3          # raised to, but not beyond, the maximum
+    assert limiter.peak_limit == 3
+    assert limiter.in_flight == 0
+
+
+  def test_latency_holds_limit(self):
+    limiter = AdaptiveLimiter(max_limit=8)
+    limiter.acquire()
+    limiter.release(latency=0.1)
+    assert limiter.limit == 2
+    for _ in range(6):
+      limiter.acquire()
+      limiter.release(latency=1.0)     # much slower than the best seen
+    assert limiter.limit == 2
+
+
+  def test_multiplicative_decrease(self):
+    limiter = AdaptiveLimiter(max_limit=16, initial_limit=8, backoff=0.01)
+    limiter.acquire()
+    limiter.acquire()
+    limiter.release(overloaded=True)
+    limiter.release(overloaded=True)   # same burst: only halved once
+    assert limiter.limit == 4
+    assert limiter.retries == 2
+    time.sleep(0.02)
+    limiter.acquire()
+    limiter.release(overloaded=True)
+    assert limiter.limit == 2
+
+
+  def test_retry_after_pause(self):
+    limiter = AdaptiveLimiter(max_limit=4, initial_limit=4)
+    limiter.acquire()
+    limiter.release(overloaded=True, retry_after=0.2)
+    start = time.monotonic()
+    limiter.acquire()                  # must wait out the Retry-After time
+    assert (time.monotonic() - start) >= 0.15
+    limiter.release(latency=0.01)
+
+
+  def test_limit_bounds_in_flight(self):
+    limiter = AdaptiveLimiter(max_limit=2, initial_limit=2)
+    limiter.acquire()
+    limiter.acquire()
+    acquired = threading.Event()
+    def third ():
+      limiter.acquire()
+      acquired.set()
+    thread = threading.Thread(target=third)
+    thread.start()
+    assert not acquired.wait(0.1)      # blocked at the limit
+    limiter.release(latency=0.01)
+    assert acquired.wait(1)
+    thread.join()
+
+
+  def test_client_retries(self):
+    limiter = AdaptiveLimiter(max_limit=4, initial_limit=4, backoff=0.01)
+    client = FetcherClient(limiter=limiter)
+    client.session = FakeSession([ FakeResponse(503), req.Timeout(),
+                                   FakeResponse(429, {'Retry-After': '0'}), FakeResponse() ])
+    results = fetch.do_query('http://fake/bold', client=client)
+    assert results == {'_items': []}
+    assert client.session.calls == 4
+    assert limiter.retries == 3
+    assert limiter.limit == 2          # halved to one, then raised by the success
+
+
+  def test_client_out_of_retries(self):
+    limiter = AdaptiveLimiter(max_retries=2, backoff=0.01)
+    client = FetcherClient(limiter=limiter)
+    client.session = FakeSession([FakeResponse(503)] * 5)
+    with pytest.raises(req.RequestException) as re:
+      fetch.do_query('http://fake/bold', client=client)
+    assert re.value.response.status_code == 503
+    assert client.session.calls == 3
+
+
+  def test_client_stream_holds_limiter(self):
+    limiter = AdaptiveLimiter(backoff=0.01)
+    client = FetcherClient(limiter=limiter)
+    client.session = FakeSession([FakeResponse(), FakeResponse()])
+    resp = client.get('http://fake/bold', stream=True)
+    assert limiter.in_flight == 1      # held until the body is read
+    assert ''.join(resp.iter_content(chunk_size=4)) == '{"_items": []}'
+    assert limiter.in_flight == 0
+    assert limiter.retries == 0
+    with client.get('http://fake/bold', stream=True) as resp:
+      assert limiter.in_flight == 1
+    assert limiter.in_flight == 0      # or until it is closed
+
+
+  def test_client_stream_not_modified(self):
+    limiter = AdaptiveLimiter(max_limit=4, backoff=0.01)
+    client = FetcherClient(limiter=limiter)
+    client.session = FakeSession([FakeResponse(req.codes.not_modified)] * 10)
+    for _ in range(10):
+      client.get('http://fake/bold', stream=True).close()
+    assert limiter.in_flight == 0
+    assert limiter.peak_limit > 1      # unchanged responses count as healthy requests
+    client.session = FakeSession([FakeResponse()])
+    limit = limiter.limit
+    client.get('http://fake/bold', stream=True).close()
+    assert limiter.limit == limit      # but an abandoned body does not
+
+
+  def test_client_stream_resumed(self):
+    limiter = AdaptiveLimiter(backoff=0.01)
+    client = FetcherClient(limiter=limiter)
+    text = '{"_items": [1, 2, 3, 4, 5]}'
+    client.session = FakeSession([ FakeResponse(text=text, cut_at=6), FakeResponse(text=text, cut_at=15),
+                                   FakeResponse(text=text) ])
+    with client.get('http://fake/bold', stream=True) as resp:
+      chunks = list(resp.iter_content(chunk_size=4))
+    assert ''.join(chunks) == text     # each part of the body yielded once, in order
+    assert client.session.calls == 3
+    assert limiter.retries == 2        # each cut off body counted as an overload
+    assert limiter.in_flight == 0
+
+
+  def test_client_stream_out_of_retries(self):
+    limiter = AdaptiveLimiter(max_retries=1, backoff=0.01)
+    client = FetcherClient(limiter=limiter)
+    client.session = FakeSession([FakeResponse(cut_at=3)] * 3)
+    with pytest.raises(req.exceptions.ChunkedEncodingError):
+      with client.get('http://fake/bold', stream=True) as resp:
+        list(resp.iter_content(chunk_size=4))
+    assert client.session.calls == 2
+    assert limiter.in_flight == 0
+
+
+  def test_client_not_retried(self):
+    limiter = AdaptiveLimiter(backoff=0.01)
+    client = FetcherClient(limiter=limiter)
+    client.session = FakeSession([FakeResponse(404)])
+    with pytest.raises(req.RequestException) as re:
+      fetch.do_query('http://fake/bold', client=client)
+    assert client.session.calls == 1
+    assert limiter.in_flight == 0
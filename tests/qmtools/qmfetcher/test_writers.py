@@ -0,0 +1,182 @@
+# Tests of the classes which incrementally write fetched records to a file.
+#   Written by: Tom Hicks and Dianne Patterson.
+#   Last Modified: Test the column types of the BIDS metadata fields.
+#
+import gzip
+import os
+import tempfile
+
+import pytest
+
+import qmtools.qmfetcher.writers as writers
+from qmtools.mriqc_keywords import BOLD_KEYWORDS, STRUCTURAL_KEYWORDS
+
+
+@pytest.fixture
+def recs():
+  return [
+    { '_id': '1', 'snr': 1.5, 'provenance.md5sum': '19cf39e8895fcf98e46f6017caebbbf1', 'junk': 'X' },
+    { '_id': '2', 'snr': 2.5, 'provenance.md5sum': '42febfb2ff72767655b0901dbde42ecb' },
+    { '_id': '3', 'snr': 3.5, 'provenance.md5sum': 'af34ecc2a49a550d49216f5b5b5b22d7' }
+  ]
+
+
+class TestWriters(object):
+
+  def test_get_modality_fields(self):
+    assert writers.get_modality_fields('bold') == sorted(BOLD_KEYWORDS)
+    assert writers.get_modality_fields('T1w') == sorted(STRUCTURAL_KEYWORDS)
+    assert writers.get_modality_fields('T2w') == sorted(STRUCTURAL_KEYWORDS)
+
+
+  def test_get_output_fields(self):
+    assert writers.get_output_fields('bold') == sorted(BOLD_KEYWORDS)
+    assert writers.get_output_fields('T1w', []) == sorted(STRUCTURAL_KEYWORDS)
+    assert writers.get_output_fields('bold', ['snr', '_id']) == [
+      '_created', '_id', 'provenance.md5sum', 'snr' ]
+
+
+  def test_tsv_writer_fields(self, recs):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      tmpfile = os.path.join(tmpdir, 'test.tsv')
+      with writers.TsvWriter('bold', tmpfile, fields=['snr']) as writer:
+        writer.write_records(recs)
+      with open(tmpfile) as tmpf:
+        lines = tmpf.readlines()
+      assert lines[0] == '_created\tprovenance.md5sum\tsnr\n'
+      assert lines[1] == '\t19cf39e8895fcf98e46f6017caebbbf1\t1.5\n'
+
+
+  def test_tsv_writer_batches(self, recs):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      tmpfile = os.path.join(tmpdir, 'test.tsv')
+      with writers.TsvWriter('bold', tmpfile) as writer:
+        writer.write_records(recs[:1])
+        writer.write_records([])
+        writer.write_records(recs[1:])
+      assert writer.num_written == 3
+      with open(tmpfile) as tmpf:
+        lines = tmpf.readlines()
+      assert len(lines) == 4           # header is written only once
+      assert lines[0].startswith('_created\t_etag\t_id\t')
+      assert 'junk' not in lines[0]
+      assert 'X' not in lines[1]
+      assert '3.5' in lines[3]
+
+
+  def test_tsv_writer_gzip(self, recs):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      tmpfile = os.path.join(tmpdir, 'test.tsv.gz')
+      with writers.get_writer('bold', tmpfile, 'tsv.gz') as writer:
+        writer.write_records(recs[:1])
+        writer.write_records(recs[1:])
+      with gzip.open(tmpfile, 'rt') as tmpf:
+        lines = tmpf.readlines()
+      assert len(lines) == 4
+      assert lines[0].startswith('_created\t_etag\t_id\t')
+      assert '3.5' in lines[3]
+
+
+  def test_format_for_path(self):
+    assert writers.format_for_path('fetched/bold.tsv') == 'tsv'
+    assert writers.format_for_path('fetched/bold.tsv.gz') == 'tsv.gz'
+    assert writers.format_for_path('bold.parquet') == 'parquet'
+    assert writers.format_for_path('bold.feather') == 'feather'
+    assert writers.format_for_path('bold') == 'tsv'
+    assert writers.format_for_path('bold.txt', default=None) is None
+
+
+  def test_field_type(self):
+    assert writers.field_type('_id') == 'string'
+    assert writers.field_type('provenance.md5sum') == 'string'
+    assert writers.field_type('bids_meta.TaskName') == 'string'
+    assert writers.field_type('bids_meta.Manufacturer') == 'string'
+    assert writers.field_type('bids_meta.RepetitionTime') == 'float'
+    assert writers.field_type('bids_meta.MagneticFieldStrength') == 'float'
+    assert writers.field_type('provenance.settings.hmc_fsl') == 'bool'
+    assert writers.field_type('snr') == 'float'
+    assert writers.field_type('provenance.settings.fd_thres') == 'float'
+
+
+  def test_converters(self):
+    assert writers.to_float('2.5') == 2.5
+    assert writers.to_float(3) == 3.0
+    assert writers.to_float('n/a') is None
+    assert writers.to_float(None) is None
+    assert writers.to_bool('True') is True
+    assert writers.to_bool(False) is False
+    assert writers.to_bool('maybe') is None
+    assert writers.to_string(0.5) == '0.5'
+    assert writers.to_string(None) is None
+
+
+  def test_get_writer_errors(self, monkeypatch):
+    with pytest.raises(ValueError):
+      writers.get_writer('bold', 'test.csv', 'csv')
+    monkeypatch.setattr(writers, 'pa', None)
+    assert writers.available_formats() == ['tsv', 'tsv.gz']
+    with pytest.raises(ValueError) as ve:
+      writers.get_writer('bold', 'test.parquet', 'parquet')
+    assert 'not one of the available formats' in str(ve)
+
+
+  def test_columnar_writer(self, recs):
+    pd = pytest.importorskip('pandas')
+    pytest.importorskip('pyarrow')
+    with tempfile.TemporaryDirectory() as tmpdir:
+      for fmt in writers.COLUMNAR_FORMATS:
+        tmpfile = os.path.join(tmpdir, f"test.{fmt}")
+        with writers.get_writer('bold', tmpfile, fmt) as writer:
+          writer.batch_size = 2        # test writing of several row groups (batches)
+          writer.write_records(recs[:1])
+          writer.write_records([])
+          writer.write_records(recs[1:] + [{ '_id': '4', 'snr': 'bad' }])
+        assert writer.num_written == 4
+        df = pd.read_parquet(tmpfile) if (fmt == 'parquet') else pd.read_feather(tmpfile)
+        assert list(df.columns) == writers.get_modality_fields('bold')
+        assert str(df['snr'].dtype) == 'float64'
+        assert df['snr'].tolist()[:3] == [1.5, 2.5, 3.5]
+        assert pd.isna(df['snr'].tolist()[3])
+        assert df['_id'].tolist() == ['1', '2', '3', '4']
+        with pytest.raises(ValueError):
+          writers.get_writer('bold', tmpfile, fmt, append=True)
+
+
+  def test_columnar_writer_dtypes(self, recs):
+    pytest.importorskip('pyarrow')
+    from qmtools.qm_utils import load_tsv
+    bids_meta = { 'bids_meta.RepetitionTime': 2.0, 'bids_meta.EchoTime': 0.03,
+                  'bids_meta.FlipAngle': 90.0, 'bids_meta.MagneticFieldStrength': 3.0,
+                  'bids_meta.Manufacturer': 'Siemens', 'bids_meta.TaskName': 'rest',
+                  'bids_meta.run_id': 1.0 }
+    bids_recs = [ dict(rec, **bids_meta) for rec in recs ]
+    with tempfile.TemporaryDirectory() as tmpdir:
+      frames = {}
+      for fmt in ['tsv', 'parquet']:
+        tmpfile = os.path.join(tmpdir, f"test.{fmt}")
+        with writers.get_writer('bold', tmpfile, fmt) as writer:
+          writer.write_records(bids_recs)
+        frames[fmt] = load_tsv(tmpfile)
+      for field in ['snr'] + list(bids_meta):   # the same types, however written
+        assert frames['parquet'][field].dtype == frames['tsv'][field].dtype, field
+      assert str(frames['parquet']['bids_meta.RepetitionTime'].dtype) == 'float64'
+      assert frames['parquet']['bids_meta.FlipAngle'].tolist() == [90.0, 90.0, 90.0]
+
+
+  def test_columnar_writer_norecs(self):
+    pytest.importorskip('pyarrow')
+    with tempfile.TemporaryDirectory() as tmpdir:
+      tmpfile = os.path.join(tmpdir, 'test.parquet')
+      with writers.ColumnarWriter('T1w', tmpfile) as writer:
+        writer.write_records([])
+      assert writer.num_written == 0
+      assert not os.path.exists(tmpfile)
+
+
+  def test_tsv_writer_norecs(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      tmpfile = os.path.join(tmpdir, 'test.tsv')
+      with writers.TsvWriter('T1w', tmpfile) as writer:
+        writer.write_records([])
+      assert writer.num_written == 0
+      assert not os.path.exists(tmpfile)
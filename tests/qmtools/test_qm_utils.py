@@ -1,7 +1,8 @@
 # Tests of Shared utilities for the QMTools programs.
 #   Written by: Tom Hicks and Dianne Patterson. 8/5/2021.
-#   Last Modified: Reset (stupid) magic file size constant.
+#   Last Modified: Add tests of loading gzipped and columnar files.
 #
+import gzip
 import os
 import pandas
 import pytest
@@ -123,6 +124,28 @@ class TestQMUtils(object):
     assert qm_df.shape == self.df_shape
 
 
+  def test_load_tsv_gzip(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      gzpath = os.path.join(tmpdir, 'bold_test.tsv.gz')
+      with open(self.bold_test_fyl, 'rb') as infile, gzip.open(gzpath, 'wb') as outfile:
+        outfile.write(infile.read())
+      qm_df = qmu.load_tsv(gzpath)
+      assert qm_df.shape == self.df_shape
+      assert qm_df.equals(qmu.load_tsv(self.bold_test_fyl))
+
+
+  def test_load_tsv_columnar(self):
+    pytest.importorskip('pyarrow')
+    tsv_df = qmu.load_tsv(self.bold_test_fyl)
+    with tempfile.TemporaryDirectory() as tmpdir:
+      for (ext, writer) in [('.parquet', tsv_df.to_parquet), ('.feather', tsv_df.to_feather)]:
+        filepath = os.path.join(tmpdir, f"bold_test{ext}")
+        writer(filepath)
+        qm_df = qmu.load_tsv(filepath)
+        assert qm_df.shape == self.df_shape
+        assert qm_df.equals(tsv_df)
+
+
   def test_validate_modality_good(self):
     assert qmu.validate_modality('bold') == 'bold'
     assert qmu.validate_modality('T1w') == 'T1w'